@@ -0,0 +1,129 @@
+"""
+Deterministic synthetic GIF corpus for the benchmarks. Every case is drawn from its own seeded RNG, so two runs
+(or two machines) with the same CORPUS_VERSION get byte identical files.
+"""
+import os
+import json
+import random
+from typing import List, NamedTuple, Tuple
+
+from PIL import Image, ImageChops, ImageDraw
+
+# bump whenever the cases or the way they're drawn changes, so stale corpora get regenerated
+CORPUS_VERSION = 1
+MANIFEST_NAME = 'corpus.json'
+
+
+class CorpusCase(NamedTuple):
+    name: str
+    size: Tuple[int, int]
+    frames: int
+    # 'full': every pixel changes every frame, 'partial': a sprite moves over a still background
+    mode: str
+    # 'global': one palette shared by every frame, 'local': every frame brings its own
+    palette: str
+    duration: int = 40
+
+
+CASES = (
+    CorpusCase('small-full-global', (320, 240), 24, 'full', 'global'),
+    CorpusCase('small-partial-local', (320, 240), 24, 'partial', 'local'),
+    CorpusCase('xga-full-local', (1024, 768), 12, 'full', 'local'),
+    CorpusCase('wide-partial-global', (1280, 720), 30, 'partial', 'global'),
+    CorpusCase('hd-full-global', (1920, 1080), 16, 'full', 'global'),
+    CorpusCase('hd-partial-local', (1920, 1080), 16, 'partial', 'local'),
+    CorpusCase('long-partial-global', (640, 480), 120, 'partial', 'global'),
+    CorpusCase('single-frame', (800, 600), 1, 'full', 'global'),
+)
+
+QUICK_CASES = ('small-full-global', 'small-partial-local', 'wide-partial-global')
+
+
+def _background(rng: random.Random, size: Tuple[int, int]) -> Image.Image:
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    image = ImageChops.multiply(image, Image.new('RGB', size, tuple(rng.randrange(128, 256) for _ in range(3))))
+    draw = ImageDraw.Draw(image)
+    for _ in range(24):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = x0 + rng.randrange(8, size[0] // 3), y0 + rng.randrange(8, size[1] // 3)
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle((x0, y0, x1, y1), fill=fill)
+        else:
+            draw.ellipse((x0, y0, x1, y1), fill=fill)
+    return image
+
+
+def _frames(case: CorpusCase, rng: random.Random) -> List[Image.Image]:
+    background = _background(rng, case.size)
+    sprite_size = (max(case.size[0] // 8, 8), max(case.size[1] // 8, 8))
+    sprite = _background(rng, sprite_size)
+    frames = []
+    for i in range(case.frames):
+        if case.mode == 'full':
+            # scroll the whole picture, every pixel changes
+            offset = (i * case.size[0]) // max(case.frames, 1)
+            frame = ImageChops.offset(background, offset, i * 3)
+        else:
+            frame = background.copy()
+            x = (i * (case.size[0] - sprite_size[0])) // max(case.frames - 1, 1)
+            y = (case.size[1] - sprite_size[1]) // 2
+            frame.paste(sprite, (x, y))
+        frames.append(frame)
+    return frames
+
+
+def _quantize(case: CorpusCase, frames: List[Image.Image]) -> List[Image.Image]:
+    if case.palette == 'global':
+        palette = frames[0].quantize(colors=255)
+        return [frame.quantize(palette=palette, dither=Image.Dither.NONE) for frame in frames]
+    # a different colour count per frame keeps pillow from folding the tables back into one
+    return [frame.quantize(colors=192 + i % 60) for i, frame in enumerate(frames)]
+
+
+def generate_case(case: CorpusCase, path: str):
+    rng = random.Random('{}-{}'.format(CORPUS_VERSION, case.name))
+    frames = _quantize(case, _frames(case, rng))
+    options = {}
+    if case.palette == 'global':
+        # without an explicit palette pillow gives every frame after the first a local table
+        options['palette'] = bytes(frames[0].getpalette())
+    frames[0].save(
+        path, format='GIF', save_all=len(frames) > 1, append_images=frames[1:], duration=case.duration, loop=0,
+        **options
+    )
+
+
+def generate_corpus(directory: str, names=None) -> List[Tuple[CorpusCase, str]]:
+    """
+    Make sure the corpus is in directory, only drawing cases that are missing or from another CORPUS_VERSION.
+
+    Args:
+        names (optional): only these cases
+
+    Returns:
+        [(case, path)]
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get('version') != CORPUS_VERSION:
+        manifest = {'version': CORPUS_VERSION, 'cases': []}
+
+    corpus = []
+    for case in CASES:
+        if names is not None and case.name not in names:
+            continue
+        path = os.path.join(directory, case.name + '.gif')
+        if case.name not in manifest['cases'] or not os.path.isfile(path):
+            generate_case(case, path)
+            manifest['cases'].append(case.name)
+        corpus.append((case, path))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return corpus
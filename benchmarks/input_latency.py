@@ -0,0 +1,171 @@
+"""
+Latency from a button callback firing on its own thread to the change being queued for every screen, for the old
+janus queue bridge in ButtonWatcher and the call_soon_threadsafe path through ButtonInput.
+
+The old path is rebuilt here as it was: the callback puts a string and a timestamp on a janus.Queue, a proxy task
+awaits it on the loop, and the send spawns its own task to broadcast. The broadcast itself is the same for both,
+encode once and put_nowait on each client's send queue, with a task per client draining it. Runs once on an idle
+loop and once with another task hogging it in short slices, like a resize finishing or a snapshot being built.
+
+    python benchmarks/input_latency.py --edges 2000 --clients 10
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from threading import Thread
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'client-server-attempt')
+sys.path.insert(0, SERVER_PATH)
+
+from button_input import ButtonEvent, ButtonInput, Buttons, InputSource
+from client_connection import encode_message
+
+VARIANTS = ('janus', 'call_soon_threadsafe')
+
+# how long the busy loop's other task holds the loop for each time it runs
+BUSY_SLICE_SECONDS = 0.002
+
+
+class Screens:
+    """
+    Stand in for ConnectionManager._broadcast, every client's send queue with its sender draining it.
+    """
+
+    def __init__(self, clients: int):
+        self.queues = [asyncio.Queue() for _ in range(clients)]
+        self.senders = [asyncio.create_task(self._Drain(queue)) for queue in self.queues]
+        self.latencies = []
+
+    async def _Drain(self, queue: asyncio.Queue):
+        while True:
+            await queue.get()
+
+    def Broadcast(self, input_time: float):
+        text = encode_message({'message': 'TOGGLE_GIF', 'current': 'gif.gif', 'seq': len(self.latencies)})
+        for queue in self.queues:
+            queue.put_nowait(text)
+        self.latencies.append(time.monotonic() - input_time)
+
+    def Stop(self):
+        for sender in self.senders:
+            sender.cancel()
+
+
+def press_on_a_thread(edges: int, interval: float, press) -> Thread:
+    def run():
+        for _ in range(edges):
+            press()
+            time.sleep(interval)
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+async def wait_for(thread: Thread):
+    await asyncio.get_running_loop().run_in_executor(None, thread.join)
+    # long enough for whatever the last edges are still waiting behind to get broadcast
+    await asyncio.sleep(0.1)
+
+
+async def run_janus(screens: Screens, edges: int, interval: float):
+    import janus
+    queue = janus.Queue()
+
+    async def broadcast(input_time):
+        screens.Broadcast(input_time)
+
+    async def proxy():
+        while True:
+            name, input_time = await queue.async_q.get()
+            if name == 'TOGGLE_PUSHED':
+                asyncio.create_task(broadcast(input_time))
+
+    proxy_task = asyncio.create_task(proxy())
+    await wait_for(press_on_a_thread(edges, interval, lambda: queue.sync_q.put(('TOGGLE_PUSHED', time.monotonic()))))
+    proxy_task.cancel()
+    queue.close()
+
+
+class FakePresses(InputSource):
+
+    def __init__(self, edges: int, interval: float):
+        self.edges = edges
+        self.interval = interval
+        self.thread = None
+
+    def Start(self, emit):
+        # alternate the edges so every one of them is a change, the debounce is off for this
+        pressed = [False]
+
+        def press():
+            pressed[0] = not pressed[0]
+            emit(Buttons.TOGGLE, pressed[0], None)
+        self.thread = press_on_a_thread(self.edges, self.interval, press)
+
+
+async def run_call_soon_threadsafe(screens: Screens, edges: int, interval: float):
+    def on_event(event: ButtonEvent):
+        screens.Broadcast(event.input_time)
+
+    source = FakePresses(edges, interval)
+    ButtonInput(on_event=on_event, debounce=0).Start(source)
+    await wait_for(source.thread)
+
+
+async def hog_the_loop():
+    while True:
+        end = time.monotonic() + BUSY_SLICE_SECONDS
+        while time.monotonic() < end:
+            pass
+        await asyncio.sleep(0)
+
+
+async def run_variant(variant: str, busy: bool, edges: int, interval: float, clients: int) -> dict:
+    screens = Screens(clients)
+    hog = asyncio.create_task(hog_the_loop()) if busy else None
+    if variant == 'janus':
+        await run_janus(screens, edges, interval)
+    else:
+        await run_call_soon_threadsafe(screens, edges, interval)
+    if hog is not None:
+        hog.cancel()
+    screens.Stop()
+    latencies = sorted(screens.latencies)
+    return {
+        'variant': variant,
+        'loop': 'busy' if busy else 'idle',
+        # an edge and its undo landing while the loop was held up come out as no change at all, and go nowhere
+        'broadcast': len(latencies),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--edges', type=int, default=2000, help='button edges per run')
+    parser.add_argument('--interval', type=float, default=0.001, help='seconds between edges')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    results = []
+    for busy in (False, True):
+        for variant in VARIANTS:
+            results.append(asyncio.run(run_variant(variant, busy, args.edges, args.interval, args.clients)))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print('{variant:>20} {loop:>4}: {broadcast:5} sent  p50 {p50_ms:7.3f} ms  p99 {p99_ms:7.3f} ms  '
+              'max {max_ms:7.3f} ms'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
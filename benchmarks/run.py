@@ -0,0 +1,268 @@
+"""
+Resize / playback benchmarks over the synthetic corpus in corpus.py.
+
+Targets:
+    resize       client-server-attempt resize_gifs.try_and_resize_gif, source -> screen sized gif
+    resize_frame_palette  the same with every frame quantized on its own, what resize did before shared palettes
+    extract      resize_gifs.extract_and_resize_frames alone, decode + composite + resample to screen size
+    webp         resize_gifs.try_and_transcode_gif, screen sized gif -> animated webp
+    frame_store  tkinter-attempt FRAME_STORE.write_frame_store, plus how fast the player can read frames back
+
+Every case records wall time (best of --repeat), frames per second, peak RSS and output bytes. The resize targets
+also record the PSNR of the output against the unquantized resized frames, and how long Pillow takes to decode it.
+Results go out as JSON, and with --baseline a run is checked against a saved one and exits 1 on a regression:
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import concurrent.futures
+from typing import Any, Callable, Dict, List
+
+import PIL
+import numpy as np
+from PIL import Image
+
+BENCHMARKS_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, '..', 'client-server-attempt'))
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, '..', 'tkinter-attempt'))
+
+import FRAME_STORE
+from corpus import CORPUS_VERSION, QUICK_CASES, CorpusCase, generate_corpus
+from resize_gifs import (
+    PALETTE, SCREEN_SIZE, extract_and_resize_frames, extract_frames, peak_rss, reset_peak_rss, try_and_resize_gif,
+    try_and_transcode_gif
+)
+
+RESULTS_VERSION = 1
+CORPUS_PATH = os.path.join(BENCHMARKS_PATH, 'corpus')
+
+# metrics where bigger is worse, and how much bigger counts as a regression on top of the relative threshold
+CHECKED_METRICS = {
+    'wall_seconds': 0.02,
+    'peak_rss': 4 * 1024 * 1024,
+    'output_bytes': 0,
+}
+DEFAULT_THRESHOLD = 0.10
+
+
+def psnr(path: str, resized_path: str) -> float:
+    """
+    Every source frame is compared against the output frame that's on screen when it would be, the output has
+    runs of identical frames merged into one.
+
+    Returns:
+        mean PSNR in dB of the resized gif's frames against the source frames resized without quantizing
+    """
+    total = 0.0
+    frames = 0
+    output = extract_frames(resized_path)
+    actual, actual_end = None, 0
+    # ms into the animation the source frame goes up
+    shown = 0
+    for expected, duration in extract_and_resize_frames(path, SCREEN_SIZE):
+        while actual is None or actual_end <= shown:
+            try:
+                actual, actual_duration = next(output)
+            except StopIteration:
+                break
+            actual_end += actual_duration
+        shown += duration
+        difference = np.asarray(expected.convert('RGB'), np.float32) - np.asarray(actual.convert('RGB'), np.float32)
+        mse = float((difference ** 2).mean())
+        total += 100.0 if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+        frames += 1
+    return total / max(frames, 1)
+
+
+def decode_seconds(path: str) -> float:
+    start = time.perf_counter()
+    with Image.open(path) as im:
+        for i in range(getattr(im, 'n_frames', 1)):
+            im.seek(i)
+            im.load()
+    return time.perf_counter() - start
+
+
+def _bench_resize(case: CorpusCase, path: str, work_path: str, palette: str) -> Dict[str, Any]:
+    save_as = os.path.join(work_path, '{}-{}.gif'.format(case.name, palette))
+    start = time.perf_counter()
+    try_and_resize_gif(SCREEN_SIZE[0], SCREEN_SIZE[1], path, save_as, palette=palette)
+    wall_seconds = time.perf_counter() - start
+    return {
+        'frames': case.frames,
+        'output_bytes': os.path.getsize(save_as),
+        'wall_seconds': wall_seconds,
+        'peak_rss': peak_rss(),
+        # not timed or counted in peak rss, and not checked for regressions
+        'psnr': psnr(path, save_as),
+        'decode_seconds': decode_seconds(save_as),
+    }
+
+
+def bench_resize(case: CorpusCase, path: str, work_path: str) -> Dict[str, Any]:
+    return _bench_resize(case, path, work_path, PALETTE)
+
+
+def bench_resize_frame_palette(case: CorpusCase, path: str, work_path: str) -> Dict[str, Any]:
+    return _bench_resize(case, path, work_path, 'frame')
+
+
+def bench_extract(case: CorpusCase, path: str, work_path: str) -> Dict[str, Any]:
+    frames = sum(1 for _ in extract_and_resize_frames(path, SCREEN_SIZE))
+    return {'frames': frames, 'output_bytes': 0}
+
+
+def bench_webp(case: CorpusCase, path: str, work_path: str) -> Dict[str, Any]:
+    resized = os.path.join(work_path, case.name + '.gif')
+    if not os.path.isfile(resized):
+        # not timed, webp only ever starts from a resized gif
+        try_and_resize_gif(SCREEN_SIZE[0], SCREEN_SIZE[1], path, resized)
+    save_as = os.path.join(work_path, case.name + '.webp')
+    reset_peak_rss()
+    start = time.perf_counter()
+    try_and_transcode_gif(resized, save_as)
+    return {
+        'frames': case.frames,
+        'output_bytes': os.path.getsize(save_as),
+        'wall_seconds': time.perf_counter() - start,
+    }
+
+
+def bench_frame_store(case: CorpusCase, path: str, work_path: str) -> Dict[str, Any]:
+    FRAME_STORE.STORE_PATH = work_path
+    store_path = FRAME_STORE.write_frame_store(path, SCREEN_SIZE)
+    output_bytes = os.path.getsize(store_path)
+    # what GifViewer.UpdateImage does per frame, minus the tk upload
+    screen = Image.new('RGB', SCREEN_SIZE)
+    store = FRAME_STORE.FrameStore(store_path)
+    start = time.perf_counter()
+    for i in range(len(store)):
+        screen.paste(store.frame(i))
+    playback_seconds = time.perf_counter() - start
+    store.close()
+    return {
+        'frames': case.frames,
+        'output_bytes': output_bytes,
+        'playback_fps': case.frames / playback_seconds if playback_seconds > 0 else None,
+    }
+
+
+TARGETS: Dict[str, Callable[[CorpusCase, str, str], Dict[str, Any]]] = {
+    'resize': bench_resize,
+    'resize_frame_palette': bench_resize_frame_palette,
+    'extract': bench_extract,
+    'webp': bench_webp,
+    'frame_store': bench_frame_store,
+}
+
+
+def run_case(target: str, case: CorpusCase, path: str, work_path: str, repeat: int) -> Dict[str, Any]:
+    best = None
+    for _ in range(repeat):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = TARGETS[target](case, path, work_path)
+        result.setdefault('wall_seconds', time.perf_counter() - start)
+        result.setdefault('peak_rss', peak_rss())
+        if best is None or result['wall_seconds'] < best['wall_seconds']:
+            best = result
+    best['fps'] = best['frames'] / best['wall_seconds'] if best['wall_seconds'] > 0 else None
+    return best
+
+
+def run(targets: List[str], corpus_path: str, names=None, repeat: int = 1) -> Dict[str, Any]:
+    corpus = generate_corpus(corpus_path, names)
+    results: Dict[str, Dict[str, Any]] = {target: {} for target in targets}
+    # a fresh interpreter per case, so peak RSS is the case's own and not whatever ran before it
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=1
+    )
+    with pool, tempfile.TemporaryDirectory() as work_path:
+        for target in targets:
+            for case, path in corpus:
+                result = pool.submit(run_case, target, case, path, work_path, repeat).result()
+                results[target][case.name] = result
+                print('{:>20} {:>24}: {:7.3f}s {:8.1f} fps {:7.1f} MB rss {:10d} bytes'.format(
+                    target, case.name, result['wall_seconds'], result['fps'] or 0,
+                    result['peak_rss'] / (1024 * 1024), result['output_bytes']
+                ), file=sys.stderr)
+    return {
+        'version': RESULTS_VERSION,
+        'corpus_version': CORPUS_VERSION,
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """
+    Returns:
+        one line per metric that got worse than the baseline by more than threshold (and the metric's slack)
+    """
+    if baseline.get('corpus_version') != results['corpus_version']:
+        return ['baseline is for corpus version {}, this run is {}'.format(
+            baseline.get('corpus_version'), results['corpus_version']
+        )]
+    regressions = []
+    for target, cases in results['results'].items():
+        for case_name, result in cases.items():
+            base = baseline.get('results', {}).get(target, {}).get(case_name)
+            if base is None:
+                continue
+            for metric, slack in CHECKED_METRICS.items():
+                if metric not in base or metric not in result:
+                    continue
+                limit = base[metric] * (1 + threshold) + slack
+                if result[metric] > limit:
+                    regressions.append('{} {} {}: {} -> {} ({:+.1%})'.format(
+                        target, case_name, metric, base[metric], result[metric],
+                        result[metric] / base[metric] - 1 if base[metric] else float('inf')
+                    ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', default=','.join(TARGETS), help='comma separated, from: ' + ', '.join(TARGETS))
+    parser.add_argument('--quick', action='store_true', help='only the small cases: ' + ', '.join(QUICK_CASES))
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, the fastest one is kept')
+    parser.add_argument('--corpus', default=CORPUS_PATH, help='where the synthetic gifs get generated')
+    parser.add_argument('--output', help='write the results json here instead of stdout')
+    parser.add_argument('--baseline', help='results json to compare against, exits 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    targets = [target.strip() for target in args.targets.split(',') if target.strip()]
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        parser.error('unknown targets: ' + ', '.join(sorted(unknown)))
+
+    results = run(targets, args.corpus, QUICK_CASES if args.quick else None, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Throughput of the /gifs serving layer: plain StaticFiles against ContentHashedStaticFiles with the hot asset
+cache, with N screens all pulling the same files at once, like a room full of kiosks after a library update.
+
+Each variant runs in its own uvicorn process, so the server CPU time is the server's alone.
+
+    python benchmarks/static_throughput.py --clients 10 --requests 50
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'client-server-attempt')
+
+VARIANTS = ('StaticFiles', 'ContentHashedStaticFiles')
+
+# (name, bytes), one that fits in the hot cache and one that has to be streamed
+DEFAULT_FILES = (('small.gif', 2 * 1024 * 1024), ('large.gif', 24 * 1024 * 1024))
+
+
+def make_app(variant: str, directory: str):
+    sys.path.insert(0, SERVER_PATH)
+    from starlette.applications import Starlette
+    from starlette.staticfiles import StaticFiles
+    from static_files import ContentHashedStaticFiles, HotAssetCache
+
+    app = Starlette()
+    if variant == 'StaticFiles':
+        app.mount('/gifs', StaticFiles(directory=directory))
+    else:
+        app.mount('/gifs', ContentHashedStaticFiles(
+            directory=directory, content_hash=lambda path, stat: None, hot_cache=HotAssetCache()
+        ))
+    return app
+
+
+def serve(variant: str, directory: str, port: int):
+    import uvicorn
+    uvicorn.run(make_app(variant, directory), host='127.0.0.1', port=port, log_level='warning')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_cpu_seconds(pid: int) -> float:
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 counting from 1
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server never came up on {}'.format(port))
+
+
+async def fetch_all(port: int, names, clients: int, requests: int) -> int:
+    async def client():
+        received = 0
+        async with httpx.AsyncClient(base_url='http://127.0.0.1:{}'.format(port)) as http:
+            for i in range(requests):
+                response = await http.get('/gifs/' + names[i % len(names)])
+                response.raise_for_status()
+                received += len(response.content)
+        return received
+
+    return sum(await asyncio.gather(*[client() for _ in range(clients)]))
+
+
+def run_variant(variant: str, directory: str, names, clients: int, requests: int):
+    port = free_port()
+    server = subprocess.Popen([
+        sys.executable, __file__, '--serve', variant, '--directory', directory, '--port', str(port)
+    ])
+    try:
+        wait_for_port(port)
+        # one pass to warm the page cache (and the hot cache), so both variants start from the same place
+        asyncio.run(fetch_all(port, names, 1, len(names)))
+        cpu_start = process_cpu_seconds(server.pid)
+        start = time.perf_counter()
+        received = asyncio.run(fetch_all(port, names, clients, requests))
+        seconds = time.perf_counter() - start
+        cpu_seconds = process_cpu_seconds(server.pid) - cpu_start
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'variant': variant,
+        'requests': clients * requests,
+        'seconds': seconds,
+        'requests_per_second': clients * requests / seconds,
+        'mb_per_second': received / seconds / (1024 * 1024),
+        'server_cpu_seconds': cpu_seconds,
+        'server_cpu_ms_per_mb': cpu_seconds * 1000 / (received / (1024 * 1024)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=50, help='requests per client')
+    parser.add_argument('--directory', help='serve the gifs in here instead of generated files')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--serve', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.directory, args.port)
+        return
+
+    with tempfile.TemporaryDirectory() as generated:
+        directory = args.directory
+        if directory is None:
+            directory = generated
+            for name, size in DEFAULT_FILES:
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(os.urandom(size))
+        names = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+        results = [run_variant(variant, directory, names, args.clients, args.requests) for variant in VARIANTS]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print('{variant:>26}: {requests_per_second:8.1f} req/s {mb_per_second:8.1f} MB/s '
+              '{server_cpu_ms_per_mb:6.2f} ms server cpu per MB'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
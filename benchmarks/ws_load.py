@@ -0,0 +1,474 @@
+"""
+Headless load / latency harness for the websocket server in client-server-attempt/main.py.
+
+The server runs in its own process with SPARKY_HEADLESS=1, so there's no browser and the buttons are a fake: this
+script writes button edges to the server's stdin, stamped with time.monotonic(). N simulated screens connect over
+/ws, ack every event like the browser does, and record when each one arrived. Everything runs on one machine, so
+every timestamp is on the same monotonic clock.
+
+Reported: delivery latency percentiles (button edge -> message received by a screen), lost messages, messages
+that arrived out of order, how often the server had to resync a screen that fell behind, and the server's CPU and
+memory.
+
+With --drops every screen also drops its connection that many times at random, and reconnects straight away
+resuming from the last seq it saw, like the browser does after a wifi blip. Events it missed while it was away
+should be replayed, so they still count as delivered. Reported on top: how long getting back took, and how many
+reconnects needed a full snapshot instead of a replay.
+
+With --sync the server runs in sync mode (SPARKY_SYNC=1), like a wall of screens. Every screen gets a clock of
+its own that is off from the real one by up to a few seconds, works out the server's clock over /ws like the
+browser does, and applies every scheduled change when its estimate of the server's clock says so. Since the real
+clock is shared, the harness knows exactly when each screen applied each change. Reported on top: the skew between
+the first and last screen per change, how far from the scheduled time the screens were, how far off their clock
+estimates were, and the skew the server worked out from the screens' own reports. Phase resyncs go out every
+PHASE_RESYNC_INTERVAL, run for longer than that to see them.
+
+    python benchmarks/ws_load.py --clients 20 --toggle-rate 5 --power-rate 0.5 --duration 10
+    python benchmarks/ws_load.py --clients 20 --drops 5
+    python benchmarks/ws_load.py --clients 10 --sync --duration 40
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+import websockets
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'client-server-attempt')
+
+# how long after the last button edge the screens keep listening for stragglers
+DRAIN_SECONDS = 2.0
+
+SNAPSHOT_MESSAGES = ('LOAD_GIFS', 'NO_GIFS')
+
+# each screen's clock is off from the real one by up to this many seconds either way
+MAX_CLOCK_SKEW = 5.0
+# same as index.js
+CLOCK_BURST = 5
+CLOCK_BURST_SPACING = 0.1
+CLOCK_INTERVAL = 10.0
+CLOCK_SAMPLES = 8
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError('server never came up on {}'.format(port))
+
+
+def process_cpu_seconds(pid: int) -> float:
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 counting from 1
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def process_memory(pid: int) -> Dict[str, int]:
+    memory = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                name, value = line.split()[:2]
+                memory[name[:-1]] = int(value) * 1024
+    return memory
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if len(values) == 0:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {'p50': rank(0.50), 'p90': rank(0.90), 'p99': rank(0.99), 'max': values[-1]}
+
+
+class SimulatedScreen:
+
+    def __init__(self, index: int, clock_skew: float = 0.0, sync: bool = False):
+        """
+        Args:
+            clock_skew (optional): seconds this screen's clock is ahead of the real one
+            sync (optional): keep track of the server's clock and apply scheduled changes when it says
+        """
+        self.index = index
+        self.clock_skew = clock_skew
+        self.sync = sync
+        self.connected = asyncio.Event()
+        # (event id, time.monotonic() it arrived)
+        self.received: List[Tuple[int, float]] = []
+        self.messages = 0
+        # full state snapshots, one on connect and one more every time the server resynced a slow screen
+        self.snapshots = 0
+        # ms from dropping the connection to being caught up again, and how many of those needed a snapshot
+        self.reconnect_ms: List[float] = []
+        self.reloads = 0
+        self.error: Optional[str] = None
+        self._epoch: Optional[str] = None
+        self._seq: Optional[int] = None
+        # (rtt, offset) in ms, offset being the server's clock minus ours
+        self._clock_samples: List[Tuple[float, float]] = []
+        self.clock_offset: Optional[float] = None
+        self._clock_known = asyncio.Event()
+        # (at, time.monotonic() it was applied)
+        self.applied: List[Tuple[int, float]] = []
+        self._scheduled: List[asyncio.Task] = []
+        # a phase resync can come round again in a snapshot, it's still the one change
+        self._scheduled_at = set()
+
+    def Now(self) -> float:
+        # this screen's own clock, in ms like performance.now()
+        return (time.monotonic() + self.clock_skew) * 1000
+
+    def ClockError(self) -> Optional[float]:
+        # the server's clock is the real time.monotonic(), so the true offset is just our skew backwards
+        if self.clock_offset is None:
+            return None
+        return abs(self.clock_offset + self.clock_skew * 1000)
+
+    async def Run(self, url: str, ack: bool, drop_times: List[float] = ()):
+        """
+        Args:
+            drop_times (optional): time.monotonic()s to drop the connection at and resume
+        """
+        drop_times = sorted(drop_times)
+        dropped_at = None
+        try:
+            while True:
+                connect_url = url
+                if dropped_at is not None and self._epoch is not None:
+                    connect_url = '{}?epoch={}&seq={}'.format(url, self._epoch, self._seq)
+                async with websockets.connect(connect_url, max_size=None) as websocket:
+                    if dropped_at is None:
+                        self.connected.set()
+                    else:
+                        # nothing comes back if nothing was missed, so caught up is the replay or the open
+                        self.reconnect_ms.append((time.monotonic() - dropped_at) * 1000)
+                    drop_at = drop_times.pop(0) if len(drop_times) > 0 else None
+                    clock = asyncio.create_task(self._SyncClock(websocket)) if self.sync else None
+                    try:
+                        await self._Receive(websocket, ack, drop_at, resumed=dropped_at is not None)
+                    finally:
+                        if clock is not None:
+                            clock.cancel()
+                    if drop_at is None:
+                        return
+                    dropped_at = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = repr(e)
+            self.connected.set()
+        finally:
+            for task in self._scheduled:
+                task.cancel()
+
+    async def _SyncClock(self, websocket):
+        for i in range(CLOCK_BURST):
+            await websocket.send(json.dumps({'message': 'CLOCK', 'sent': self.Now()}))
+            await asyncio.sleep(CLOCK_BURST_SPACING)
+        while True:
+            await asyncio.sleep(CLOCK_INTERVAL)
+            await websocket.send(json.dumps({'message': 'CLOCK', 'sent': self.Now()}))
+
+    def _HandleClock(self, message: Dict[str, Any], received: float):
+        sent, server = message['sent'], message['server']
+        self._clock_samples = (self._clock_samples + [(received - sent, server - (sent + received) / 2)])[
+            -CLOCK_SAMPLES:
+        ]
+        self.clock_offset = min(self._clock_samples)[1]
+        self._clock_known.set()
+
+    async def _ApplyAt(self, websocket, at: int):
+        # what RunAt in index.js does, on our own clock
+        await self._clock_known.wait()
+        await asyncio.sleep(max((at - self.clock_offset - self.Now()) / 1000, 0))
+        self.applied.append((at, time.monotonic()))
+        try:
+            await websocket.send(json.dumps({
+                'message': 'APPLIED', 'at': at, 'shown': self.Now() + self.clock_offset
+            }))
+        except websockets.ConnectionClosed:
+            # dropped in the meantime, the server just misses this report
+            pass
+
+    async def _Receive(self, websocket, ack: bool, drop_at: Optional[float], resumed: bool):
+        while True:
+            if drop_at is None:
+                text = await websocket.recv()
+            else:
+                try:
+                    text = await asyncio.wait_for(websocket.recv(), max(drop_at - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    return
+            arrived = time.monotonic()
+            self.messages += 1
+            message = json.loads(text)
+            if message.get('message') == 'CLOCK':
+                self._HandleClock(message, self.Now())
+                continue
+            if self.sync and message.get('at') is not None and message['at'] not in self._scheduled_at:
+                self._scheduled_at.add(message['at'])
+                self._scheduled.append(asyncio.create_task(self._ApplyAt(websocket, message['at'])))
+            if message.get('message') in SNAPSHOT_MESSAGES:
+                self.snapshots += 1
+                if resumed:
+                    self.reloads += 1
+            resumed = False
+            if message.get('epoch') is not None:
+                self._epoch = message['epoch']
+            if message.get('seq') is not None:
+                self._seq = message['seq']
+            event_id = message.get('id')
+            if event_id is None:
+                continue
+            self.received.append((event_id, arrived))
+            if ack:
+                # no paint to wait for, so received and rendered are the same moment
+                await websocket.send(json.dumps({
+                    'message': 'ACK', 'id': event_id, 'received': arrived * 1000, 'rendered': arrived * 1000
+                }))
+
+
+async def drive_buttons(stdin: asyncio.StreamWriter, toggle_rate: float, power_rate: float,
+                        duration: float) -> List[float]:
+    """
+    Press the buttons at the given rates for duration seconds.
+
+    Returns:
+        the input time of every edge that makes the server broadcast, in order. The server numbers its events from
+        1 in the order it reads them, so event id n went in at input_times[n - 1].
+    """
+    input_times = []
+    start = time.monotonic()
+    next_toggle = start if toggle_rate > 0 else float('inf')
+    next_power = start + 0.5 / power_rate if power_rate > 0 else float('inf')
+    power_off = False
+    while True:
+        due = min(next_toggle, next_power)
+        if due - start >= duration:
+            break
+        await asyncio.sleep(max(due - time.monotonic(), 0))
+        now = time.monotonic()
+        if due == next_toggle:
+            # a press and its release, only the press broadcasts
+            stdin.write('TOGGLE_PUSHED {0}\nTOGGLE_RELEASED {0}\n'.format(now).encode())
+            next_toggle += 1 / toggle_rate
+        else:
+            # every power edge broadcasts, off on the press and back on with the release
+            stdin.write('{} {}\n'.format('POWER_RELEASED' if power_off else 'POWER_PUSHED', now).encode())
+            power_off = not power_off
+            next_power += 1 / power_rate
+        input_times.append(now)
+        await stdin.drain()
+    return input_times
+
+
+def summarize_sync(screens: List[SimulatedScreen], server_metrics: Dict[str, float]) -> Dict[str, Any]:
+    applied: Dict[int, List[float]] = {}
+    sync_errors = []
+    for screen in screens:
+        for at, applied_time in screen.applied:
+            applied.setdefault(at, []).append(applied_time)
+            sync_errors.append(abs(applied_time - at / 1000) * 1000)
+    # the server only counts screens that reported, we count every screen that got the change
+    skews = [(max(times) - min(times)) * 1000 for times in applied.values() if len(times) > 1]
+    clock_errors = [screen.ClockError() for screen in screens if screen.ClockError() is not None]
+
+    def mean_ms(name):
+        count = server_metrics.get(name + '_count', 0)
+        return server_metrics[name + '_sum'] / count * 1000 if count > 0 else None
+
+    return {
+        'scheduled_changes': len(applied),
+        'skew_ms': percentiles(skews),
+        'sync_error_ms': percentiles(sync_errors),
+        'clock_error_ms': percentiles(clock_errors),
+        'server_skew_mean_ms': mean_ms('sparky_screen_skew_seconds'),
+        'server_skews': int(server_metrics.get('sparky_screen_skew_seconds_count', 0)),
+        'server_sync_error_mean_ms': mean_ms('sparky_sync_error_seconds'),
+    }
+
+
+def read_server_metrics(port: int) -> Dict[str, float]:
+    # only the unlabelled lines, that's all summarize_sync wants
+    with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=5) as response:
+        text = response.read().decode()
+    values = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and not line.startswith('#') and '{' not in fields[0]:
+            values[fields[0]] = float(fields[1])
+    return values
+
+
+def summarize(screens: List[SimulatedScreen], input_times: List[float]) -> Dict[str, Any]:
+    latencies = []
+    lost = 0
+    out_of_order = 0
+    duplicates = 0
+    for screen in screens:
+        seen = set()
+        last_id = 0
+        for event_id, arrived in screen.received:
+            if event_id in seen:
+                duplicates += 1
+                continue
+            seen.add(event_id)
+            if event_id < last_id:
+                out_of_order += 1
+            last_id = max(last_id, event_id)
+            if 0 < event_id <= len(input_times):
+                latencies.append((arrived - input_times[event_id - 1]) * 1000)
+        lost += len(set(range(1, len(input_times) + 1)) - seen)
+    expected = len(input_times) * len(screens)
+    return {
+        'events': len(input_times),
+        'expected_deliveries': expected,
+        'delivered': len(latencies),
+        'lost': lost,
+        'loss_ratio': lost / expected if expected else 0.0,
+        'out_of_order': out_of_order,
+        'duplicates': duplicates,
+        'resyncs': sum(max(screen.snapshots - 1 - screen.reloads, 0) for screen in screens),
+        'latency_ms': percentiles(latencies),
+        'reconnects': sum(len(screen.reconnect_ms) for screen in screens),
+        'reloads': sum(screen.reloads for screen in screens),
+        'reconnect_ms': percentiles([ms for screen in screens for ms in screen.reconnect_ms]),
+        'client_errors': [screen.error for screen in screens if screen.error is not None],
+    }
+
+
+async def run(clients: int, toggle_rate: float, power_rate: float, duration: float,
+              ack: bool = True, drops: int = 0, sync: bool = False) -> Dict[str, Any]:
+    port = free_port()
+    env = {**os.environ, 'SPARKY_HEADLESS': '1'}
+    if sync:
+        env['SPARKY_SYNC'] = '1'
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+        '--log-level', 'warning',
+        cwd=SERVER_PATH, env=env, stdin=asyncio.subprocess.PIPE
+    )
+    tasks = []
+    server_metrics = {}
+    try:
+        await wait_for_port(port)
+        skews = random.Random(1)
+        screens = [
+            SimulatedScreen(i, skews.uniform(-MAX_CLOCK_SKEW, MAX_CLOCK_SKEW) if sync else 0.0, sync)
+            for i in range(clients)
+        ]
+        url = 'ws://127.0.0.1:{}/ws'.format(port)
+        # the drops land somewhere in the button presses, seeded so runs can be compared
+        rng = random.Random(0)
+        start = time.monotonic() + 0.5
+        tasks = [
+            asyncio.create_task(screen.Run(url, ack, [start + rng.uniform(0, duration) for _ in range(drops)]))
+            for screen in screens
+        ]
+        await asyncio.gather(*[screen.connected.wait() for screen in screens])
+        # let the connect snapshots go out before the clock starts
+        await asyncio.sleep(max(start - time.monotonic(), 0))
+
+        cpu_start = process_cpu_seconds(server.pid)
+        wall_start = time.monotonic()
+        input_times = await drive_buttons(server.stdin, toggle_rate, power_rate, duration)
+        await asyncio.sleep(DRAIN_SECONDS)
+        cpu_seconds = process_cpu_seconds(server.pid) - cpu_start
+        wall_seconds = time.monotonic() - wall_start
+        memory = process_memory(server.pid)
+        if sync:
+            server_metrics = await asyncio.get_running_loop().run_in_executor(None, read_server_metrics, port)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        server.terminate()
+        await server.wait()
+
+    results = summarize(screens, input_times)
+    if sync:
+        results.update(summarize_sync(screens, server_metrics))
+    results.update({
+        'clients': clients,
+        'toggle_rate': toggle_rate,
+        'power_rate': power_rate,
+        'duration': duration,
+        'drops': drops,
+        'sync': sync,
+        'server_cpu_seconds': cpu_seconds,
+        'server_cpu_percent': 100 * cpu_seconds / wall_seconds,
+        'server_rss': memory.get('VmRSS'),
+        'server_peak_rss': memory.get('VmHWM'),
+    })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10, help='simulated screens')
+    parser.add_argument('--toggle-rate', type=float, default=2.0, help='toggle presses per second')
+    parser.add_argument('--power-rate', type=float, default=0.5, help='power edges per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of button presses')
+    parser.add_argument('--drops', type=int, default=0, help='times every screen drops its connection and resumes')
+    parser.add_argument('--sync', action='store_true', help='run the server in sync mode, see above')
+    parser.add_argument('--no-ack', action='store_true', help="don't ack events like the browser does")
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(
+        args.clients, args.toggle_rate, args.power_rate, args.duration, not args.no_ack, args.drops, args.sync
+    ))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    latency = results['latency_ms']
+    print('{clients} screens, {events} events: {delivered}/{expected_deliveries} delivered, {lost} lost, '
+          '{out_of_order} out of order, {duplicates} duplicated, {resyncs} resyncs'.format(**results))
+    if latency['p50'] is not None:
+        print('latency ms: p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} max {max:.2f}'.format(**latency))
+    if results['reconnects'] > 0:
+        print('{} reconnects, {} needed a snapshot, ms: p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} max {max:.2f}'.format(
+            results['reconnects'], results['reloads'], **results['reconnect_ms']
+        ))
+    if results['sync'] and results['skew_ms']['p50'] is not None:
+        print('{} scheduled changes, skew between screens ms: p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} '
+              'max {max:.2f}'.format(results['scheduled_changes'], **results['skew_ms']))
+        print('off the scheduled time ms: p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} max {max:.2f}'.format(
+            **results['sync_error_ms']
+        ))
+        print('clock estimate error ms: p50 {p50:.3f} max {max:.3f}'.format(**results['clock_error_ms']))
+        if results['server_skew_mean_ms'] is not None:
+            print('server saw: mean skew {:.2f} ms over {} changes, mean off the scheduled time {:.2f} ms'.format(
+                results['server_skew_mean_ms'], results['server_skews'], results['server_sync_error_mean_ms']
+            ))
+    print('server: {:.1f}% cpu, {:.1f} MB rss, {:.1f} MB peak'.format(
+        results['server_cpu_percent'], (results['server_rss'] or 0) / (1024 * 1024),
+        (results['server_peak_rss'] or 0) / (1024 * 1024)
+    ))
+    for error in results['client_errors']:
+        print('client error: ' + error)
+
+
+if __name__ == '__main__':
+    main()
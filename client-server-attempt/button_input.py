@@ -0,0 +1,176 @@
+import sys
+import time
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from enum import Enum, unique
+from typing import Callable, Dict, NamedTuple, Optional
+
+# contacts chatter for a few ms either side of a real edge, anything inside this after an accepted edge is bounce
+DEBOUNCE_SECONDS = 0.02
+
+
+@unique
+class Buttons(Enum):
+    TOGGLE = 'TOGGLE'
+    POWER = 'POWER'
+
+
+class ButtonEvent(NamedTuple):
+    button: Buttons
+    pressed: bool
+    # time.monotonic() on the thread that saw the edge, as close to the hardware as we get
+    input_time: float
+
+
+# what a source calls from its own thread for every edge, input_time is stamped there if not given
+Emit = Callable[[Buttons, bool, Optional[float]], None]
+
+
+class InputSource(ABC):
+    """
+    Somewhere button edges come from. Start hooks it up to call emit for every edge, from whatever thread it likes.
+    """
+
+    @abstractmethod
+    def Start(self, emit: Emit):
+        pass
+
+    def InitialState(self) -> Dict[Buttons, bool]:
+        # buttons that are already held down when we start, e.g. the power switch
+        return {}
+
+
+class GpioButtons(InputSource):
+
+    def __init__(self, toggle_pin: int, power_pin: int):
+        self.pins = {Buttons.TOGGLE: toggle_pin, Buttons.POWER: power_pin}
+        self.buttons = {}
+
+    def Start(self, emit: Emit):
+        # only the pi has it, and it's slow to import
+        from gpiozero import Button
+        for name, pin in self.pins.items():
+            # no bounce_time, ButtonInput does the debouncing for every source
+            button = self.buttons[name] = Button(pin)
+            button.when_pressed = lambda name=name: emit(name, True, None)
+            button.when_released = lambda name=name: emit(name, False, None)
+
+    def InitialState(self) -> Dict[Buttons, bool]:
+        return {name: button.is_pressed for name, button in self.buttons.items()}
+
+
+class KeyboardButtons(InputSource):
+    """
+    Space is power, right arrow is toggle.
+    """
+
+    def __init__(self):
+        self.listener = None
+
+    def Start(self, emit: Emit):
+        from pynput import keyboard
+        keys = {keyboard.Key.space: Buttons.POWER, keyboard.Key.right: Buttons.TOGGLE}
+
+        def on_key(pressed, key):
+            name = keys.get(key)
+            if name is not None:
+                emit(name, pressed, None)
+
+        self.listener = keyboard.Listener(
+            on_press=lambda key: on_key(True, key),
+            on_release=lambda key: on_key(False, key)
+        )
+        self.listener.start()
+
+
+class StdinButtons(InputSource):
+    """
+    Fake buttons for running headless, see benchmarks/ws_load.py. One edge per line, "TOGGLE_PUSHED 1234.5", the
+    time is the sender's time.monotonic() when it pressed.
+    """
+
+    EDGES = {
+        'TOGGLE_PUSHED': (Buttons.TOGGLE, True),
+        'TOGGLE_RELEASED': (Buttons.TOGGLE, False),
+        'POWER_PUSHED': (Buttons.POWER, True),
+        'POWER_RELEASED': (Buttons.POWER, False),
+    }
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdin
+
+    def Start(self, emit: Emit):
+        threading.Thread(target=self._Read, args=(emit,), daemon=True).start()
+
+    def _Read(self, emit: Emit):
+        for line in self.stream:
+            fields = line.split()
+            if len(fields) == 0 or fields[0] not in self.EDGES:
+                continue
+            name, pressed = self.EDGES[fields[0]]
+            emit(name, pressed, float(fields[1]) if len(fields) > 1 else None)
+
+
+class ButtonInput:
+    """
+    The one way in for button edges, whichever source they come from.
+
+    Sources call Emit on their own thread, which stamps the edge and hands it to the event loop with a single
+    call_soon_threadsafe, no queue and no proxy task in between. On the loop, debouncing happens here and only
+    here: an edge that changes a button's state goes out straight away, then the button is left alone for
+    DEBOUNCE_SECONDS and whatever it settled on by then goes out too if it's different. Edges that don't change
+    the state (key autorepeat, a press we already saw) never go out.
+    """
+
+    def __init__(self, on_event: Callable[[ButtonEvent], None], debounce: float = DEBOUNCE_SECONDS):
+        self.on_event = on_event
+        self.debounce = debounce
+        # edges handed to the loop, and edges it has looked at. Every source thread emits, handled is only the loop's
+        self.emitted = 0
+        self.handled = 0
+        self._emitted_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._state: Dict[Buttons, bool] = {}
+        # latest edge per button while it's settling
+        self._latest: Dict[Buttons, ButtonEvent] = {}
+        self._settling: Dict[Buttons, asyncio.TimerHandle] = {}
+
+    def Start(self, source: InputSource):
+        self._loop = asyncio.get_running_loop()
+        source.Start(self.Emit)
+        self._state.update(source.InitialState())
+
+    @property
+    def pending(self) -> int:
+        return self.emitted - self.handled
+
+    def IsPressed(self, button: Buttons) -> bool:
+        return self._state.get(button, False)
+
+    def Emit(self, button: Buttons, pressed: bool, input_time: Optional[float] = None):
+        if input_time is None:
+            input_time = time.monotonic()
+        with self._emitted_lock:
+            self.emitted += 1
+        self._loop.call_soon_threadsafe(self._Handle, ButtonEvent(button, pressed, input_time))
+
+    def _Handle(self, event: ButtonEvent):
+        self.handled += 1
+        self._latest[event.button] = event
+        if event.button in self._settling:
+            return
+        self._Accept(event)
+
+    def _Accept(self, event: ButtonEvent):
+        if self._state.get(event.button, False) == event.pressed:
+            return
+        self._state[event.button] = event.pressed
+        self._settling[event.button] = self._loop.call_later(
+            max(event.input_time + self.debounce - time.monotonic(), 0), self._Settle, event.button
+        )
+        self.on_event(event)
+
+    def _Settle(self, button: Buttons):
+        del self._settling[button]
+        self._Accept(self._latest[button])
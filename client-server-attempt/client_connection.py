@@ -0,0 +1,109 @@
+import json
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from starlette.websockets import WebSocket
+
+from metrics import Metrics
+from resize_gifs import SCREEN_SIZE
+
+# a client more than this many messages behind is slow, it gets resynced instead of queueing more
+SEND_QUEUE_SIZE = 16
+# one send stalling this long means the client is wedged
+SEND_TIMEOUT = 2.0
+# resyncs in a row without ever catching up before we give up on the client
+MAX_RESYNCS = 3
+
+
+def encode_message(message: Dict[str, Any]) -> str:
+    # same encoding as starlette's send_json, done once per broadcast instead of once per client
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+
+
+class ClientConnection:
+    """
+    One websocket plus its own bounded send queue and sender task, so a stalled client only ever holds itself up.
+
+    Slow consumer policy: when the queue fills up, everything queued is dropped and replaced with a snapshot of
+    the latest state. A client that needs more than MAX_RESYNCS of those in a row, or has a single send stall
+    for SEND_TIMEOUT, gets disconnected.
+    """
+
+    def __init__(self, websocket: WebSocket, snapshot: Callable[['ClientConnection'], List[str]],
+                 on_close: Callable[['ClientConnection'], None], rendition_size: Tuple[int, int] = SCREEN_SIZE):
+        """
+        Args:
+            snapshot: called with the connection, so the snapshot can be at its rendition size
+            rendition_size (optional): size of the gif renditions this client gets sent
+        """
+        self.websocket = websocket
+        self.rendition_size = rendition_size
+        self.closed = False
+        self._snapshot = snapshot
+        self._on_close = on_close
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self._resyncs = 0
+        self._sender: Optional[asyncio.Task] = asyncio.create_task(self._Send())
+
+    def Push(self, text: str, event_id: Optional[int] = None):
+        """
+        Args:
+            event_id (optional): Metrics input event this message carries, so the send gets timed
+        """
+        if self.closed:
+            return
+        try:
+            self._queue.put_nowait((text, event_id))
+        except asyncio.QueueFull:
+            self._Resync()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def PushSnapshot(self):
+        for text in self._snapshot(self):
+            self.Push(text)
+
+    def Close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._sender is not None and self._sender is not asyncio.current_task():
+            self._sender.cancel()
+        self._sender = None
+        asyncio.create_task(self._Close())
+        self._on_close(self)
+
+    async def _Close(self):
+        try:
+            await self.websocket.close()
+        except Exception:
+            # already gone, nothing to tell it
+            pass
+
+    def _Resync(self):
+        self._resyncs += 1
+        if self._resyncs > MAX_RESYNCS:
+            print('Dropping slow client {}'.format(self.websocket.client))
+            self.Close()
+            return
+        # everything queued is stale by now, the latest state supersedes it
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        for text in self._snapshot(self):
+            self._queue.put_nowait((text, None))
+
+    async def _Send(self):
+        try:
+            while True:
+                text, event_id = await self._queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), SEND_TIMEOUT)
+                if event_id is not None:
+                    Metrics.EventSent(event_id, self)
+                if self._queue.empty():
+                    self._resyncs = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.Close()
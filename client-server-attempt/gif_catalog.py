@@ -0,0 +1,295 @@
+import os
+import time
+import asyncio
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from gif_stream import loop_duration, read_canvas_size
+from resize_gifs import GIF_PATH, IS_GIF, RESAMPLE, WEBP_ENABLED, exceeds, pick_rendition_size, size_name
+from rendition_cache import remove_stale_partials
+from resize_worker import ResizeWorker
+
+# copying a big gif in fires a modified event per write, wait for the folder to go quiet
+QUIET_WINDOW = 0.5
+# every gif ends with this byte, one without it is still being copied in
+GIF_TRAILER = b'\x3b'
+# ...unless nothing has written to it for this long, then it's as whole as it's going to get
+INCOMPLETE_GRACE = 10.0
+
+# better formats than gif that get offered when a rendition exists in them, best first, as (extension, mime type)
+PREFERRED_FORMATS = (('webp', 'image/webp'),) if WEBP_ENABLED else ()
+
+
+class GifsDelta:
+
+    def __init__(self):
+        self.added: List[Dict[str, Any]] = []
+        self.removed: List[str] = []
+        # (old entry, new entry)
+        self.changed: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+
+    def __bool__(self):
+        return len(self.added) > 0 or len(self.removed) > 0 or len(self.changed) > 0
+
+    def to_message(self, size: Tuple[int, int]) -> Dict[str, List]:
+        """
+        Returns:
+            the delta as a client wanting renditions at size sees it, a new size it doesn't use isn't a change
+        """
+        changed = []
+        for old_entry, new_entry in self.changed:
+            rendered = GifCatalog.RenderEntry(new_entry, size)
+            if rendered != GifCatalog.RenderEntry(old_entry, size):
+                changed.append(rendered)
+        return {
+            'added': [GifCatalog.RenderEntry(entry, size) for entry in self.added],
+            'removed': self.removed,
+            'changed': changed,
+        }
+
+
+class GifCatalog:
+    """
+    In memory view of the gif folder, in the order clients show them, plus which one is on screen.
+
+    Each entry is {'name', 'original', 'renditions', 'loop', 'size'}: original is the gif as it is in the folder,
+    size is its canvas size (None if it isn't readable), renditions has one per size ResizeWorker made it at, keyed
+    by size_name, none of them bigger than the original. Both are {'url', 'sources'}: url is always a gif, sources
+    are the same animation in better formats ({'url', 'type'}, best first) for clients that can play them. Clients
+    only ever see one of them, RenderEntry picks it for the client's size. loop is how many ms one loop of the
+    animation takes in a browser, for lining screens up on it, clients don't get sent it or size.
+
+    Watchdog events only mark names dirty, they get synced once the folder has been quiet for QUIET_WINDOW. A gif
+    that is still missing its trailer by then is looked at again later, so a slow copy doesn't get resized (and
+    handed to clients) half written.
+    Entries change when ResizeWorker says a gif is ready, and every change goes out as a delta.
+    """
+
+    entries: Dict[str, Dict[str, Any]] = {}
+    current: Optional[str] = None
+    # set once there's a gif to show, or every gif that was there at startup turned out not to be one
+    ready: Optional[asyncio.Event] = None
+
+    _dirty: Set[str] = set()
+    _flush_handle: Optional[asyncio.TimerHandle] = None
+    _ready: Set[str] = set()
+    _on_change: Optional[Callable[[GifsDelta], None]] = None
+    # gifs from the startup listing that haven't been through _Refresh yet
+    _waiting: Set[str] = set()
+
+    @classmethod
+    async def Startup(cls, on_change: Callable[[GifsDelta], None]):
+        cls._on_change = on_change
+        cls.ready = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        # an in place resize that died mid write leaves its partial next to the gif
+        for partial_path in await loop.run_in_executor(None, remove_stale_partials, GIF_PATH):
+            print('Removed {}, left over from a resize that never finished'.format(partial_path))
+        gif_names = await loop.run_in_executor(None, cls._ListGifs)
+        cls._waiting = set(gif_names)
+        for gif_name in gif_names:
+            ResizeWorker.Submit(gif_name)
+        cls._CheckReady()
+
+    @classmethod
+    def Touch(cls, gif_name: str):
+        cls._dirty.add(gif_name)
+        if cls._flush_handle is not None:
+            cls._flush_handle.cancel()
+        cls._flush_handle = asyncio.get_running_loop().call_later(QUIET_WINDOW, cls._Flush)
+
+    @classmethod
+    def OnReady(cls, gif_name: str):
+        # a burst of finished jobs goes out as one delta
+        if len(cls._ready) == 0:
+            asyncio.get_running_loop().call_soon(cls._FlushReady)
+        cls._ready.add(gif_name)
+
+    @classmethod
+    def StepCurrent(cls) -> Optional[str]:
+        if cls.current is None:
+            return None
+        gif_names = list(cls.entries)
+        cls.current = gif_names[(gif_names.index(cls.current) + 1) % len(gif_names)]
+        return cls.current
+
+    @staticmethod
+    def RenderEntry(gif_entry: Dict[str, Any], size: Tuple[int, int]) -> Dict[str, Any]:
+        """
+        Returns:
+            {'name', 'url', 'sources'} at size, or the nearest size there is a rendition at, or the original if
+            size is bigger than it
+        """
+        renditions = gif_entry['renditions']
+        variant = renditions.get(size_name(size))
+        source_size = gif_entry['size']
+        if variant is None and source_size is not None and exceeds(size, source_size):
+            # there's no rendition bigger than the source, the biggest one there is would be a downgrade
+            variant = gif_entry['original']
+        if variant is None and len(renditions) > 0:
+            sizes = [tuple(int(n) for n in name.split('x')) for name in renditions]
+            variant = renditions[size_name(pick_rendition_size(size, sizes))]
+        if variant is None:
+            variant = gif_entry['original']
+        return {'name': gif_entry['name'], **variant}
+
+    @classmethod
+    def RenditionPaths(cls) -> List[str]:
+        """
+        Returns:
+            the path in the rendition cache of every rendition some entry points clients at, in every format
+        """
+        paths = []
+        for gif_entry in cls.entries.values():
+            for variant in gif_entry['renditions'].values():
+                for url in [variant['url']] + [source['url'] for source in variant['sources']]:
+                    paths.append(os.path.join(ResizeWorker.cache.cache_path, os.path.basename(url)))
+        return paths
+
+    @classmethod
+    def Render(cls, size: Tuple[int, int]) -> List[Dict[str, Any]]:
+        return [cls.RenderEntry(gif_entry, size) for gif_entry in cls.entries.values()]
+
+    @staticmethod
+    def _ListGifs() -> List[str]:
+        return sorted(
+            f for f in os.listdir(GIF_PATH)
+            if os.path.isfile(os.path.join(GIF_PATH, f))
+            and IS_GIF.match(f)
+        )
+
+    @staticmethod
+    def _IsComplete(path: str) -> bool:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) == GIF_TRAILER:
+                    return True
+        return time.time() - stat.st_mtime >= INCOMPLETE_GRACE
+
+    @classmethod
+    def _ExistingGifs(cls, gif_names: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+        """
+        Returns:
+            (gifs that are there and whole, gifs that are there but still being written)
+        """
+        existing = set()
+        incomplete = set()
+        for gif_name in gif_names:
+            try:
+                if cls._IsComplete(os.path.join(GIF_PATH, gif_name)):
+                    existing.add(gif_name)
+                else:
+                    incomplete.add(gif_name)
+            except (FileNotFoundError, IsADirectoryError):
+                continue
+        return existing, incomplete
+
+    @staticmethod
+    def _GifEntry(gif_name: str) -> Optional[Dict[str, Any]]:
+        path = os.path.join(GIF_PATH, gif_name)
+        if not os.path.isfile(path):
+            return None
+        # renditions are named by their hash already, the original gets it as a version so it can be cached
+        url = '{}?v={}'.format(os.path.join('gifs', gif_name), ResizeWorker.cache.source_hash(path))
+        try:
+            source_size = read_canvas_size(path)
+            loop = loop_duration(path)
+        except ValueError:
+            # not really a gif, nothing to line up
+            source_size, loop = None, 0
+        renditions = {}
+        for size in list(ResizeWorker.sizes):
+            # one made bigger than the source before they stopped being made is still in the cache, leave it be
+            if source_size is not None and exceeds(size, source_size):
+                continue
+            # a size whose resize failed is left out, clients wanting it get the nearest one instead
+            rendition_path = ResizeWorker.cache.lookup(path, size, RESAMPLE)
+            if rendition_path is None:
+                continue
+            sources = []
+            for extension, mime_type in PREFERRED_FORMATS:
+                source_path = ResizeWorker.cache.lookup(path, size, RESAMPLE, extension=extension)
+                if source_path is not None:
+                    sources.append({
+                        'url': os.path.join('renditions', os.path.basename(source_path)), 'type': mime_type
+                    })
+            renditions[size_name(size)] = {
+                'url': os.path.join('renditions', os.path.basename(rendition_path)),
+                'sources': sources,
+            }
+        return {
+            'name': gif_name, 'original': {'url': url, 'sources': []}, 'renditions': renditions, 'loop': loop,
+            'size': source_size,
+        }
+
+    @classmethod
+    def _Flush(cls):
+        cls._flush_handle = None
+        gif_names, cls._dirty = cls._dirty, set()
+        asyncio.create_task(cls._Sync(gif_names))
+
+    @classmethod
+    async def _Sync(cls, gif_names: Set[str]):
+        loop = asyncio.get_running_loop()
+        existing, incomplete = await loop.run_in_executor(None, cls._ExistingGifs, gif_names)
+        for gif_name in gif_names:
+            if gif_name in existing:
+                ResizeWorker.Submit(gif_name)
+            elif gif_name in incomplete:
+                # a copy that stalls stops firing events, so keep looking until it's whole or INCOMPLETE_GRACE is up
+                loop.call_later(QUIET_WINDOW, cls.Touch, gif_name)
+            else:
+                ResizeWorker.Cancel(gif_name)
+
+    @classmethod
+    def _FlushReady(cls):
+        gif_names, cls._ready = cls._ready, set()
+        asyncio.create_task(cls._Refresh(gif_names))
+
+    @classmethod
+    async def _Refresh(cls, gif_names: Set[str]):
+        loop = asyncio.get_running_loop()
+        gif_entries = await loop.run_in_executor(None, lambda: {name: cls._GifEntry(name) for name in gif_names})
+        await loop.run_in_executor(None, ResizeWorker.cache.save)
+
+        delta = GifsDelta()
+        for gif_name in sorted(gif_names):
+            # it got queued again while we were looking, it'll be back
+            if ResizeWorker.IsPending(gif_name):
+                continue
+            gif_entry = gif_entries[gif_name]
+            old_entry = cls.entries.get(gif_name)
+            if gif_entry == old_entry:
+                continue
+            if gif_entry is None:
+                cls._Remove(gif_name)
+                delta.removed.append(gif_name)
+            elif old_entry is None:
+                cls.entries[gif_name] = gif_entry
+                if cls.current is None:
+                    cls.current = gif_name
+                delta.added.append(gif_entry)
+            else:
+                cls.entries[gif_name] = gif_entry
+                delta.changed.append((old_entry, gif_entry))
+
+        cls._waiting -= {gif_name for gif_name in gif_names if not ResizeWorker.IsPending(gif_name)}
+        cls._CheckReady()
+        if delta:
+            cls._on_change(delta)
+
+    @classmethod
+    def _CheckReady(cls):
+        if not cls.ready.is_set() and (len(cls.entries) > 0 or len(cls._waiting) == 0):
+            cls.ready.set()
+
+    @classmethod
+    def _Remove(cls, gif_name: str):
+        # same rule as the client, if the gif on screen goes the next one takes its place
+        if cls.current == gif_name:
+            gif_names = list(cls.entries)
+            index = gif_names.index(gif_name)
+            remaining = gif_names[index + 1:] + gif_names[:index]
+            cls.current = remaining[0] if len(remaining) > 0 else None
+        del cls.entries[gif_name]
@@ -0,0 +1,60 @@
+import os
+import asyncio
+from pathlib import Path
+from typing import Callable
+
+from watchdog.observers import Observer
+from watchdog.events import PatternMatchingEventHandler
+
+from resize_gifs import GIF_PATH, IS_GIF
+
+
+class GifFolderWatcher:
+    """
+    Watches the gif folder from watchdog's thread, every gif that gets touched is handed to on_touch on the loop.
+
+    Lives in its own module so main.py only pays for importing watchdog once the server is starting up.
+    """
+
+    def __init__(self, on_touch: Callable[[str], None]):
+        Path(GIF_PATH).mkdir(parents=True, exist_ok=True)
+        self.on_touch = on_touch
+        self.observer = Observer()
+
+    def start(self):
+        event_handler = GifFolderHandler(asyncio.get_running_loop(), self.on_touch)
+        self.observer.schedule(event_handler, GIF_PATH, recursive=False)
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+class GifFolderHandler(PatternMatchingEventHandler):
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_touch: Callable[[str], None]):
+        # Set the patterns for PatternMatchingEventHandler
+        PatternMatchingEventHandler.__init__(self, patterns=['*.gif'], ignore_directories=True, case_sensitive=False)
+        # watchdog calls us from its own thread, everything has to hop back onto the server's loop
+        self.loop = loop
+        self.on_touch = on_touch
+
+    def _Touch(self, path: str):
+        self.loop.call_soon_threadsafe(self.on_touch, path)
+
+    def on_created(self, event):
+        self._Touch(event.src_path)
+
+    def on_modified(self, event):
+        self._Touch(event.src_path)
+
+    def on_deleted(self, event):
+        self._Touch(event.src_path)
+
+    def on_moved(self, event):
+        # a partial renamed over a gif only shows up here as its dest, the partial itself was never a gif
+        if IS_GIF.match(os.path.basename(event.src_path)):
+            self._Touch(event.src_path)
+        if IS_GIF.match(os.path.basename(event.dest_path)):
+            self._Touch(event.dest_path)
@@ -0,0 +1,320 @@
+import io
+import mmap
+import struct
+from typing import BinaryIO, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# GIF block markers
+EXTENSION_INTRODUCER = 0x21
+IMAGE_SEPARATOR = 0x2C
+TRAILER = 0x3B
+GRAPHIC_CONTROL_LABEL = 0xF9
+
+DISPOSAL_NONE = 1
+DISPOSAL_BACKGROUND = 2
+
+# the delay is 16 bits of hundredths of a second
+MAX_FRAME_DURATION = 0xFFFF * 10
+
+# browsers play a delay of 10ms or less as 100ms, plenty of old gifs rely on it
+BROWSER_MIN_FRAME_DURATION = 10
+BROWSER_FRAME_DURATION = 100
+
+# unchanged pixels only go transparent when at least this much of the changed box is unchanged, scattered
+# transparent pixels break up the LZW runs and cost more than they save
+DELTA_TRANSPARENCY_MIN_UNCHANGED = 0.75
+
+
+class FrameHeader(NamedTuple):
+    offset: Tuple[int, int]
+    size: Tuple[int, int]
+    disposal: int
+    duration: int
+    transparency: Optional[int]
+    local_palette: bool
+
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    while data[pos] != 0:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def read_frame_headers(path: str) -> Tuple[Tuple[int, int], List[FrameHeader]]:
+    """
+    Walk the GIF block structure without decoding any pixels, LZW data is skipped by sub-block length.
+
+    Returns:
+        (canvas size, header of every frame)
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:3] != b'GIF':
+            raise ValueError('{} is not a GIF'.format(path))
+        try:
+            canvas_size = struct.unpack_from('<HH', data, 6)
+            flags = data[10]
+        except (IndexError, struct.error):
+            raise ValueError('{} is cut off before its first frame'.format(path))
+        pos = 13
+        if flags & 0x80:
+            pos += 3 << ((flags & 0x07) + 1)
+
+        frames = []
+        disposal, duration, transparency = 0, 0, None
+        try:
+            while pos < len(data) and data[pos] != TRAILER:
+                block = data[pos]
+                if block == EXTENSION_INTRODUCER:
+                    if data[pos + 1] == GRAPHIC_CONTROL_LABEL:
+                        packed = data[pos + 3]
+                        disposal = (packed >> 2) & 0x07
+                        duration = struct.unpack_from('<H', data, pos + 4)[0] * 10
+                        transparency = data[pos + 6] if packed & 0x01 else None
+                    pos = _skip_sub_blocks(data, pos + 2)
+                elif block == IMAGE_SEPARATOR:
+                    x, y, width, height, local_flags = struct.unpack_from('<HHHHB', data, pos + 1)
+                    pos += 10
+                    if local_flags & 0x80:
+                        pos += 3 << ((local_flags & 0x07) + 1)
+                    frames.append(FrameHeader(
+                        (x, y), (width, height), disposal, duration, transparency, bool(local_flags & 0x80)
+                    ))
+                    disposal, duration, transparency = 0, 0, None
+                    # skip the lzw minimum code size, then the image data
+                    pos = _skip_sub_blocks(data, pos + 1)
+                else:
+                    # junk after the last frame, browsers stop here too
+                    break
+        except (IndexError, struct.error):
+            # truncated file, keep whatever frames we got to
+            pass
+    return canvas_size, frames
+
+
+def read_canvas_size(path: str) -> Tuple[int, int]:
+    """
+    Just the logical screen size, without walking the frames.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(10)
+    if header[:3] != b'GIF':
+        raise ValueError('{} is not a GIF'.format(path))
+    if len(header) < 10:
+        raise ValueError('{} is cut off before its first frame'.format(path))
+    return struct.unpack_from('<HH', header, 6)
+
+
+def loop_duration(path: str) -> int:
+    """
+    How long one loop of the gif takes to play in a browser, in ms.
+    """
+    _, frames = read_frame_headers(path)
+    return sum(
+        frame.duration if frame.duration > BROWSER_MIN_FRAME_DURATION else BROWSER_FRAME_DURATION
+        for frame in frames
+    )
+
+
+def _encode_frame(frame: Image.Image, transparency: Optional[int] = None) -> Tuple[bytes, Optional[int], bytes]:
+    """
+    Let PIL quantize and LZW encode a single frame, then pull the pieces back out of the file it wrote.
+
+    A P mode frame is taken as already indexed, PIL only LZW encodes it and leaves the indexes alone.
+
+    Args:
+        transparency (optional): transparent index of an already indexed frame
+
+    Returns:
+        (colour table, transparency index or None, min code size + lzw sub-blocks)
+    """
+    buffer = io.BytesIO()
+    # PIL interlaces anything taller than 16 rows unless told not to, and the descriptor we write says we don't
+    options = {'interlace': False}
+    if frame.mode == 'P':
+        if transparency is not None:
+            options['transparency'] = transparency
+        frame.save(buffer, format='GIF', optimize=False, **options)
+    else:
+        frame.save(buffer, format='GIF', optimize=True, **options)
+    data = buffer.getvalue()
+
+    flags = data[10]
+    pos = 13
+    colour_table = b''
+    if flags & 0x80:
+        table_size = 3 << ((flags & 0x07) + 1)
+        colour_table = data[pos:pos + table_size]
+        pos += table_size
+
+    transparency = None
+    while data[pos] == EXTENSION_INTRODUCER:
+        label = data[pos + 1]
+        if label == GRAPHIC_CONTROL_LABEL and data[pos + 3] & 0x01:
+            transparency = data[pos + 6]
+        pos = _skip_sub_blocks(data, pos + 2)
+
+    if data[pos] != IMAGE_SEPARATOR:
+        raise ValueError('PIL wrote a GIF without an image descriptor')
+    local_flags = data[pos + 9]
+    pos += 10
+    if local_flags & 0x80:
+        table_size = 3 << ((local_flags & 0x07) + 1)
+        colour_table = data[pos:pos + table_size]
+        pos += table_size
+
+    image_data_end = _skip_sub_blocks(data, pos + 1)
+    return colour_table, transparency, data[pos:image_data_end]
+
+
+class GifStreamWriter:
+    """
+    Writes an animated GIF one frame at a time, so a job never holds more than the frame it is encoding.
+
+    Given a global colour table, frames that are already indexed against it are written without a local one.
+    Otherwise every frame carries its own local colour table.
+    """
+
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], loop: int = 0, colour_table: Optional[bytes] = None):
+        """
+        Args:
+            colour_table (optional): 256 entry global colour table
+        """
+        self.fp = fp
+        self.size = size
+        self.frame_count = 0
+        self.colour_table = colour_table
+        screen_flags = 0
+        if colour_table:
+            screen_flags = 0x80 | 0x70 | ((len(colour_table) // 3).bit_length() - 2)
+        fp.write(b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], screen_flags, 0, 0))
+        if colour_table:
+            fp.write(colour_table)
+        # NETSCAPE2.0 looping extension
+        fp.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    def write_frame(self, frame: Image.Image, duration: int = 0, offset: Tuple[int, int] = (0, 0),
+                    disposal: Optional[int] = None, transparency: Optional[int] = None,
+                    colour_table: Optional[bytes] = None):
+        """
+        Args:
+            frame: RGBA frame to quantize, or a P mode frame already indexed against colour_table
+            transparency (optional): transparent index of a P mode frame
+            colour_table (optional): local colour table of a P mode frame, the global one is used if not set
+        """
+        encoded_table, transparency, image_data = _encode_frame(frame, transparency)
+        if frame.mode != 'P':
+            colour_table = encoded_table
+        elif colour_table is None and self.colour_table is None:
+            raise ValueError('an indexed frame needs a colour table')
+        if disposal is None:
+            disposal = DISPOSAL_BACKGROUND if transparency is not None else DISPOSAL_NONE
+
+        packed = (disposal << 2) | (1 if transparency is not None else 0)
+        self.fp.write(struct.pack(
+            '<BBBBHBB',
+            EXTENSION_INTRODUCER, GRAPHIC_CONTROL_LABEL, 4, packed,
+            int(duration // 10), transparency or 0, 0
+        ))
+
+        descriptor_flags = 0
+        if colour_table:
+            descriptor_flags = 0x80 | ((len(colour_table) // 3).bit_length() - 2)
+        self.fp.write(struct.pack(
+            '<BHHHHB', IMAGE_SEPARATOR, offset[0], offset[1], frame.size[0], frame.size[1], descriptor_flags
+        ))
+        if colour_table:
+            self.fp.write(colour_table)
+        self.fp.write(image_data)
+        self.frame_count += 1
+
+    def close(self):
+        self.fp.write(bytes([TRAILER]))
+
+
+class DeltaFrameWriter:
+    """
+    Sits in front of a GifStreamWriter and only writes what changed since the frame before.
+
+    Frames come in as whole canvases of palette indexes. Each one is cropped to the bounding box of the pixels that
+    differ from what's on screen, and the unchanged pixels inside the box are made transparent so they LZW down to
+    nothing. A frame identical to the one before just extends its duration.
+
+    A frame is held until the next one arrives, since its disposal depends on what comes after it: drawing on top
+    can't turn a pixel back to transparent, so if the next frame needs that the held frame goes out whole with
+    DISPOSAL_BACKGROUND and the next frame is drawn on a clear canvas.
+    """
+
+    def __init__(self, writer: GifStreamWriter, transparent_index: int):
+        self.writer = writer
+        self.transparent_index = transparent_index
+        # what's on screen once the held frame is drawn
+        self.canvas: Optional[np.ndarray] = None
+        self.canvas_table: Optional[bytes] = None
+        # [indexes, offset, duration]
+        self._held: Optional[list] = None
+
+    def write_frame(self, indexes: np.ndarray, duration: int = 0, colour_table: Optional[bytes] = None):
+        """
+        Args:
+            indexes: height x width palette indexes covering the whole canvas
+            colour_table (optional): the frame's local colour table, the global one is used if not set
+        """
+        transparent = self.transparent_index
+        if self.canvas is not None and colour_table == self.canvas_table:
+            changed = indexes != self.canvas
+            if not changed.any():
+                if self._held[2] + duration <= MAX_FRAME_DURATION:
+                    self._held[2] += duration
+                    return
+                # too long to fold in, a single transparent pixel carries the time
+                changed[0, 0] = True
+                indexes = self.canvas.copy()
+                indexes[0, 0] = transparent
+                clear = False
+            else:
+                clear = bool((indexes[changed] == transparent).any())
+        else:
+            # a new palette, the indexes on screen mean something else now
+            changed = None
+            clear = self.canvas is not None and bool((indexes == transparent).any())
+
+        self._Flush(clear)
+
+        if changed is None or clear:
+            held = [indexes, (0, 0), duration]
+        else:
+            rows = np.flatnonzero(changed.any(axis=1))
+            columns = np.flatnonzero(changed.any(axis=0))
+            y0, y1, x0, x1 = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+            crop = indexes[y0:y1, x0:x1]
+            unchanged = ~changed[y0:y1, x0:x1]
+            if unchanged.mean() >= DELTA_TRANSPARENCY_MIN_UNCHANGED:
+                crop = crop.copy()
+                crop[unchanged] = transparent
+            held = [crop, (int(x0), int(y0)), duration]
+        self._held = held
+        self.canvas = indexes
+        self.canvas_table = colour_table
+
+    def _Flush(self, clear: bool):
+        if self._held is None:
+            return
+        indexes, offset, duration = self._held
+        disposal = DISPOSAL_NONE
+        if clear:
+            indexes, offset, disposal = self.canvas, (0, 0), DISPOSAL_BACKGROUND
+        frame = Image.fromarray(indexes, 'P')
+        # any full table will do, it only makes PIL code every index in 8 bits
+        frame.putpalette(self.canvas_table or self.writer.colour_table)
+        transparency = self.transparent_index if (indexes == self.transparent_index).any() else None
+        self.writer.write_frame(
+            frame, duration=duration, offset=offset, disposal=disposal, transparency=transparency,
+            colour_table=self.canvas_table
+        )
+        self._held = None
+
+    def close(self):
+        self._Flush(False)
+        self.writer.close()
@@ -1,26 +1,30 @@
 
+import time
+# before anything else gets imported, so the boot timeline counts our imports too
+BOOT_START = time.monotonic()
+
 import os
 import subprocess
-from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from enum import Enum, unique
-import re
 
 import uvicorn
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, Request, WebSocket
 from starlette.endpoints import WebSocketEndpoint
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import PlainTextResponse
 import asyncio
+import json
 
-from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
-
-import janus
-from functools import partial
-from threading import Timer
-
-import pyautogui
+from button_input import ButtonEvent, ButtonInput, Buttons, GpioButtons, KeyboardButtons, StdinButtons
+from client_connection import ClientConnection, encode_message
+from gif_catalog import GifCatalog, GifsDelta
+from metrics import InputEvent, Metrics
+from playback_sync import PlaybackSync, server_time
+from resize_gifs import SCREEN_SIZE, pick_rendition_size
+from resize_worker import ResizeWorker
+from session_log import SessionLog
+from static_files import ContentHashedStaticFiles, HotAssetCache, MemoryFile
 
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -28,251 +32,322 @@ FRONTEND_PATH = os.path.join(DIR_PATH, 'vanilla-js-client')
 INDEX_PATH = os.path.join(FRONTEND_PATH, 'index.html')
 
 GIF_PATH = os.path.join(DIR_PATH, 'gifs')
-IS_GIF = re.compile('.+?.gif$', re.IGNORECASE)
 
 
 IS_PI = hasattr(os, 'uname') and os.uname()[4][:3] == 'arm'
+# no browser, and button edges come in on stdin instead of gpio / the keyboard (see benchmarks/ws_load.py)
+IS_HEADLESS = os.environ.get('SPARKY_HEADLESS') == '1'
+# several screens side by side as one wall, changes are scheduled so they all flip together (see PlaybackSync)
+SYNC_MODE = os.environ.get('SPARKY_SYNC') == '1'
 
 TOGGLE_BUTTON = 21
 POWER_BUTTON = 20
 
+PORT = 42069
+# a screen in a wall that isn't the one with the buttons points its browser at the one that is
+SCREEN_URL = os.environ.get('SPARKY_SCREEN_URL', 'http://localhost:{}'.format(PORT))
+# the browser goes up once the catalog has something to show, or after this long regardless
+BROWSER_READY_TIMEOUT = 60.0
+
 if IS_PI:
-    from gpiozero import Button
     chrome_path = '/usr/bin/chromium-browser'
 else:
-    from pynput import keyboard
     chrome_path = 'C:\Program Files (x86)\Google\Chrome\Application\chrome'
 
 
 class ButtonWatcher:
 
-    _toggle_flag = False
     power_off_flag = False
+    input: Optional[ButtonInput] = None
 
     @classmethod
     def Startup(cls):
-        if not IS_PI:
-            queue = janus.Queue()
-            bound_key_down = partial(cls._HandleKeydown, queue.sync_q)
-            bound_key_up = partial(cls._HandleKeyup, queue.sync_q)
-            listener = keyboard.Listener(
-                on_press=bound_key_down,
-                on_release=bound_key_up
-            )
-            listener.start()
-            asyncio.create_task(cls._ProxyKeys(queue.async_q))
+        # only the source this machine uses gets its backend imported, and only now the server is starting
+        if IS_HEADLESS:
+            source = StdinButtons()
+        elif IS_PI:
+            source = GpioButtons(TOGGLE_BUTTON, POWER_BUTTON)
         else:
-            queue = janus.Queue()
+            source = KeyboardButtons()
+        cls.input = ButtonInput(on_event=cls._HandleEvent)
+        cls.input.Start(source)
+        cls.power_off_flag = cls.input.IsPressed(Buttons.POWER)
 
-            cls.toggle_button = Button(TOGGLE_BUTTON)
-            bound_toggle_pressed = partial(cls._ToggleButtonPushed, queue.sync_q)
-            cls.toggle_button.when_pressed = bound_toggle_pressed
-            bound_toggle_released = partial(cls._ToggleButtonReleased, queue.sync_q)
-            cls.toggle_button.when_released = bound_toggle_released
+    @classmethod
+    def _HandleEvent(cls, event: ButtonEvent):
+        # already debounced, every event here is a real change of state
+        if event.button == Buttons.TOGGLE:
+            if event.pressed:
+                ConnectionManager.SendToggleGif(Metrics.StartEvent(MessageTypes.TOGGLE_GIF.value, event.input_time))
+        elif event.button == Buttons.POWER:
+            cls.power_off_flag = event.pressed
+            if event.pressed:
+                ConnectionManager.SendPowerOff(Metrics.StartEvent(MessageTypes.POWER_OFF.value, event.input_time))
+            else:
+                ConnectionManager.SendPowerOn(Metrics.StartEvent(MessageTypes.POWER_ON.value, event.input_time))
 
-            cls.power_button = Button(POWER_BUTTON)
-            if cls.power_button.is_pressed:
-                cls.power_off_flag = True
 
-            bound_power_pressed = partial(cls._PowerButtonPushed, queue.sync_q)
-            cls.power_button.when_pressed = bound_power_pressed
-            bound_power_released = partial(cls._PowerButtonReleased, queue.sync_q)
-            cls.power_button.when_released = bound_power_released
+@unique
+class MessageTypes(Enum):
+    POWER_ON = 'POWER_ON'
+    POWER_OFF = 'POWER_OFF'
+    TOGGLE_GIF = 'TOGGLE_GIF'
+    LOAD_GIFS = 'LOAD_GIFS'
+    GIFS_DELTA = 'GIFS_DELTA'
+    NO_GIFS = 'NO_GIFS'
+    CLOCK = 'CLOCK'
+    PHASE = 'PHASE'
 
-            asyncio.create_task(cls._ProxyButtons(queue.async_q))
 
-    @classmethod
-    def _HandleKeydown(cls, queue, key):
-        queue.put(('DOWN', key))
+@unique
+class ClientMessageTypes(Enum):
+    ACK = 'ACK'
+    VIEWPORT = 'VIEWPORT'
+    FIRST_FRAME = 'FIRST_FRAME'
+    CLOCK = 'CLOCK'
+    APPLIED = 'APPLIED'
 
-    @classmethod
-    def _HandleKeyup(cls, queue, key):
-        queue.put(('UP', key))
 
-    @classmethod
-    async def _ProxyKeys(cls, queue):
-        while True:
-            direction, key = await queue.get()
-            if direction == 'DOWN':
-                cls._DoHandleKeydown(key)
-            elif direction == 'UP':
-                cls._DoHandleKeyup(key)
+class ConnectionManager:
 
-    @classmethod
-    def _DoHandleKeydown(cls, key):
-        if key == keyboard.Key.space:
-            cls._DoPowerButtonPushed()
-        # right arrow, toggle
-        elif key == keyboard.Key.right:
-            cls._DoToggleButtonPushed()
+    active_connections: Dict[WebSocket, ClientConnection] = {}
+    # set when the first client connects, made in startup_event
+    first_client: Optional[asyncio.Event] = None
 
     @classmethod
-    def _DoHandleKeyup(cls, key):
-        if key == keyboard.Key.space:
-            cls._DoPowerButtonReleased()
-        # right arrow, toggle
-        elif key == keyboard.Key.right:
-            cls._DoToggleButtonReleased()
-
-    @classmethod
-    def _ToggleButtonPushed(cls, queue):
-        queue.put('TOGGLE_PUSHED')
+    async def connect(cls, websocket: WebSocket):
+        await websocket.accept()
+        # the client says how big it is in the url, so even the first snapshot is at the right size
+        query = websocket.query_params
+        rendition_size = cls._RenditionSize(query.get("width"), query.get("height"), query.get("dpr"))
+        connection = ClientConnection(
+            websocket, cls._StateMessages, on_close=cls._ConnectionClosed,
+            rendition_size=rendition_size or SCREEN_SIZE
+        )
+        cls.active_connections[websocket] = connection
+        Metrics.MarkBoot('first_client')
+        cls.first_client.set()
+        ResizeWorker.AddSize(connection.rendition_size, GifCatalog.entries)
+        # a client coming back from a blip says where it got to, if we still have everything after that it gets
+        # just those. Everyone else is already up to date, only this client needs anything
+        missed = SessionLog.Since(query.get("epoch"), cls._ParseSeq(query.get("seq")))
+        if missed is None:
+            connection.PushSnapshot()
+            return
+        for render in missed:
+            text = render(connection.rendition_size)
+            if text is not None:
+                connection.Push(text)
 
     @classmethod
-    def _ToggleButtonReleased(cls, queue):
-        queue.put('TOGGLE_RELEASED')
+    def disconnect(cls, websocket: WebSocket):
+        connection = cls.active_connections.pop(websocket, None)
+        if connection is not None:
+            connection.Close()
 
     @classmethod
-    def _PowerButtonPushed(cls, queue):
-        queue.put('POWER_PUSHED')
+    def _ConnectionClosed(cls, connection: ClientConnection):
+        cls.active_connections.pop(connection.websocket, None)
+
+    @staticmethod
+    def _ParseSeq(seq: Optional[str]) -> Optional[int]:
+        try:
+            return int(seq)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _RenditionSize(width, height, device_pixel_ratio) -> Optional[Tuple[int, int]]:
+        """
+        Returns:
+            the rendition size for a viewport of width x height css pixels, or None if it doesn't make sense
+        """
+        try:
+            width, height = float(width), float(height)
+            device_pixel_ratio = float(device_pixel_ratio) if device_pixel_ratio is not None else 1.0
+        except (TypeError, ValueError):
+            return None
+        if not (width > 0 and height > 0 and device_pixel_ratio > 0):
+            return None
+        return pick_rendition_size((width * device_pixel_ratio, height * device_pixel_ratio))
 
     @classmethod
-    def _PowerButtonReleased(cls, queue):
-        queue.put('POWER_RELEASED')
+    def _SizeGroups(cls) -> Dict[Tuple[int, int], List[ClientConnection]]:
+        groups: Dict[Tuple[int, int], List[ClientConnection]] = {}
+        for connection in cls.active_connections.values():
+            groups.setdefault(connection.rendition_size, []).append(connection)
+        return groups
 
     @classmethod
-    async def _ProxyButtons(cls, queue):
-        while True:
-            button_name_and_direciton = await queue.get()
-            if button_name_and_direciton == 'TOGGLE_PUSHED':
-                cls._DoToggleButtonPushed()
-            elif button_name_and_direciton == 'TOGGLE_RELEASED':
-                cls._DoToggleButtonReleased()
-            elif button_name_and_direciton == 'POWER_PUSHED':
-                cls._DoPowerButtonPushed()
-            elif button_name_and_direciton == 'POWER_RELEASED':
-                cls._DoPowerButtonReleased()
+    def _broadcast(cls, message: Dict[str, Any], event: Optional[InputEvent] = None):
+        event_id = None
+        if event is not None:
+            # clients ack anything with an id once it's on screen
+            event_id = message["id"] = event.id
+        message["seq"] = SessionLog.Next()
+        # serialize once, then every client's own sender takes it from there
+        text = encode_message(message)
+        SessionLog.Append(message["seq"], lambda rendition_size: text)
+        for connection in list(cls.active_connections.values()):
+            connection.Push(text, event_id)
+        if event is not None:
+            Metrics.EventBroadcast(event)
 
     @classmethod
-    def _DoToggleButtonPushed(cls):
-        if cls._toggle_flag is True:
+    def HandleClientMessage(cls, websocket: WebSocket, data: str):
+        connection = cls.active_connections.get(websocket)
+        try:
+            client_message = json.loads(data)
+        except ValueError:
             return
-        cls._toggle_flag = True
-        ConnectionManager.SendToggleGif()
-
-    @classmethod
-    def _DoToggleButtonReleased(cls):
-        if cls._toggle_flag is False:
+        if connection is None or not isinstance(client_message, dict):
             return
-        cls._toggle_flag = False
+        if client_message.get("message") == ClientMessageTypes.CLOCK.value:
+            # NTP style, with our receive and send stamps as one, the client's own send time comes straight back
+            sent = client_message.get("sent")
+            if isinstance(sent, (int, float)):
+                connection.Push(encode_message({
+                    "message": MessageTypes.CLOCK.value, "sent": sent, "server": server_time()
+                }))
+        elif client_message.get("message") == ClientMessageTypes.ACK.value:
+            try:
+                Metrics.EventAcked(
+                    int(client_message["id"]), connection,
+                    float(client_message["received"]), float(client_message["rendered"])
+                )
+            except (KeyError, TypeError, ValueError):
+                pass
+        elif client_message.get("message") == ClientMessageTypes.APPLIED.value:
+            try:
+                PlaybackSync.Applied(int(client_message["at"]), float(client_message["shown"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        elif client_message.get("message") == ClientMessageTypes.FIRST_FRAME.value:
+            Metrics.MarkBoot('first_frame')
+        elif client_message.get("message") == ClientMessageTypes.VIEWPORT.value:
+            rendition_size = cls._RenditionSize(
+                client_message.get("width"), client_message.get("height"), client_message.get("devicePixelRatio")
+            )
+            if rendition_size is None or rendition_size == connection.rendition_size:
+                return
+            connection.rendition_size = rendition_size
+            ResizeWorker.AddSize(rendition_size, GifCatalog.entries)
+            # the urls it has are for the old size, the nearest ones there are now for the new one
+            connection.Push(encode_message(cls._GifsMessage(rendition_size)))
 
     @classmethod
-    def _DoPowerButtonPushed(cls):
-        if cls.power_off_flag is True:
-            return
-        cls.power_off_flag = True
-        ConnectionManager.SendPowerOff()
+    def MaxSendQueueDepth(cls) -> int:
+        return max((connection.queue_depth for connection in cls.active_connections.values()), default=0)
 
     @classmethod
-    def _DoPowerButtonReleased(cls):
-        if cls.power_off_flag is False:
-            return
-        cls.power_off_flag = False
-        ConnectionManager.SendPowerOn()
-
-
-class GifFolderWatcher:
-
-    def __init__(self):
-        Path(GIF_PATH).mkdir(parents=True, exist_ok=True)
-        self.observer = Observer()
-
-    def start(self):
-        event_handler = GifFolderHandler()
-        self.observer.schedule(event_handler, GIF_PATH, recursive=False)
-        self.observer.start()
-
-    def stop(self):
-        self.observer.stop()
-        self.observer.join()
-
-
-class GifFolderHandler(PatternMatchingEventHandler):
-
-    def __init__(self):
-        # Set the patterns for PatternMatchingEventHandler
-        PatternMatchingEventHandler.__init__(self, patterns=['*.gif'], ignore_directories=True, case_sensitive=False)
-
-    def on_created(self, event):
-        ConnectionManager.TryLoadGifs()
-
-    def on_modified(self, event):
-        ConnectionManager.TryLoadGifs()
-
-    def on_deleted(self, event):
-        ConnectionManager.TryLoadGifs()
-
-
-@unique
-class MessageTypes(Enum):
-    POWER_ON = 'POWER_ON'
-    POWER_OFF = 'POWER_OFF'
-    TOGGLE_GIF = 'TOGGLE_GIF'
-    LOAD_GIFS = 'LOAD_GIFS'
-    NO_GIFS = 'NO_GIFS'
-
-
-class ConnectionManager:
-
-    active_connections: List[WebSocket] = []
+    def SendPowerOn(cls, event: Optional[InputEvent] = None):
+        cls._broadcast(cls._Scheduled({"message": MessageTypes.POWER_ON.value}), event)
 
     @classmethod
-    async def connect(cls, websocket: WebSocket):
-        await websocket.accept()
-        cls.active_connections.append(websocket)
-        cls.TryLoadGifs()
-        if ButtonWatcher.power_off_flag:
-            cls.SendPowerOff()
+    def SendPowerOff(cls, event: Optional[InputEvent] = None):
+        cls._broadcast(cls._Scheduled({"message": MessageTypes.POWER_OFF.value}), event)
 
     @classmethod
-    def disconnect(cls, websocket: WebSocket):
-        # pretty sure i should tear this bitch down
-        cls.active_connections.remove(websocket)
+    def SendToggleGif(cls, event: Optional[InputEvent] = None):
+        ResizeWorker.SetOnScreen(GifCatalog.StepCurrent())
+        # which gif to show, not just "the next one", so a screen that missed a toggle can't end up on another gif
+        cls._broadcast(cls._Scheduled(
+            {"message": MessageTypes.TOGGLE_GIF.value, "current": GifCatalog.current}, restarts_gif=True
+        ), event)
 
     @classmethod
-    async def _broadcast(cls, message: Dict[str, Any]):
-        for connection in cls.active_connections:
-            await connection.send_json(message)
+    def SendPhase(cls):
+        # not logged, a screen that misses one lines up on the next
+        text = cls._PhaseMessage()
+        if text is None:
+            return
+        for connection in list(cls.active_connections.values()):
+            connection.Push(text)
 
     @classmethod
-    def SendPowerOn(cls):
-        asyncio.create_task(cls._broadcast({"message": MessageTypes.POWER_ON.value}))
+    def _PhaseMessage(cls) -> Optional[str]:
+        entry = GifCatalog.entries.get(GifCatalog.current)
+        if entry is None:
+            return None
+        return encode_message({
+            "message": MessageTypes.PHASE.value,
+            "current": GifCatalog.current,
+            "at": PlaybackSync.NextLoopStart(entry['loop'])
+        })
 
-    @classmethod
-    def SendPowerOff(cls):
-        asyncio.create_task(cls._broadcast({"message": MessageTypes.POWER_OFF.value}))
+    @staticmethod
+    def _Scheduled(message: Dict[str, Any], restarts_gif: bool = False) -> Dict[str, Any]:
+        # in sync mode every screen applies it at the same moment, instead of whenever it gets there
+        at = PlaybackSync.Schedule(restarts_gif)
+        if at is not None:
+            message["at"] = at
+        return message
 
     @classmethod
-    def SendToggleGif(cls):
-        asyncio.create_task(cls._broadcast({"message": MessageTypes.TOGGLE_GIF.value}))
+    def SendGifsDelta(cls, delta: GifsDelta):
+        ResizeWorker.SetOnScreen(GifCatalog.current)
+        if len(GifCatalog.entries) == 0:
+            cls._broadcast(cls._GifsMessage(SCREEN_SIZE))
+            return
+        seq = SessionLog.Next()
+        current = GifCatalog.current
+        texts: Dict[Tuple[int, int], Optional[str]] = {}
+
+        def render(rendition_size: Tuple[int, int]) -> Optional[str]:
+            # clients at the same size see the same urls, serialize once per size instead of once per client
+            if rendition_size not in texts:
+                delta_message = delta.to_message(rendition_size)
+                texts[rendition_size] = None
+                # a delta that only changed sizes these clients don't use isn't sent at all
+                if any(len(values) > 0 for values in delta_message.values()):
+                    texts[rendition_size] = encode_message({
+                        "message": MessageTypes.GIFS_DELTA.value, **delta_message, "current": current, "seq": seq
+                    })
+            return texts[rendition_size]
+
+        SessionLog.Append(seq, render)
+        for rendition_size, connections in cls._SizeGroups().items():
+            text = render(rendition_size)
+            if text is None:
+                continue
+            for connection in connections:
+                connection.Push(text)
 
     @classmethod
-    def TryLoadGifs(cls):
-        gif_list = [
-            os.path.join('gifs', f)
-            for f in os.listdir(GIF_PATH)
-            if os.path.isfile(os.path.join(GIF_PATH, f))
-            and IS_GIF.match(f)
+    def _StateMessages(cls, connection: ClientConnection) -> List[str]:
+        # everything a client needs to match the others, for new clients and ones that fell behind
+        power = MessageTypes.POWER_OFF if ButtonWatcher.power_off_flag else MessageTypes.POWER_ON
+        messages = [
+            encode_message(cls._GifsMessage(connection.rendition_size)),
+            encode_message({"message": power.value, "seq": SessionLog.seq})
         ]
-        if len(gif_list) == 0:
-            asyncio.create_task(cls._SendNoGifs())
-        else:
-            asyncio.create_task(cls._SendLoadGifs(gif_list))
-
-    @classmethod
-    async def _SendNoGifs(cls):
-        await cls._broadcast({"message": MessageTypes.NO_GIFS.value})
+        # and in step with the rest of the wall from the next loop, not the next resync
+        phase = cls._PhaseMessage() if PlaybackSync.enabled else None
+        if phase is not None:
+            messages.append(phase)
+        return messages
 
     @classmethod
-    async def _SendLoadGifs(cls, gif_paths: List[str]):
-        await cls._broadcast({
+    def _GifsMessage(cls, rendition_size: Tuple[int, int]) -> Dict[str, Any]:
+        # the state as of seq, a client resuming later sends it back along with the epoch
+        if len(GifCatalog.entries) == 0:
+            return {"message": MessageTypes.NO_GIFS.value, "seq": SessionLog.seq, "epoch": SessionLog.epoch}
+        return {
             "message": MessageTypes.LOAD_GIFS.value,
-            "gifs": gif_paths
-        })
+            "gifs": GifCatalog.Render(rendition_size),
+            "current": GifCatalog.current,
+            "seq": SessionLog.seq,
+            "epoch": SessionLog.epoch
+        }
 
 
 app = FastAPI()
 
+# read once, every reconnect and reload asks for it
+index_page = MemoryFile(INDEX_PATH, 'text/html')
+# shared by /gifs and /renditions, every screen wants the same few files
+hot_assets = HotAssetCache()
+
 
 @app.websocket_route("/ws")
 class CalibrationConnection(WebSocketEndpoint):
@@ -281,45 +356,125 @@ class CalibrationConnection(WebSocketEndpoint):
     async def on_connect(self, websocket: WebSocket) -> None:
         await ConnectionManager.connect(websocket)
 
+    async def on_receive(self, websocket: WebSocket, data: str) -> None:
+        ConnectionManager.HandleClientMessage(websocket, data)
+
     async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
         ConnectionManager.disconnect(websocket)
 
 
 @app.get("/")
-async def root():
-    with open(INDEX_PATH) as f:
-        return HTMLResponse(content=f.read(), status_code=200)
+async def root(request: Request):
+    return index_page.response(request.headers)
+
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(Metrics.Render(), media_type='text/plain; version=0.0.4')
 
-app.mount("/gifs", StaticFiles(directory=GIF_PATH), name="static")
+
+app.mount("/gifs", ContentHashedStaticFiles(
+    directory=GIF_PATH, content_hash=lambda path, stat: ResizeWorker.cache.known_source_hash(path, stat),
+    hot_cache=hot_assets
+), name="static")
+app.mount("/renditions", ContentHashedStaticFiles(
+    directory=ResizeWorker.cache.cache_path, content_hash=lambda path, stat: os.path.basename(path),
+    content_addressed=True, hot_cache=hot_assets
+), name="static")
 app.mount("/", StaticFiles(directory=FRONTEND_PATH), name="static")
 
-folder_watcher: Optional[GifFolderWatcher] = None
+# a gif_folder_watcher.GifFolderWatcher, imported in startup_event so watchdog loads with the rest of startup
+folder_watcher = None
+
+
+def touch_gif(path: str):
+    hot_assets.invalidate(path)
+    GifCatalog.Touch(os.path.basename(path))
+
+
+async def wait_until_listening(port: int):
+    # uvicorn only binds once the startup hooks are done, so keep knocking until it answers
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+
+
+async def open_browser_when_ready():
+    await wait_until_listening(PORT)
+    Metrics.MarkBoot('listening')
+    try:
+        # a browser that connects before there's a gif just gets told there are none
+        await asyncio.wait_for(GifCatalog.ready.wait(), BROWSER_READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        print('No gif ready after {:.0f}s, opening the browser anyway'.format(BROWSER_READY_TIMEOUT))
+    Metrics.MarkBoot('catalog_ready')
+    subprocess.Popen([
+        chrome_path, '--disable-infobars', '--start-fullscreen', '--app={}'.format(SCREEN_URL)
+    ])
+    Metrics.MarkBoot('browser_launched')
+    # the page is up once it connects, that's when the cursor gets nudged out of the way
+    await ConnectionManager.first_client.wait()
+    await asyncio.get_running_loop().run_in_executor(None, move_mouse)
+
+
+def move_mouse():
+    # needs a display, so only imported once there's a browser to nudge
+    import pyautogui
+    pyautogui.moveRel(0, 10)
 
 
 @app.on_event("startup")
 async def startup_event():
     global folder_watcher
-    folder_watcher = GifFolderWatcher()
+    Metrics.BootStarted(BOOT_START)
+    Metrics.MarkBoot('imported')
+    Metrics.Startup()
+    ConnectionManager.first_client = asyncio.Event()
+    Metrics.RegisterGauge(
+        'sparky_input_queue_depth', 'Button and key events waiting to reach the event loop.',
+        lambda: ButtonWatcher.input.pending if ButtonWatcher.input is not None else 0
+    )
+    Metrics.RegisterGauge(
+        'sparky_send_queue_depth_max', 'Messages queued for the furthest behind client.',
+        ConnectionManager.MaxSendQueueDepth
+    )
+    Metrics.RegisterGauge(
+        'sparky_connected_clients', 'Open websocket connections.',
+        lambda: len(ConnectionManager.active_connections)
+    )
+    Metrics.RegisterGauge(
+        'sparky_hot_asset_bytes', 'Bytes of gifs held in memory for serving.', lambda: hot_assets.nbytes
+    )
+    Metrics.RegisterGauge(
+        'sparky_hot_asset_hits', 'Gif requests served straight from memory.', lambda: hot_assets.hits
+    )
+    await ResizeWorker.Startup(on_ready=GifCatalog.OnReady, in_use=GifCatalog.RenditionPaths)
+    from gif_folder_watcher import GifFolderWatcher
+    folder_watcher = GifFolderWatcher(on_touch=touch_gif)
     folder_watcher.start()
+    await GifCatalog.Startup(on_change=ConnectionManager.SendGifsDelta)
     ButtonWatcher.Startup()
+    if SYNC_MODE:
+        PlaybackSync.Startup(on_resync=ConnectionManager.SendPhase)
+    Metrics.MarkBoot('app_ready')
 
-    def do_open_browser():
-        subprocess.Popen([chrome_path, '--disable-infobars', '--start-fullscreen', '--app=http://localhost:42069'])
-
-        def do_move_mouse():
-            pyautogui.moveRel(0, 10)
+    if IS_HEADLESS:
+        return
 
-        Timer(3.0, do_move_mouse).start()
-
-    Timer(2.0, do_open_browser).start()
+    asyncio.create_task(open_browser_when_ready())
 
 
 @app.on_event("shutdown")
 def shutdown_event():
-    global folder_watcher
     folder_watcher.stop()
+    ResizeWorker.Shutdown()
+    PlaybackSync.Shutdown()
+    Metrics.Shutdown()
 
 
 if __name__ == '__main__':
-    uvicorn.run("main:app", host="0.0.0.0", port=42069, log_level="info")
+    uvicorn.run("main:app", host="0.0.0.0", port=PORT, log_level="info")
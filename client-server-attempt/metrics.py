@@ -0,0 +1,259 @@
+import time
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# seconds, tuned for "did a button press feel instant" rather than request latency
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+STAGES = (
+    # gpio / keyboard callback thread -> event loop
+    'input_queue',
+    # event loop picks the event up -> message handed to every client's send queue
+    'dispatch',
+    # send queue -> written to the socket, per client
+    'send',
+    # one way network estimate, half the ack round trip minus the time the client sat on it
+    'network',
+    # message received -> next frame painted, measured by the client
+    'render',
+    # button to pixel
+    'end_to_end',
+)
+
+BOOT_STAGES = (
+    # main.py and everything it imports is loaded
+    'imported',
+    # startup hooks done: resize workers forked, gif folder watched, buttons listening
+    'app_ready',
+    # the socket takes connections
+    'listening',
+    # the catalog has a gif to show, or knows there are none
+    'catalog_ready',
+    'browser_launched',
+    'first_client',
+    # a client painted its first gif
+    'first_frame',
+)
+
+# acks that never show up shouldn't pile up forever
+MAX_TRACKED_EVENTS = 256
+
+LOOP_LAG_INTERVAL = 0.25
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def Observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def Render(self, name: str, labels: str) -> List[str]:
+        bucket_labels = labels + ',' if labels else ''
+        label_block = '{' + labels + '}' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, bucket_labels, bound, cumulative))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, bucket_labels, self.count))
+        lines.append('{}_sum{} {}'.format(name, label_block, self.sum))
+        lines.append('{}_count{} {}'.format(name, label_block, self.count))
+        return lines
+
+
+class InputEvent:
+
+    def __init__(self, event_id: int, kind: str, input_time: float):
+        self.id = event_id
+        self.kind = kind
+        self.input_time = input_time
+        self.dispatch_time: Optional[float] = None
+        self.broadcast_time: Optional[float] = None
+        # client -> when its send finished
+        self.sent: Dict[Any, float] = {}
+
+
+class Metrics:
+    """
+    Per stage latency histograms for the button -> pixel path, plus a few gauges, served up Prometheus style.
+
+    Every timestamp is time.monotonic(). The client only ever reports differences of its own clock, so nothing
+    here depends on the client and server clocks agreeing. The exception is sync mode's screen skew and sync error
+    (see PlaybackSync), which come from each client's own estimate of our clock.
+    """
+
+    stage_latency: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+    loop_lag = Histogram()
+    last_loop_lag: float = 0.0
+    acks: int = 0
+    # sync mode: spread between the first and last screen showing a scheduled change, and each screen's distance
+    # from when it was scheduled
+    screen_skew = Histogram()
+    last_screen_skew: Optional[float] = None
+    sync_error = Histogram()
+
+    # time.monotonic() main.py started loading at, and when each of BOOT_STAGES was reached
+    boot_start: Optional[float] = None
+    boot_times: Dict[str, float] = {}
+
+    _events: 'OrderedDict[int, InputEvent]' = OrderedDict()
+    _event_ids = itertools.count(1)
+    _gauges: List[Tuple[str, str, Callable[[], float]]] = []
+    _lag_watcher: Optional[asyncio.Task] = None
+
+    @classmethod
+    def Startup(cls):
+        cls._lag_watcher = asyncio.create_task(cls._WatchLoopLag())
+
+    @classmethod
+    def Shutdown(cls):
+        if cls._lag_watcher is not None:
+            cls._lag_watcher.cancel()
+            cls._lag_watcher = None
+
+    @classmethod
+    def RegisterGauge(cls, name: str, help_text: str, read: Callable[[], float]):
+        cls._gauges.append((name, help_text, read))
+
+    @classmethod
+    def BootStarted(cls, boot_start: float):
+        cls.boot_start = boot_start
+
+    @classmethod
+    def MarkBoot(cls, stage: str):
+        """
+        Record the first time stage was reached, the timeline gets printed once a client paints its first gif.
+        """
+        if cls.boot_start is None or stage in cls.boot_times:
+            return
+        cls.boot_times[stage] = time.monotonic() - cls.boot_start
+        if stage == BOOT_STAGES[-1]:
+            print(cls.BootTimeline())
+
+    @classmethod
+    def BootTimeline(cls) -> str:
+        # in the order they happened, a stage that never happened (no browser when headless) is left out
+        return 'boot: ' + ', '.join(
+            '{} {:.2f}s'.format(stage, seconds)
+            for stage, seconds in sorted(cls.boot_times.items(), key=lambda item: item[1])
+        )
+
+    @classmethod
+    def StartEvent(cls, kind: str, input_time: float) -> InputEvent:
+        """
+        Args:
+            kind: what happened, e.g. TOGGLE_GIF
+            input_time: time.monotonic() from the callback thread that saw the edge
+        """
+        event = InputEvent(next(cls._event_ids), kind, input_time)
+        event.dispatch_time = time.monotonic()
+        cls.stage_latency['input_queue'].Observe(event.dispatch_time - input_time)
+        cls._events[event.id] = event
+        while len(cls._events) > MAX_TRACKED_EVENTS:
+            cls._events.popitem(last=False)
+        return event
+
+    @classmethod
+    def EventBroadcast(cls, event: InputEvent):
+        event.broadcast_time = time.monotonic()
+        cls.stage_latency['dispatch'].Observe(event.broadcast_time - event.dispatch_time)
+
+    @classmethod
+    def EventSent(cls, event_id: int, client: Any):
+        event = cls._events.get(event_id)
+        if event is None or event.broadcast_time is None:
+            return
+        sent_time = time.monotonic()
+        event.sent[client] = sent_time
+        cls.stage_latency['send'].Observe(sent_time - event.broadcast_time)
+
+    @classmethod
+    def EventAcked(cls, event_id: int, client: Any, received: float, rendered: float):
+        """
+        Args:
+            received, rendered: the client's performance.now() in ms when the message arrived and when the
+                                frame showing it was painted
+        """
+        ack_time = time.monotonic()
+        event = cls._events.get(event_id)
+        if event is None:
+            return
+        sent_time = event.sent.pop(client, None)
+        if sent_time is None:
+            return
+        render = max((rendered - received) / 1000, 0.0)
+        network = max((ack_time - sent_time - render) / 2, 0.0)
+        cls.acks += 1
+        cls.stage_latency['network'].Observe(network)
+        cls.stage_latency['render'].Observe(render)
+        cls.stage_latency['end_to_end'].Observe(sent_time - event.input_time + network + render)
+
+    @classmethod
+    def ScreenSkew(cls, skew: float):
+        cls.last_screen_skew = skew
+        cls.screen_skew.Observe(skew)
+
+    @classmethod
+    def SyncError(cls, error: float):
+        cls.sync_error.Observe(error)
+
+    @classmethod
+    async def _WatchLoopLag(cls):
+        # anything hogging the loop shows up as this sleep overshooting
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            cls.last_loop_lag = max(time.monotonic() - start - LOOP_LAG_INTERVAL, 0.0)
+            cls.loop_lag.Observe(cls.last_loop_lag)
+
+    @classmethod
+    def Render(cls) -> str:
+        lines = [
+            '# HELP sparky_stage_latency_seconds Latency of each hop between a button edge and the pixels changing.',
+            '# TYPE sparky_stage_latency_seconds histogram',
+        ]
+        for stage, histogram in cls.stage_latency.items():
+            lines.extend(histogram.Render('sparky_stage_latency_seconds', 'stage="{}"'.format(stage)))
+
+        lines.append('# HELP sparky_event_loop_lag_seconds How late the event loop woke up a sleeping task.')
+        lines.append('# TYPE sparky_event_loop_lag_seconds histogram')
+        lines.extend(cls.loop_lag.Render('sparky_event_loop_lag_seconds', ''))
+        lines.append('# TYPE sparky_event_loop_lag_last_seconds gauge')
+        lines.append('sparky_event_loop_lag_last_seconds {}'.format(cls.last_loop_lag))
+
+        lines.append('# HELP sparky_boot_seconds Seconds from main.py starting to load to each boot stage.')
+        lines.append('# TYPE sparky_boot_seconds gauge')
+        for stage, seconds in cls.boot_times.items():
+            lines.append('sparky_boot_seconds{{stage="{}"}} {}'.format(stage, seconds))
+
+        if cls.sync_error.count > 0:
+            lines.append('# HELP sparky_screen_skew_seconds Spread between screens showing the same scheduled change.')
+            lines.append('# TYPE sparky_screen_skew_seconds histogram')
+            lines.extend(cls.screen_skew.Render('sparky_screen_skew_seconds', ''))
+            if cls.last_screen_skew is not None:
+                lines.append('# TYPE sparky_screen_skew_last_seconds gauge')
+                lines.append('sparky_screen_skew_last_seconds {}'.format(cls.last_screen_skew))
+            lines.append('# HELP sparky_sync_error_seconds How far from its scheduled time a change hit a screen.')
+            lines.append('# TYPE sparky_sync_error_seconds histogram')
+            lines.extend(cls.sync_error.Render('sparky_sync_error_seconds', ''))
+
+        lines.append('# TYPE sparky_render_acks_total counter')
+        lines.append('sparky_render_acks_total {}'.format(cls.acks))
+
+        for name, help_text, read in cls._gauges:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, read()))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,227 @@
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+# 255 colours, the last index is kept for transparent pixels
+PALETTE_COLOURS = 255
+TRANSPARENT_INDEX = 255
+# below this the pixel is transparent, same cut off Pillow uses going from RGBA to P
+ALPHA_THRESHOLD = 128
+
+# colour statistics come from a strided sample of every frame, not every pixel
+SAMPLES_PER_FRAME = 4096
+MAX_SAMPLES_PER_SCENE = 256 * 1024
+
+# frames are compared by a 4 bit per channel histogram, half the pixels changing colour starts a new scene
+SCENE_HISTOGRAM_BITS = 4
+SCENE_CHANGE = 0.5
+# a scene's palette is built from the frames at its start, held as colour bins (2 bytes a pixel) until there's this
+# many of them or they'd take more than this many bytes. At the pi's screen size that's 6 frames
+SCENE_WINDOW_FRAMES = 8
+SCENE_WINDOW_BYTES = 16 * 1024 * 1024
+
+# frames are mapped through a table of the nearest palette entry for every 5 bit per channel colour
+LOOKUP_BITS = 5
+LOOKUP_CHUNK = 4096
+# the bin after every colour's, for transparent pixels
+TRANSPARENT_BIN = 1 << (3 * LOOKUP_BITS)
+
+# 4x4 Bayer matrix, centred on 0
+BAYER_4 = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5],
+], dtype=np.float32) + 0.5) / 16 - 0.5
+# about half the distance between neighbouring entries of a 255 colour palette spread over the rgb cube
+DITHER_SPREAD = 16
+
+
+def sample_colours(frame: Image.Image, count: int = SAMPLES_PER_FRAME) -> np.ndarray:
+    """
+    Args:
+        frame: frame in any mode, a nearest neighbour shrink picks the pixels so the rest never get copied
+
+    Returns:
+        n x 3 RGB of up to count opaque pixels, taken at an even stride so a frame always gives the same sample
+    """
+    scale = max((frame.size[0] * frame.size[1] / count) ** 0.5, 1)
+    sample_size = (max(int(frame.size[0] / scale), 1), max(int(frame.size[1] / scale), 1))
+    pixels = np.asarray(frame.resize(sample_size, Image.Resampling.NEAREST).convert('RGBA')).reshape(-1, 4)
+    return pixels[pixels[:, 3] >= ALPHA_THRESHOLD, :3]
+
+
+def colour_histogram(samples: np.ndarray, bits: int = SCENE_HISTOGRAM_BITS) -> np.ndarray:
+    """
+    Returns:
+        normalised histogram of the samples, bits per channel
+    """
+    shift = 8 - bits
+    bins = (
+        (samples[:, 0].astype(np.int32) >> shift) << (2 * bits)
+        | (samples[:, 1].astype(np.int32) >> shift) << bits
+        | (samples[:, 2].astype(np.int32) >> shift)
+    )
+    histogram = np.bincount(bins, minlength=1 << (3 * bits)).astype(np.float32)
+    return histogram / max(histogram.sum(), 1)
+
+
+def scene_changed(previous: np.ndarray, histogram: np.ndarray, threshold: float = SCENE_CHANGE) -> bool:
+    """
+    Returns:
+        True if the colours moved more than threshold (half the L1 distance between histograms, 0 - 1) from the
+        frame before, which starts a new scene
+    """
+    return np.abs(histogram - previous).sum() / 2 > threshold
+
+
+def build_palette(samples: np.ndarray, colours: int = PALETTE_COLOURS) -> np.ndarray:
+    """
+    Median cut over the sampled colours, done once per scene instead of once per frame.
+
+    Returns:
+        n x 3 uint8 palette, n <= colours
+    """
+    if len(samples) == 0:
+        return np.zeros((1, 3), dtype=np.uint8)
+    if len(samples) > MAX_SAMPLES_PER_SCENE:
+        samples = samples[::len(samples) // MAX_SAMPLES_PER_SCENE + 1]
+    quantized = Image.fromarray(np.ascontiguousarray(samples).reshape(1, -1, 3), 'RGB').quantize(colours)
+    return np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3)
+
+
+def colour_table(palette: np.ndarray) -> bytes:
+    """
+    Returns:
+        the palette as a 256 entry GIF colour table, the transparent entry is black
+    """
+    table = np.zeros((256, 3), dtype=np.uint8)
+    table[:len(palette)] = palette
+    return table.tobytes()
+
+
+def lookup_bins(frame: Image.Image, dither: bool = False) -> np.ndarray:
+    """
+    Everything PaletteMapper needs of a frame, whatever the palette turns out to be.
+
+    Args:
+        frame: RGBA frame
+        dither (optional): ordered dither, it only depends on where the pixel is so it goes on before binning
+
+    Returns:
+        height x width uint16 LOOKUP_BITS per channel colour bins, TRANSPARENT_BIN where the frame is transparent
+    """
+    pixels = np.asarray(frame)
+    rgb = pixels[:, :, :3]
+    if dither:
+        height, width = rgb.shape[:2]
+        threshold = np.tile(BAYER_4, (height // 4 + 1, width // 4 + 1))[:height, :width, None]
+        rgb = np.clip(rgb + threshold * DITHER_SPREAD, 0, 255).astype(np.uint8)
+
+    shift = 8 - LOOKUP_BITS
+    bins = (
+        (rgb[:, :, 0].astype(np.uint16) >> shift) << (2 * LOOKUP_BITS)
+        | (rgb[:, :, 1].astype(np.uint16) >> shift) << LOOKUP_BITS
+        | (rgb[:, :, 2].astype(np.uint16) >> shift)
+    )
+    bins[pixels[:, :, 3] < ALPHA_THRESHOLD] = TRANSPARENT_BIN
+    return bins
+
+
+class PaletteMapper:
+    """
+    Maps whole frames onto a fixed palette with a couple of numpy lookups, instead of Pillow quantizing each one.
+    """
+
+    def __init__(self, palette: np.ndarray, dither: bool = False):
+        self.palette = palette
+        self.colour_table = colour_table(palette)
+        self.dither = dither
+
+        levels = 1 << LOOKUP_BITS
+        step = 256 // levels
+        centres = (np.arange(levels, dtype=np.float32) * step + step / 2)
+        r, g, b = np.meshgrid(centres, centres, centres, indexing='ij')
+        colours = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+        entries = palette.astype(np.float32)
+        entry_norms = (entries ** 2).sum(axis=1)
+        # one past the colours for TRANSPARENT_BIN
+        self.lookup = np.empty(len(colours) + 1, dtype=np.uint8)
+        self.lookup[TRANSPARENT_BIN] = TRANSPARENT_INDEX
+        # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, and |c|^2 doesn't change which p is nearest
+        for start in range(0, len(colours), LOOKUP_CHUNK):
+            chunk = colours[start:start + LOOKUP_CHUNK]
+            distances = entry_norms[None, :] - 2 * chunk @ entries.T
+            self.lookup[start:start + LOOKUP_CHUNK] = distances.argmin(axis=1)
+
+    def map(self, frame: Image.Image) -> np.ndarray:
+        """
+        Args:
+            frame: RGBA frame
+
+        Returns:
+            height x width palette indexes, TRANSPARENT_INDEX where the frame is transparent
+        """
+        return self.map_bins(lookup_bins(frame, self.dither))
+
+    def map_bins(self, bins: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            bins: from lookup_bins, dithered already if this mapper dithers
+        """
+        return self.lookup[bins]
+
+
+def map_scenes(frames: Iterable[Tuple[Image.Image, int]], per_scene: bool = True,
+               dither: bool = False) -> Iterator[Tuple[np.ndarray, int, bytes]]:
+    """
+    Map frames onto shared palettes in the one pass over them, sampling colours as they go by.
+
+    The frames at the start of a scene are held back as lookup_bins, up to SCENE_WINDOW_FRAMES or
+    SCENE_WINDOW_BYTES, and the scene's palette is built from their samples. The rest of the scene is mapped onto it as it comes. Without
+    per_scene, the palette built from the start of the GIF is used for the whole of it.
+
+    Args:
+        frames: (RGBA frame, duration in ms), a frame may be overwritten by the next one
+        per_scene (optional): a palette per scene, otherwise one for the whole GIF
+        dither (optional): ordered dither onto the palettes
+
+    Returns:
+        (height x width palette indexes, duration in ms, 256 entry colour table of the frame's palette)
+    """
+    # (bins, duration)
+    held: List[Tuple[np.ndarray, int]] = []
+    samples: List[np.ndarray] = []
+    mapper = None
+    previous = None
+    window = SCENE_WINDOW_FRAMES
+
+    def map_held():
+        nonlocal mapper
+        mapper = PaletteMapper(build_palette(np.concatenate(samples)), dither)
+        for bins, held_duration in held:
+            yield mapper.map_bins(bins), held_duration, mapper.colour_table
+        held.clear()
+        samples.clear()
+
+    for frame, duration in frames:
+        sample = sample_colours(frame)
+        if per_scene:
+            histogram = colour_histogram(sample)
+            if previous is not None and scene_changed(previous, histogram):
+                if len(held) > 0:
+                    yield from map_held()
+                mapper = None
+            previous = histogram
+        if mapper is not None:
+            yield mapper.map(frame), duration, mapper.colour_table
+            continue
+        if len(held) == 0:
+            window = min(SCENE_WINDOW_FRAMES, max(SCENE_WINDOW_BYTES // (frame.size[0] * frame.size[1] * 2), 1))
+        held.append((lookup_bins(frame, dither), duration))
+        samples.append(sample)
+        if len(held) >= window:
+            yield from map_held()
+    if len(held) > 0:
+        yield from map_held()
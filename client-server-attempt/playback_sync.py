@@ -0,0 +1,134 @@
+import math
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from metrics import Metrics
+
+# how far ahead a change is scheduled, it has to cover getting the message to the slowest screen on the wall
+SYNC_LEAD = 0.25
+# how often every screen restarts the gif on screen together, so animations that drifted apart line back up
+PHASE_RESYNC_INTERVAL = 15.0
+# a screen reporting a change this long after it was due is too late to count towards the skew
+SKEW_WINDOW = 2.0
+# scheduled changes still collecting reports, screens that never report shouldn't make this grow forever
+MAX_TRACKED_CHANGES = 64
+
+
+def server_time() -> int:
+    # what clients get told the time is, time.monotonic() in ms
+    return int(round(time.monotonic() * 1000))
+
+
+class PlaybackSync:
+    """
+    Sync mode, for a wall of screens side by side: a change goes out with an `at` SYNC_LEAD in the future on our
+    clock, and every screen applies it then instead of whenever the message happens to get there.
+
+    Clients work out the offset from their clock to server_time() NTP style, pinging over /ws (see index.js). Every
+    PHASE_RESYNC_INTERVAL the screens are also told to restart the gif on screen from its first frame at the same
+    moment. It's picked on a loop boundary of the gif, so screens that are still in step don't see a jump.
+
+    Screens report when each scheduled change hit the screen, on our clock by their estimate. The spread of those
+    per change is the inter-screen skew, and goes to Metrics once every report should be in.
+    """
+
+    enabled = False
+    # time.monotonic() the gif on screen started from its first frame everywhere, loops line up from here
+    shown_at: Optional[float] = None
+
+    # at -> when each screen reported showing it, in seconds
+    _reports: 'OrderedDict[int, List[float]]' = OrderedDict()
+    _resync_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def Startup(cls, on_resync: Callable[[], None]):
+        """
+        Args:
+            on_resync: sends every screen a phase resync, see NextLoopStart
+        """
+        cls.enabled = True
+        cls._resync_task = asyncio.create_task(cls._Resync(on_resync))
+
+    @classmethod
+    def Shutdown(cls):
+        if cls._resync_task is not None:
+            cls._resync_task.cancel()
+            cls._resync_task = None
+
+    @classmethod
+    def Schedule(cls, restarts_gif: bool = False) -> Optional[int]:
+        """
+        Args:
+            restarts_gif (optional): the change puts a gif on screen from its first frame
+
+        Returns:
+            the server_time() every screen should apply a change at, or None when not in sync mode
+        """
+        if not cls.enabled:
+            return None
+        at = time.monotonic() + SYNC_LEAD
+        if restarts_gif:
+            cls.shown_at = at
+        return cls._Track(at)
+
+    @classmethod
+    def NextLoopStart(cls, loop: int) -> int:
+        """
+        Args:
+            loop: ms one loop of the gif on screen takes
+
+        Returns:
+            the first server_time() at least SYNC_LEAD away that the gif on screen starts a loop, if the screens
+            are in step
+        """
+        earliest = time.monotonic() + SYNC_LEAD
+        if cls.shown_at is None or loop <= 0:
+            # nothing to line up with yet, this is where the loops count from now
+            cls.shown_at = earliest
+            return cls._Track(earliest)
+        loops = math.ceil((earliest - cls.shown_at) / (loop / 1000))
+        return cls._Track(cls.shown_at + loops * loop / 1000)
+
+    @classmethod
+    def Applied(cls, at: int, shown: float):
+        """
+        Args:
+            at: the change's server_time()
+            shown: when the screen showed it, server_time() by its estimate
+        """
+        reports = cls._reports.get(at)
+        if reports is None:
+            return
+        reports.append(shown / 1000)
+        Metrics.SyncError(abs(shown - at) / 1000)
+        cls._Finish()
+
+    @classmethod
+    def _Track(cls, at: float) -> int:
+        at = int(round(at * 1000))
+        cls._reports.setdefault(at, [])
+        while len(cls._reports) > MAX_TRACKED_CHANGES:
+            cls._Skew(*cls._reports.popitem(last=False))
+        return at
+
+    @classmethod
+    def _Finish(cls):
+        # roughly in order of at, one that's done behind one that isn't yet just waits for it
+        done_before = (time.monotonic() - SKEW_WINDOW) * 1000
+        while len(cls._reports) > 0 and next(iter(cls._reports)) < done_before:
+            cls._Skew(*cls._reports.popitem(last=False))
+
+    @staticmethod
+    def _Skew(at: int, reports: List[float]):
+        # one screen on its own isn't skewed from anything
+        if len(reports) > 1:
+            Metrics.ScreenSkew(max(reports) - min(reports))
+
+    @classmethod
+    async def _Resync(cls, on_resync: Callable[[], None]):
+        while True:
+            await asyncio.sleep(PHASE_RESYNC_INTERVAL)
+            cls._Finish()
+            on_resync()
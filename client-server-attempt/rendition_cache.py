@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+RENDITION_PATH = os.path.join(DIR_PATH, 'renditions')
+INDEX_NAME = 'index.json'
+
+# every format a rendition gets written in, they share a key and only differ by extension
+RENDITION_EXTENSIONS = ('gif', 'webp')
+
+# keep the cache from eating the sd card, 512 MB
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# everything gets written under this suffix and renamed over the real name once it's whole
+PARTIAL_SUFFIX = '.partial'
+# a partial nobody has written to for this long is left over from a crash, a live one grows every frame
+STALE_PARTIAL_SECONDS = 10 * 60
+
+
+def partial_path_for(path: str) -> str:
+    return path if path.endswith(PARTIAL_SUFFIX) else path + PARTIAL_SUFFIX
+
+
+def remove_stale_partials(directory: str, max_age: float = STALE_PARTIAL_SECONDS) -> List[str]:
+    """
+    Returns:
+        the partial files in directory that were removed
+    """
+    removed = []
+    now = time.time()
+    for entry in os.scandir(directory):
+        if not entry.is_file() or not entry.name.endswith(PARTIAL_SUFFIX):
+            continue
+        try:
+            if now - entry.stat().st_mtime < max_age:
+                continue
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        removed.append(entry.path)
+    return removed
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RenditionCache:
+    """
+    Content addressed store of resized GIFs, plus their animated WebP transcodes.
+
+    A rendition is keyed by the hash of the source file plus the target size, resample filter and encoding, so the
+    originals in gifs/ are never touched and a rename or touch of a source doesn't cost a re-render. Source
+    hashes are memoized against (mtime, size) in index.json so a warm lookup is just a stat. LRU order is the
+    mtime of the rendition file itself, bumped on every hit, which keeps the server and the resize script from
+    fighting over a shared index.
+
+    Hashing happens on executor threads while the loop looks things up, so the memo is only touched under a lock.
+    save() and evict() do file io, callers on the event loop should run them in an executor too.
+    """
+
+    def __init__(self, cache_path: str = RENDITION_PATH, max_bytes: int = DEFAULT_MAX_BYTES, encoding: str = ''):
+        """
+        Args:
+            encoding (optional): the encoder settings renditions are made with, a change gets new keys
+        """
+        self.cache_path = cache_path
+        self.encoding = encoding
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(cache_path, INDEX_NAME)
+        self._source_hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        Path(cache_path).mkdir(parents=True, exist_ok=True)
+        self._LoadIndex()
+
+    def _LoadIndex(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+            self._source_hashes = {
+                path: tuple(entry)
+                for path, entry in index.get('sources', {}).items()
+            }
+        except (OSError, ValueError):
+            self._source_hashes = {}
+
+    def save(self):
+        # held for the write as well, two saves at once would share the tmp file
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'sources': self._source_hashes}, f)
+            os.replace(tmp_path, self._index_path)
+            self._dirty = False
+
+    def source_hash(self, source_path: str) -> str:
+        stat = os.stat(source_path)
+        content_hash = self.known_source_hash(source_path, stat)
+        if content_hash is not None:
+            return content_hash
+        content_hash = hash_file(source_path)
+        with self._lock:
+            self._source_hashes[source_path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+            self._dirty = True
+        return content_hash
+
+    def known_source_hash(self, source_path: str, stat: os.stat_result) -> Optional[str]:
+        """
+        Returns:
+            the memoized hash if it's still current for this stat, otherwise None. Never reads the file.
+        """
+        with self._lock:
+            memo = self._source_hashes.get(source_path)
+        if memo is not None and memo[0] == stat.st_mtime_ns and memo[1] == stat.st_size:
+            return memo[2]
+        return None
+
+    @staticmethod
+    def make_key(content_hash: str, size: Tuple[int, int], resample: str, encoding: str = '') -> str:
+        key = '{}-{}x{}-{}'.format(content_hash, size[0], size[1], resample.lower())
+        return key + '-' + encoding if encoding else key
+
+    def key_for(self, source_path: str, size: Tuple[int, int], resample: str) -> str:
+        return self.make_key(self.source_hash(source_path), size, resample, self.encoding)
+
+    def path_for(self, key: str, extension: str = 'gif') -> str:
+        return os.path.join(self.cache_path, key + '.' + extension)
+
+    def temp_path_for(self, key: str, extension: str = 'gif') -> str:
+        return partial_path_for(self.path_for(key, extension))
+
+    def lookup(self, source_path: str, size: Tuple[int, int], resample: str,
+               extension: str = 'gif') -> Optional[str]:
+        """
+        Returns:
+            the rendition path if one exists for this source/size/resample in this format, otherwise None
+        """
+        rendition_path = self.path_for(self.key_for(source_path, size, resample), extension)
+        try:
+            os.utime(rendition_path)
+        except FileNotFoundError:
+            return None
+        return rendition_path
+
+    def commit(self, key: str, extension: str = 'gif') -> str:
+        # renditions are rendered into a partial file so a crash never leaves a half written hit
+        rendition_path = self.path_for(key, extension)
+        os.replace(self.temp_path_for(key, extension), rendition_path)
+        return rendition_path
+
+    def _Renditions(self) -> List[Tuple[float, int, str]]:
+        renditions = []
+        for entry in os.scandir(self.cache_path):
+            if not entry.is_file() or entry.name.rpartition('.')[2] not in RENDITION_EXTENSIONS:
+                continue
+            stat = entry.stat()
+            renditions.append((stat.st_mtime, stat.st_size, entry.path))
+        return renditions
+
+    def evict(self, keep: Iterable[str] = ()) -> List[str]:
+        """
+        Drop least recently used renditions until the cache fits in max_bytes.
+
+        Args:
+            keep (optional): rendition paths that must survive, e.g. the ones currently on screen
+        """
+        keep = set(keep)
+        renditions = sorted(self._Renditions())
+        total_bytes = sum(size for _, size, _ in renditions)
+        evicted = []
+        for _, size, path in renditions:
+            if total_bytes <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            evicted.append(path)
+        return evicted
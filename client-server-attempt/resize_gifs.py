@@ -1,140 +1,532 @@
 import os
-from PIL import Image
+import shutil
+import time
+from typing import Optional
+from PIL import Image, features
 import asyncio
 
+import numpy as np
 import re
 from functools import partial
 import concurrent.futures
 
+from gif_stream import DeltaFrameWriter, GifStreamWriter, read_canvas_size, read_frame_headers
+from palette import TRANSPARENT_INDEX, map_scenes
+from rendition_cache import RENDITION_EXTENSIONS, RenditionCache, partial_path_for
+
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 GIF_PATH = os.path.join(DIR_PATH, 'gifs')
 IS_GIF = re.compile('.+?.gif$', re.IGNORECASE)
 
+SCREEN_SIZE = (1280, 1040)
+# every size a rendition can be made at, a client gets the smallest one that covers its screen in device pixels.
+# SCREEN_SIZE is the pi's own screen, the rest only get made once a client asks for them
+RENDITION_SIZES = ((800, 480), SCREEN_SIZE, (1920, 1080), (3840, 2160))
+RESAMPLE = 'LANCZOS'
+# a source more than this many times the target gets reduce()d by a whole factor first, leaving at least this
+# much for the filter. same idea as PIL's reducing_gap, at 2 it's close to indistinguishable from resampling the lot
+REDUCING_GAP = 2.0
+# how many source pixels either side each filter reads, at a scale of 1
+FILTER_SUPPORT = {'NEAREST': 0.5, 'BOX': 0.5, 'BILINEAR': 1.0, 'HAMMING': 1.0, 'BICUBIC': 2.0, 'LANCZOS': 3.0}
+
+# 'scene': a palette per run of similar frames, 'gif': one for the whole gif, built from its first few frames,
+# 'frame': Pillow quantizes every frame
+PALETTE = 'scene'
+PALETTE_MODES = ('scene', 'gif', 'frame')
+# ordered dithering against the shared palette
+DITHER = False
+
+# animated webp is decoded far cheaper than gif by chromium, only made if Pillow was built with libwebp
+WEBP_ENABLED = features.check('webp')
+WEBP_QUALITY = 80
+# 0 (fast) - 6 (small), 4 is what cwebp uses
+WEBP_METHOD = 4
+
+# bump whenever a change to the encoder changes what comes out for the same settings. Renditions are served as
+# immutable, so anything that changes the output has to change the key too
+ENCODER_VERSION = 1
+# goes in every rendition key along with the source hash, size and resample filter
+ENCODING = '{}-{}-q{}m{}-v{}'.format(
+    PALETTE, 'dither' if DITHER else 'flat', WEBP_QUALITY, WEBP_METHOD, ENCODER_VERSION
+)
+
+
+class ResizeCancelled(Exception):
+    pass
 
-def resize_gif(path, save_as=None, resize_to=None):
+
+def size_name(size) -> str:
+    return '{}x{}'.format(size[0], size[1])
+
+
+def exceeds(size, source_size) -> bool:
+    """
+    Returns:
+        True if a rendition at size would be bigger than the source in either direction, there's no point making it
     """
-    Resizes the GIF to a given length:
+    return size[0] > source_size[0] or size[1] > source_size[1]
+
+
+def pick_rendition_size(pixels, sizes=RENDITION_SIZES):
+    """
+    Args:
+        pixels: (width, height) the picture fills in device pixels, the css viewport times devicePixelRatio
+        sizes (optional): the sizes to pick from
+
+    Returns:
+        the smallest size that covers pixels, or the biggest one if none do
+    """
+    covering = [size for size in sizes if size[0] >= pixels[0] and size[1] >= pixels[1]]
+    if len(covering) > 0:
+        return min(covering, key=lambda size: size[0] * size[1])
+    return max(sizes, key=lambda size: size[0] * size[1])
+
+
+def resize_gif(path, save_as=None, resize_to=None, resample=RESAMPLE, cancel_check=None, palette=PALETTE,
+               dither=DITHER):
+    """
+    Resizes the GIF to a given length, streaming frames straight from the decoder into the encoder:
+
+    Unless palette is 'frame', the resized frames are mapped onto shared palettes, each built from colours sampled
+    off the first few frames of its scene as they go by (see map_scenes), so the source is only decoded once. The
+    first palette goes in the global colour table. Mapped frames are written as deltas, cropped to what changed
+    since the frame before.
 
     Args:
         path: the path to the GIF file
         save_as (optional): Path of the resized gif. If not set, the original gif will be overwritten.
         resize_to (optional): new size of the gif. Format: (int, int). If not set, the original GIF will be resized to
                               half of its size.
+        resample (optional): name of the PIL resample filter to use.
+        cancel_check (optional): called between frames, if it returns True the resize stops with ResizeCancelled.
+        palette (optional): one of PALETTE_MODES
+        dither (optional): ordered dither onto shared palettes
+
+    Returns:
+        the number of frames written, runs of identical frames count once
     """
-    all_frames = extract_and_resize_frames(path, resize_to)
+    if palette not in PALETTE_MODES:
+        raise ValueError('unknown palette mode {}'.format(palette))
+    if not resize_to:
+        source_size = Image.open(path).size
+        resize_to = (source_size[0] // 2, source_size[1] // 2)
+
+    def checked(frames):
+        for frame in frames:
+            if cancel_check is not None and cancel_check():
+                raise ResizeCancelled(path)
+            yield frame
 
     if not save_as:
         save_as = path
+    # nothing watching save_as ever sees half a gif, and we're still reading the source while writing, so never
+    # stream over the top of it. A partial save_as is already safe to write to, the caller renames it
+    out_path = partial_path_for(save_as)
 
-    if len(all_frames) == 1:
+    try:
+        with open(out_path, 'wb') as f:
+            frames = checked(extract_and_resize_frames(path, resize_to, resample))
+            if palette == 'frame':
+                writer = GifStreamWriter(f, resize_to, loop=1000)
+                for frame, duration in frames:
+                    writer.write_frame(frame, duration=duration)
+                writer.close()
+            else:
+                # every gif has a first frame, so the writer always gets made
+                delta = None
+                for indexes, duration, table in map_scenes(frames, palette == 'scene', dither):
+                    if delta is None:
+                        # the first scene's palette goes in the global colour table, later ones carry their own
+                        writer = GifStreamWriter(f, resize_to, loop=1000, colour_table=table)
+                        delta = DeltaFrameWriter(writer, TRANSPARENT_INDEX)
+                    delta.write_frame(
+                        indexes, duration=duration, colour_table=None if table == writer.colour_table else table
+                    )
+                delta.close()
+    except BaseException:
+        # opening it may be what failed
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+
+    if out_path != save_as:
+        os.replace(out_path, save_as)
+
+    if writer.frame_count == 1:
         print("Warning: only 1 frame found")
-        all_frames[0].save(save_as, optimize=True)
-    else:
-        all_frames[0].save(save_as, optimize=True, save_all=True, append_images=all_frames[1:], loop=1000)
+    return writer.frame_count
 
 
-def analyseImage(path):
+def transcode_to_webp(path, save_as, quality=WEBP_QUALITY, method=WEBP_METHOD):
     """
-    Pre-process pass over the image to determine the mode (full or additive).
-    Necessary as assessing single frames isn't reliable. Need to know the mode
-    before processing all frames.
+    Re-encode a GIF as an animated WebP with the same frames and timing.
+
+    Pillow hands libwebp one frame at a time as it seeks through the GIF, so only the encoded output is held.
+
+    Returns:
+        the number of frames written
     """
+    _, frames = read_frame_headers(path)
     im = Image.open(path)
+    out_path = partial_path_for(save_as)
+    try:
+        im.save(
+            out_path, format='WEBP', save_all=True, loop=0, quality=quality, method=method,
+            duration=[frame.duration for frame in frames] or 0
+        )
+    except BaseException:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    if out_path != save_as:
+        os.replace(out_path, save_as)
+    return len(frames)
+
+
+def analyseImage(path):
+    """
+    Header only pass over the image to determine the mode (full or additive).
+    Reads the frame rectangles straight out of the GIF blocks, no pixels get decoded.
+    """
+    canvas_size, frames = read_frame_headers(path)
     results = {
-        'size': im.size,
+        'size': canvas_size,
         'mode': 'full',
     }
-    try:
-        while True:
-            if im.tile:
-                tile = im.tile[0]
-                update_region = tile[1]
-                update_region_dimensions = update_region[2:]
-                if update_region_dimensions != im.size:
-                    results['mode'] = 'partial'
-                    break
-            im.seek(im.tell() + 1)
-    except EOFError:
-        pass
+    for frame in frames:
+        if frame.size != canvas_size:
+            results['mode'] = 'partial'
+            break
     return results
 
 
-def extract_and_resize_frames(path, resize_to=None):
+def composite_frames(path):
+    """
+    Iterate the GIF, keeping the composited canvas in one RGBA buffer that gets updated in place.
+
+    PIL composites each frame onto the one before as it seeks, only the frame's tile and whatever the previous
+    frame's disposal cleared can have changed, so only that region is converted and compared against the buffer.
 
+    Yields:
+        (canvas, box of the pixels that changed or None if none did, duration in ms). The canvas is the same image
+        every time, the next frame overwrites it.
     """
-    Iterate the GIF, extracting each frame and resizing them
+    im = Image.open(path)
+    width, height = im.size
+    buffer = np.zeros((height, width, 4), dtype=np.uint8)
+    canvas = Image.frombuffer('RGBA', im.size, buffer, 'raw', 'RGBA', 0, 1)
+
+    frame = 0
+    previous_disposal, previous_extent = 0, None
+    while True:
+        if frame == 0 or not im.tile:
+            x0, y0, x1, y1 = 0, 0, width, height
+        else:
+            x0, y0, x1, y1 = im.tile[0][1]
+            if previous_disposal >= 2 and previous_extent is not None:
+                x0, y0 = min(x0, previous_extent[0]), min(y0, previous_extent[1])
+                x1, y1 = max(x1, previous_extent[2]), max(y1, previous_extent[3])
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+
+        box = None
+        if x1 > x0 and y1 > y0:
+            whole = (x0, y0, x1, y1) == (0, 0, width, height)
+            region = np.asarray((im if whole else im.crop((x0, y0, x1, y1))).convert('RGBA'))
+            # a pixel at a time rather than a channel at a time
+            changed = region.view(np.uint32)[:, :, 0] != buffer[y0:y1, x0:x1].view(np.uint32)[:, :, 0]
+            if frame == 0:
+                changed[:] = True
+            if changed.any():
+                rows = np.flatnonzero(changed.any(axis=1))
+                columns = np.flatnonzero(changed.any(axis=0))
+                box = (x0 + int(columns[0]), y0 + int(rows[0]), x0 + int(columns[-1]) + 1, y0 + int(rows[-1]) + 1)
+                buffer[y0:y1, x0:x1] = region
+
+        yield canvas, box, im.info.get('duration', 0)
+
+        previous_disposal = getattr(im, 'disposal_method', 0)
+        previous_extent = getattr(im, 'dispose_extent', None)
+        frame += 1
+        try:
+            im.seek(frame)
+        except EOFError:
+            return
+
+
+def extract_frames(path):
+    """
+    Iterate the GIF, compositing each frame at its source size.
+
+    Yields:
+        (RGBA frame, duration in ms), the frame is overwritten by the next one
+    """
+    for canvas, _, duration in composite_frames(path):
+        yield canvas, duration
 
+
+def reduce_factor(source_size, resize_to):
+    """
     Returns:
-        An array of all frames
+        (x, y) factor to reduce() by before resampling
     """
-    mode = analyseImage(path)['mode']
+    scale_x, scale_y = source_size[0] / resize_to[0], source_size[1] / resize_to[1]
+    return max(int(scale_x / REDUCING_GAP), 1), max(int(scale_y / REDUCING_GAP), 1)
 
-    im = Image.open(path)
 
+def extract_and_resize_frames(path, resize_to=None, resample=RESAMPLE):
+
+    """
+    Iterate the GIF, extracting each frame and resizing them
+
+    Big downscales get a reduce() by a whole factor first, which is a plain box average and far cheaper than
+    resampling at the source size. After the first frame, only the part of the output a changed source pixel can
+    reach through the filter gets resampled again, the rest of the resized frame is kept from the frame before.
+
+    Yields:
+        (resized RGBA frame, duration in ms), the frame is overwritten by the next one
+    """
+    source_size = Image.open(path).size
     if not resize_to:
-        resize_to = (im.size[0] // 2, im.size[1] // 2)
+        resize_to = (source_size[0] // 2, source_size[1] // 2)
+
+    factor = reduce_factor(source_size, resize_to)
+    resample_filter = getattr(Image.Resampling, resample)
+    reduced_size = (-(-source_size[0] // factor[0]), -(-source_size[1] // factor[1]))
+    reduced = Image.new('RGBA', reduced_size) if factor != (1, 1) else None
+    scale_x, scale_y = reduced_size[0] / resize_to[0], reduced_size[1] / resize_to[1]
+    # how far the filter reaches, in source pixels and in output pixels
+    support_x = FILTER_SUPPORT[resample] * max(scale_x, 1)
+    support_y = FILTER_SUPPORT[resample] * max(scale_y, 1)
+    margin_x, margin_y = int(support_x / scale_x) + 2, int(support_y / scale_y) + 2
+
+    resized = Image.new('RGBA', resize_to)
+    for canvas, box, duration in composite_frames(path):
+        if box is None:
+            yield resized, duration
+            continue
+
+        source = canvas
+        if reduced is not None:
+            # whole blocks only, so the region comes out exactly as it would from reducing the whole canvas
+            x0, y0 = box[0] // factor[0] * factor[0], box[1] // factor[1] * factor[1]
+            x1 = min(-(-box[2] // factor[0]) * factor[0], source_size[0])
+            y1 = min(-(-box[3] // factor[1]) * factor[1], source_size[1])
+            reduced.paste(canvas.reduce(factor, box=(x0, y0, x1, y1)), (x0 // factor[0], y0 // factor[1]))
+            box = (x0 // factor[0], y0 // factor[1], -(-x1 // factor[0]), -(-y1 // factor[1]))
+            source = reduced
+
+        out_x0 = max(int(box[0] / scale_x) - margin_x, 0)
+        out_y0 = max(int(box[1] / scale_y) - margin_y, 0)
+        out_x1 = min(int(box[2] / scale_x) + margin_x, resize_to[0])
+        out_y1 = min(int(box[3] / scale_y) + margin_y, resize_to[1])
+        # crop to just what the filter reads, so PIL only premultiplies the alpha of that much
+        crop_x0 = max(int(out_x0 * scale_x - support_x) - 1, 0)
+        crop_y0 = max(int(out_y0 * scale_y - support_y) - 1, 0)
+        crop_x1 = min(int(out_x1 * scale_x + support_x) + 2, source.size[0])
+        crop_y1 = min(int(out_y1 * scale_y + support_y) + 2, source.size[1])
+        crop = (crop_x0, crop_y0, crop_x1, crop_y1)
+        region = (source if crop == (0, 0) + source.size else source.crop(crop)).resize(
+            (out_x1 - out_x0, out_y1 - out_y0), resample_filter,
+            box=(
+                out_x0 * scale_x - crop_x0, out_y0 * scale_y - crop_y0,
+                out_x1 * scale_x - crop_x0, out_y1 * scale_y - crop_y0,
+            )
+        )
+        resized.paste(region, (out_x0, out_y0))
+        yield resized, duration
+
+
+def reset_peak_rss():
+    # linux lets us reset VmHWM, so each job in a long lived pool worker gets its own high water mark
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
-    i = 0
-    p = im.getpalette()
-    last_frame = im.convert('RGBA')
 
-    all_frames = []
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
+
+def source_changed(path, source_stat):
     try:
-        while True:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return True
+    return (stat.st_mtime_ns, stat.st_size) != source_stat
 
-            '''
-            If the GIF uses local colour tables, each frame will have its own palette.
-            If not, we need to apply the global palette to the new frame.
-            '''
-            if not im.getpalette():
-                im.putpalette(p)
 
-            new_frame = Image.new('RGBA', im.size)
+def try_and_resize_gif(screen_width, screen_height, path, save_as, source_stat=None, webp_save_as=None,
+                       palette=PALETTE):
+    """
+    Args:
+        source_stat (optional): (mtime_ns, size) the job was queued for. If the source gets deleted or rewritten
+                                mid job, the resize is abandoned with ResizeCancelled.
+        webp_save_as (optional): also transcode the resized gif to an animated WebP here, webp_seconds is None
+                                 in the stats if that didn't work out
+        palette (optional): how the resized frames get their colours, one of PALETTE_MODES
 
-            '''
-            Is this file a "partial"-mode GIF where frames update a region of a different size to the entire image?
-            If so, we need to construct the new frame by pasting it on top of the preceding frames.
-            '''
-            if mode == 'partial':
-                new_frame.paste(last_frame)
+    Returns:
+        job stats, frames is None if the gif was already the right size and just got copied
+    """
+    reset_peak_rss()
+    start = time.perf_counter()
+    frames = None
+    cancel_check = None
+    if source_stat is not None:
+        cancel_check = partial(source_changed, path, source_stat)
+    check_image_size = Image.open(path).size
+    if check_image_size[0] != screen_width or check_image_size[1] != screen_height:
+        frames = resize_gif(
+            path, save_as=save_as, resize_to=(screen_width, screen_height), cancel_check=cancel_check,
+            palette=palette
+        )
+    else:
+        out_path = partial_path_for(save_as)
+        try:
+            shutil.copyfile(path, out_path)
+        except BaseException:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            raise
+        if out_path != save_as:
+            os.replace(out_path, save_as)
+    stats = {
+        'frames': frames,
+        'seconds': time.perf_counter() - start,
+        'webp_seconds': None,
+    }
+    if webp_save_as is not None:
+        if cancel_check is not None and cancel_check():
+            os.remove(save_as)
+            raise ResizeCancelled(path)
+        try:
+            stats['webp_seconds'] = try_and_transcode_gif(save_as, webp_save_as)['seconds']
+        except Exception as e:
+            # the gif rendition is still good, clients just don't get offered a webp
+            print('Failed to transcode {} to webp: {}'.format(path, e))
+    stats['peak_rss'] = peak_rss()
+    return stats
+
+
+def try_and_transcode_gif(path, save_as):
+    """
+    Returns:
+        job stats for transcoding an already resized gif to WebP
+    """
+    start = time.perf_counter()
+    frames = transcode_to_webp(path, save_as)
+    return {
+        'frames': frames,
+        'seconds': time.perf_counter() - start,
+        'peak_rss': peak_rss(),
+    }
 
-            new_frame.paste(im, (0, 0), im.convert('RGBA'))
 
-            new_frame = new_frame.resize(size=resize_to, resample=Image.LANCZOS)
-            all_frames.append(new_frame)
+def format_stats(gif, stats):
+    webp = ''
+    if stats.get('webp_seconds') is not None:
+        webp = ', webp in {:.2f}s'.format(stats['webp_seconds'])
+    return '{}: {} frames in {:.2f}s{}, peak rss {:.1f} MB'.format(
+        gif, stats['frames'] or 'copied', stats['seconds'], webp, stats['peak_rss'] / (1024 * 1024)
+    )
 
-            i += 1
-            last_frame = new_frame
-            im.seek(im.tell() + 1)
-    except EOFError:
-        pass
 
-    return all_frames
+def warm_up():
+    # run once per pool worker at startup, so the first real job doesn't pay for the fork
+    return os.getpid()
 
 
-def try_and_resize_gif(screen_width, screen_height, gif):
-    path = os.path.join(DIR_PATH, gif)
-    check_image_size = Image.open(path).size
-    if check_image_size[0] != screen_width or check_image_size[1] != screen_height:
-        resize_gif(path, resize_to=(screen_width, screen_height))
+async def try_and_resize_gifs(gif_list, cache: Optional[RenditionCache] = None,
+                              pool: Optional[concurrent.futures.Executor] = None, size=SCREEN_SIZE):
+    """
+    Make sure every gif has a rendition at the given size, only doing the work for ones that are missing
 
+    Args:
+        pool (optional): executor to run the resizes on. If not set, a process pool is made just for this batch.
+        size (optional): rendition size, one of RENDITION_SIZES
 
-async def try_and_resize_gifs(gif_list):
+    Returns:
+        dict of gif -> rendition path, gifs smaller than size are left out
+    """
 
-    screen_width = 1280
-    screen_height = 1040
+    screen_width, screen_height = size
+
+    if cache is None:
+        cache = RenditionCache(encoding=ENCODING)
+
+    renditions = {}
+    pending = {}
+    for gif in gif_list:
+        path = os.path.join(DIR_PATH, gif)
+        try:
+            if exceeds(size, read_canvas_size(path)):
+                # the original is already the best there is at this size
+                continue
+        except ValueError:
+            # the resize says what's wrong with it
+            pass
+        rendition_path = cache.lookup(path, size, RESAMPLE)
+        webp_missing = WEBP_ENABLED and cache.lookup(path, size, RESAMPLE, extension='webp') is None
+        if rendition_path is not None and not webp_missing:
+            renditions[gif] = rendition_path
+        else:
+            pending[gif] = (path, cache.key_for(path, size, RESAMPLE))
+    cache.save()
+
+    if len(pending) == 0:
+        return renditions
 
     loop = asyncio.get_running_loop()
 
-    with concurrent.futures.ProcessPoolExecutor() as pool:
-        resize_calls = [
-            partial(try_and_resize_gif, screen_width, screen_height, gif)
-            for gif in gif_list
-        ]
-        futures_list = [loop.run_in_executor(pool, resize_call) for resize_call in resize_calls]
-        for coro in asyncio.as_completed(futures_list):
-            await coro
+    own_pool = pool is None
+    if own_pool:
+        pool = concurrent.futures.ProcessPoolExecutor()
+
+    try:
+        futures_map = {
+            loop.run_in_executor(
+                pool,
+                partial(
+                    try_and_resize_gif, screen_width, screen_height, path, cache.temp_path_for(key),
+                    webp_save_as=cache.temp_path_for(key, extension='webp') if WEBP_ENABLED else None
+                )
+            ): (gif, key)
+            for gif, (path, key) in pending.items()
+        }
+        for future, (gif, key) in futures_map.items():
+            try:
+                stats = await future
+            except Exception as e:
+                print('Failed to resize {}: {}'.format(gif, e))
+                continue
+            print(format_stats(gif, stats))
+            renditions[gif] = cache.commit(key)
+            if stats['webp_seconds'] is not None:
+                cache.commit(key, extension='webp')
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    # every size other batches made of these gifs is still in use too, not just this one
+    cache.evict(keep=[
+        rendition_path
+        for gif in gif_list
+        for rendition_size in set(RENDITION_SIZES) | {size}
+        for extension in RENDITION_EXTENSIONS
+        for rendition_path in [cache.lookup(os.path.join(DIR_PATH, gif), rendition_size, RESAMPLE, extension)]
+        if rendition_path is not None
+    ])
+    return renditions
 
 
 async def try_and_resize_all_gifs():
@@ -0,0 +1,239 @@
+import os
+import signal
+import asyncio
+import itertools
+import concurrent.futures
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from gif_stream import read_canvas_size
+from rendition_cache import RenditionCache, remove_stale_partials
+from resize_gifs import (
+    ENCODING, GIF_PATH, SCREEN_SIZE, RESAMPLE, WEBP_ENABLED, ResizeCancelled, exceeds, format_stats, size_name,
+    try_and_resize_gif, try_and_transcode_gif, warm_up
+)
+
+# leave a core for the server and the browser
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+ON_SCREEN_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+
+
+def _default_signals():
+    # forked workers inherit uvicorn's handlers, which only flag the server to stop, so SIGTERM would never end them.
+    # ctrl-c goes to the whole process group, the server shuts the pool down itself
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ResizeJob:
+
+    def __init__(self, gif_name: str):
+        self.gif_name = gif_name
+        self.done = asyncio.Event()
+
+
+class ResizeWorker:
+    """
+    Long lived process pool that keeps renditions in step with the gif folder.
+
+    Jobs are keyed by gif name, so a burst of watchdog events for one file only queues it once. A job that is
+    running when its file gets deleted or rewritten notices from the worker side (the source stat no longer
+    matches) and bails out, and the gif on screen jumps the queue.
+
+    A job makes the gif's renditions at every size in sizes. That starts as just SCREEN_SIZE, and grows when a
+    client turns up wanting another one, which queues every gif again. A gif never gets a rendition bigger than
+    itself, clients wanting one get the original.
+    """
+
+    cache = RenditionCache(encoding=ENCODING)
+    on_screen: Optional[str] = None
+    # used as an ordered set, the screen's own size goes first
+    sizes: Dict[Tuple[int, int], None] = {SCREEN_SIZE: None}
+
+    _on_ready: Optional[Callable[[str], None]] = None
+    _in_use: Callable[[], Iterable[str]] = list
+    _pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+    _queue: Optional[asyncio.PriorityQueue] = None
+    _queued: Dict[str, int] = {}
+    _running: Dict[str, ResizeJob] = {}
+    _order = itertools.count()
+    _dispatchers: List[asyncio.Task] = []
+
+    @classmethod
+    async def Startup(cls, on_ready: Callable[[str], None], in_use: Callable[[], Iterable[str]] = list,
+                      workers: int = DEFAULT_WORKERS):
+        """
+        Args:
+            on_ready: called with the gif name whenever a gif's rendition is ready, or the gif went away
+            in_use (optional): returns the rendition paths clients can currently be sent, eviction leaves them be
+            workers (optional): number of pool processes
+        """
+        cls._on_ready = on_ready
+        cls._in_use = in_use
+        cls._queue = asyncio.PriorityQueue()
+        cls._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_default_signals)
+        loop = asyncio.get_running_loop()
+        # fork every worker now, before the default executor, watchdog and gpio threads exist and before anyone is
+        # waiting on a gif
+        await asyncio.gather(*[loop.run_in_executor(cls._pool, warm_up) for _ in range(workers)])
+        for partial_path in await loop.run_in_executor(None, remove_stale_partials, cls.cache.cache_path):
+            print('Removed {}, left over from a resize that never finished'.format(partial_path))
+        cls._dispatchers = [asyncio.create_task(cls._Dispatch()) for _ in range(workers)]
+
+    @classmethod
+    def Shutdown(cls):
+        for dispatcher in cls._dispatchers:
+            dispatcher.cancel()
+        cls._dispatchers = []
+        if cls._pool is not None:
+            # a resize can run for a while, don't hold up the server stopping for it. Whatever it was writing is
+            # only a partial
+            for process in list(cls._pool._processes.values()):
+                process.terminate()
+            cls._pool.shutdown(wait=True, cancel_futures=True)
+            cls._pool = None
+        cls.cache.save()
+
+    @classmethod
+    def Submit(cls, gif_name: str):
+        if gif_name in cls._queued:
+            return
+        cls._queued[gif_name] = next(cls._order)
+        cls._Enqueue(gif_name)
+
+    @classmethod
+    def Cancel(cls, gif_name: str):
+        cls._queued.pop(gif_name, None)
+        # anything still running for this gif sees the file is gone and stops on its own
+        if gif_name not in cls._running:
+            cls._on_ready(gif_name)
+
+    @classmethod
+    def SetOnScreen(cls, gif_name: Optional[str]):
+        cls.on_screen = gif_name
+        if gif_name in cls._queued:
+            # push it again at the front, the old entry gets skipped when it comes up
+            cls._Enqueue(gif_name)
+
+    @classmethod
+    def AddSize(cls, size: Tuple[int, int], gif_names: Iterable[str]):
+        """
+        Start keeping renditions at size too, for the gifs in gif_names and any that turn up after.
+        """
+        if size in cls.sizes:
+            return
+        cls.sizes[size] = None
+        # the ones that already have the other sizes are cache hits, only the new size gets made. A running job
+        # already picked its sizes, so it goes again too
+        for gif_name in itertools.chain(gif_names, list(cls._running)):
+            cls.Submit(gif_name)
+
+    @classmethod
+    def IsPending(cls, gif_name: str) -> bool:
+        return gif_name in cls._queued or gif_name in cls._running
+
+    @classmethod
+    def _Enqueue(cls, gif_name: str):
+        priority = ON_SCREEN_PRIORITY if gif_name == cls.on_screen else DEFAULT_PRIORITY
+        cls._queue.put_nowait((priority, cls._queued[gif_name], gif_name))
+
+    @classmethod
+    async def _Dispatch(cls):
+        while True:
+            _, order, gif_name = await cls._queue.get()
+            if cls._queued.get(gif_name) != order:
+                continue
+            # one job per gif at a time, a rewrite waits for the stale job to notice and bail
+            running = cls._running.get(gif_name)
+            if running is not None:
+                await running.done.wait()
+            if cls._queued.get(gif_name) != order:
+                continue
+            del cls._queued[gif_name]
+
+            job = ResizeJob(gif_name)
+            cls._running[gif_name] = job
+            try:
+                await cls._Run(gif_name)
+            except Exception as e:
+                # a dispatcher that dies takes a worker's worth of resizing with it, for good
+                print('Failed to resize {}: {}'.format(gif_name, e))
+            finally:
+                del cls._running[gif_name]
+                job.done.set()
+            if not cls.IsPending(gif_name):
+                cls._on_ready(gif_name)
+
+    @classmethod
+    async def _Run(cls, gif_name: str):
+        path = os.path.join(GIF_PATH, gif_name)
+        loop = asyncio.get_running_loop()
+        keep = []
+        try:
+            stat = os.stat(path)
+            source_size = await cls._SourceSize(path)
+            for size in list(cls.sizes):
+                if source_size is not None and exceeds(size, source_size):
+                    continue
+                key = await cls._RunSize(gif_name, path, stat, size)
+                if key is not None:
+                    keep += [cls.cache.path_for(key), cls.cache.path_for(key, extension='webp')]
+            # every gif's renditions that clients can be sent survive too, not just this job's, or they'd 404.
+            # Evicting stats the whole cache, keep it off the loop
+            await loop.run_in_executor(None, partial(cls.cache.evict, keep=keep + list(cls._in_use())))
+        except (FileNotFoundError, ResizeCancelled):
+            pass
+        finally:
+            await loop.run_in_executor(None, cls.cache.save)
+
+    @staticmethod
+    async def _SourceSize(path: str) -> Optional[Tuple[int, int]]:
+        """
+        Returns:
+            the gif's canvas size, or None if it isn't readable as a gif, the resize can say what's wrong with it
+        """
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, read_canvas_size, path)
+        except ValueError:
+            return None
+
+    @classmethod
+    async def _RunSize(cls, gif_name: str, path: str, stat: os.stat_result, size: Tuple[int, int]) -> Optional[str]:
+        """
+        Returns:
+            the rendition key, or None if making it failed
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            # hashing a big gif on the event loop would stall every socket, do it on a thread
+            key = await loop.run_in_executor(None, cls.cache.key_for, path, size, RESAMPLE)
+            gif_hit = cls.cache.lookup(path, size, RESAMPLE) is not None
+            webp_missing = WEBP_ENABLED and cls.cache.lookup(path, size, RESAMPLE, extension='webp') is None
+            if gif_hit and not webp_missing:
+                return key
+            webp_save_as = cls.cache.temp_path_for(key, extension='webp') if webp_missing else None
+            if gif_hit:
+                # the webp got evicted on its own, it only needs transcoding again
+                stats = await loop.run_in_executor(
+                    cls._pool, partial(try_and_transcode_gif, cls.cache.path_for(key), webp_save_as)
+                )
+                stats['webp_seconds'], stats['seconds'] = stats['seconds'], 0.0
+            else:
+                resize_call = partial(
+                    try_and_resize_gif, size[0], size[1], path, cls.cache.temp_path_for(key),
+                    source_stat=(stat.st_mtime_ns, stat.st_size), webp_save_as=webp_save_as
+                )
+                stats = await loop.run_in_executor(cls._pool, resize_call)
+                cls.cache.commit(key)
+            if stats['webp_seconds'] is not None:
+                cls.cache.commit(key, extension='webp')
+            print(format_stats('{} at {}'.format(gif_name, size_name(size)), stats))
+            return key
+        except (FileNotFoundError, ResizeCancelled):
+            raise
+        except Exception as e:
+            # clients still get the gif, at another size or the original instead of a rendition
+            print('Failed to resize {} to {}: {}'.format(gif_name, size_name(size), e))
+            return None
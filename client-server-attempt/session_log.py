@@ -0,0 +1,51 @@
+import os
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+# how many state changes a client can miss and still catch up without a full snapshot
+MAX_REPLAY = 256
+
+# renders a logged change for a client at a rendition size, None if there's nothing in it for that size
+Render = Callable[[Tuple[int, int]], Optional[str]]
+
+
+class SessionLog:
+    """
+    Server side history of everything that changed what the screens show.
+
+    Every change gets the next sequence number, which goes out in its message, and is kept for the last MAX_REPLAY
+    changes. A client that drops off reconnects with the epoch and the last seq it saw, and gets sent just the
+    changes after that instead of a whole snapshot. The epoch is new every time the server starts, a seq from
+    another run means nothing.
+    """
+
+    epoch: str = os.urandom(4).hex()
+    seq: int = 0
+
+    _entries: Deque[Tuple[int, Render]] = deque(maxlen=MAX_REPLAY)
+
+    @classmethod
+    def Next(cls) -> int:
+        cls.seq += 1
+        return cls.seq
+
+    @classmethod
+    def Append(cls, seq: int, render: Render):
+        cls._entries.append((seq, render))
+
+    @classmethod
+    def Since(cls, epoch: Optional[str], seq: Optional[int]) -> Optional[List[Render]]:
+        """
+        Returns:
+            the changes after seq in order, or None if they're not all here any more and the client needs a
+            snapshot
+        """
+        if epoch != cls.epoch or seq is None or seq < 0 or seq > cls.seq:
+            return None
+        missed = [render for entry_seq, render in cls._entries if entry_seq > seq]
+        if len(missed) > 0 and cls._entries[0][0] > seq + 1:
+            # the oldest ones it's missing already fell off the end
+            return None
+        if len(missed) == 0 and seq < cls.seq:
+            return None
+        return missed
@@ -11,13 +11,15 @@ setup(
     packages=find_namespace_packages(where="src"),
     install_requires=[
         'fastapi',
-        'starlette',
+        # FileResponse handles Range / If-Range from here on
+        'starlette>=0.39',
         'uvicorn[standard]',
         'aiofiles',
         'watchdog',
         'gpiozero',
         'pynput',
-        'janus',
-        'pyautogui'
+        'pyautogui',
+        'Pillow',
+        'numpy'
     ]
 )
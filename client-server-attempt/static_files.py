@@ -0,0 +1,192 @@
+import os
+import mmap
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+from urllib.parse import parse_qs
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Receive, Scope, Send
+
+# a year, the most anything honours. the url changes whenever the content does, so it never goes stale
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# keep it, but check before every use, which costs a 304 and no body when nothing changed
+REVALIDATE = 'no-cache'
+
+# every screen asks for the same handful of gifs, keep the ones that fit in memory whole
+HOT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+HOT_FILE_MAX_BYTES = 8 * 1024 * 1024
+# anything bigger goes out of a memory map in chunks this size, instead of a thread hop per 64 KB read
+MAPPED_CHUNK_SIZE = 1024 * 1024
+
+
+def etag_matches(etag: str, request_headers: Headers) -> bool:
+    if_none_match = request_headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _map_file(path: str) -> mmap.mmap:
+    with open(path, 'rb') as f:
+        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # fault it in here on the worker thread, not page by page on the event loop
+    if hasattr(file_map, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+        file_map.madvise(mmap.MADV_WILLNEED)
+    return file_map
+
+
+class HotAssetCache:
+    """
+    Size bounded, least recently used first out, cache of whole files, keyed by path and checked against the
+    (mtime, size) StaticFiles already stat'd, so a stale entry is never served. Only touched from the event loop.
+    """
+
+    def __init__(self, max_bytes: int = HOT_CACHE_MAX_BYTES, max_file_bytes: int = HOT_FILE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[Tuple[int, int], bytes]]' = OrderedDict()
+
+    def fits(self, stat: os.stat_result) -> bool:
+        return stat.st_size <= self.max_file_bytes
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[bytes]:
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != (stat.st_mtime_ns, stat.st_size):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, path: str, stat: os.stat_result, body: bytes):
+        self.invalidate(path)
+        self._entries[path] = ((stat.st_mtime_ns, stat.st_size), body)
+        self.nbytes += len(body)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def invalidate(self, path: str):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.nbytes -= len(entry[1])
+
+
+class HotFileResponse(FileResponse):
+    """
+    FileResponse for a plain GET: the body comes out of the HotAssetCache when it fits, otherwise it's sent with
+    the server's sendfile (pathsend) if it has one, or straight out of a memory map if it doesn't.
+    """
+
+    def __init__(self, path: str, stat_result: os.stat_result, headers: dict, hot_cache: HotAssetCache):
+        super().__init__(path, headers=headers, stat_result=stat_result)
+        self.hot_cache = hot_cache
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if 'http.response.pathsend' in scope.get('extensions', {}) and not self.hot_cache.fits(self.stat_result):
+            await super().__call__(scope, receive, send)
+            return
+
+        path = str(self.path)
+        if self.hot_cache.fits(self.stat_result):
+            body = self.hot_cache.get(path, self.stat_result)
+            if body is None:
+                body = await anyio.to_thread.run_sync(_read_file, path)
+                if len(body) != self.stat_result.st_size:
+                    # rewritten since the stat, the headers don't match it any more
+                    await super().__call__(scope, receive, send)
+                    return
+                self.hot_cache.put(path, self.stat_result, body)
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        file_map = await anyio.to_thread.run_sync(_map_file, path)
+        try:
+            if len(file_map) != self.stat_result.st_size:
+                await super().__call__(scope, receive, send)
+                return
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            for start in range(0, len(file_map), MAPPED_CHUNK_SIZE):
+                # asgi wants bytes, slicing the map copies the chunk out so nothing holds on to it after
+                await send({
+                    'type': 'http.response.body',
+                    'body': file_map[start:start + MAPPED_CHUNK_SIZE],
+                    'more_body': True,
+                })
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            file_map.close()
+
+
+class ContentHashedStaticFiles(StaticFiles):
+    """
+    StaticFiles with strong ETags taken from the file's content hash, and far future caching for urls that can't
+    go stale: a content addressed mount (the hash is in the file name), or a url whose ?v= is the current hash.
+
+    Range and If-Range are left to FileResponse, the strong ETag is what makes If-Range safe to honour. Plain
+    GETs go through HotFileResponse when there's a hot_cache.
+    """
+
+    def __init__(self, *args, content_hash: Callable[[str, os.stat_result], Optional[str]],
+                 content_addressed: bool = False, hot_cache: Optional[HotAssetCache] = None, **kwargs):
+        """
+        Args:
+            content_hash: (path, stat) -> content hash, or None if it isn't known without reading the whole file
+            content_addressed (optional): every file name already changes with its content
+            hot_cache (optional): in memory cache to serve plain GETs out of, can be shared between mounts
+        """
+        super().__init__(*args, **kwargs)
+        self.content_hash = content_hash
+        self.content_addressed = content_addressed
+        self.hot_cache = hot_cache
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        headers = {'cache-control': REVALIDATE}
+        content_hash = self.content_hash(str(full_path), stat_result)
+        if content_hash is not None:
+            headers['etag'] = '"{}"'.format(content_hash)
+            version = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('v', [None])[0]
+            if self.content_addressed or version == content_hash:
+                headers['cache-control'] = IMMUTABLE
+
+        request_headers = Headers(scope=scope)
+        plain_get = scope['method'] == 'GET' and status_code == 200 and 'range' not in request_headers
+        if self.hot_cache is not None and plain_get:
+            response = HotFileResponse(str(full_path), stat_result, headers, self.hot_cache)
+        else:
+            response = FileResponse(full_path, status_code=status_code, headers=headers, stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+class MemoryFile:
+    """
+    A small file read once at startup and served straight from memory with a content ETag.
+    """
+
+    def __init__(self, path: str, media_type: str):
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.media_type = media_type
+        self.etag = '"{}"'.format(hashlib.blake2b(self.body, digest_size=16).hexdigest())
+
+    def response(self, request_headers: Headers) -> Response:
+        headers = {'etag': self.etag, 'cache-control': REVALIDATE}
+        if etag_matches(self.etag, request_headers):
+            return Response(status_code=304, headers=headers)
+        return Response(self.body, media_type=self.media_type, headers=headers)
@@ -4,19 +4,90 @@ const MESSAGE_ACTIONS = {
     POWER_OFF: 'POWER_OFF',
     TOGGLE_GIF: 'TOGGLE_GIF',
     LOAD_GIFS: 'LOAD_GIFS',
-    NO_GIFS: 'NO_GIFS'
+    GIFS_DELTA: 'GIFS_DELTA',
+    NO_GIFS: 'NO_GIFS',
+    CLOCK: 'CLOCK',
+    PHASE: 'PHASE'
 }
 
+const CLIENT_MESSAGES = {
+    ACK: 'ACK',
+    VIEWPORT: 'VIEWPORT',
+    FIRST_FRAME: 'FIRST_FRAME',
+    CLOCK: 'CLOCK',
+    APPLIED: 'APPLIED'
+}
+
+const GIF_WRAPPER_CLASS = 'gif-wrapper'
+
+// a window drag fires resize constantly, only tell the server once it settles
+const VIEWPORT_DEBOUNCE_MS = 500
+
+// reconnect right away after a blip, backing off to this if the server stays away
+const RECONNECT_MIN_MS = 100
+const RECONNECT_MAX_MS = 5000
+
+// a few pings to work out the server's clock on connecting, then one every so often to follow the drift
+const CLOCK_BURST = 5
+const CLOCK_BURST_SPACING_MS = 100
+const CLOCK_INTERVAL_MS = 10000
+// the offset comes from the quickest of the last few round trips, the slow ones sat in a queue somewhere
+const CLOCK_SAMPLES = 8
+
+let socket = null
+let sentFirstFrame = false
+let reconnectDelay = RECONNECT_MIN_MS
+// where we got to in the server's session, sent back on reconnect so only what we missed gets replayed
+let sessionEpoch = null
+let lastSeq = null
+// a resumed session keeps the gifs we already have, they have to be for the viewport we connected with
+let connectedViewport = null
+// { rtt, offset } of the last CLOCK_SAMPLES pings
+let clockSamples = []
+// the server's clock minus performance.now(), in ms, null until the first ping comes back
+let clockOffset = null
+let clockInterval = null
+// scheduled changes that came in before we knew the server's clock, the first ping back sorts them out
+let waitingForClock = []
+// the phase resync we're waiting on, the server sends it again to anyone joining in the meantime
+let pendingPhaseAt = null
+
 const HandleMessage = (event) => {
+    const received = performance.now()
     const serverMessage = JSON.parse(event.data)
-    const { message = false, gifs = [] } = serverMessage
+    const { message = false, id = null, seq = null, epoch = null, at = null } = serverMessage
     if (
         message === false ||
         !Object.hasOwnProperty.call(MESSAGE_ACTIONS, message)
     ) {
         console.error('AHHHHH SHIT, THE SERVER RETURNED SOME GARBAGE D:')
     }
+    if (epoch !== null) {
+        if (epoch !== sessionEpoch) {
+            // another server, or ours restarted, either way the clock we worked out might not be its clock
+            clockSamples = []
+            clockOffset = null
+        }
+        sessionEpoch = epoch
+    }
+    if (seq !== null) {
+        lastSeq = seq
+    }
     const messageAction = MESSAGE_ACTIONS[message]
+    if (messageAction === MESSAGE_ACTIONS.CLOCK) {
+        HandleClock(serverMessage, received)
+    } else if (at !== null) {
+        ScheduleMessage(messageAction, serverMessage, received)
+    } else {
+        ApplyMessage(messageAction, serverMessage)
+        if (id !== null) {
+            AckRender(id, received)
+        }
+    }
+}
+
+const ApplyMessage = (messageAction, serverMessage) => {
+    const { gifs = [], current = null } = serverMessage
     switch(messageAction) {
         case MESSAGE_ACTIONS.POWER_ON:
             TurnPowerOn()
@@ -25,10 +96,13 @@ const HandleMessage = (event) => {
             TurnPowerOff()
             break
         case MESSAGE_ACTIONS.TOGGLE_GIF:
-            SwitchGif()
+            SwitchGif(current)
             break
         case MESSAGE_ACTIONS.LOAD_GIFS:
-            TryLoadGifs(gifs)
+            TryLoadGifs(gifs, current)
+            break
+        case MESSAGE_ACTIONS.GIFS_DELTA:
+            ApplyGifsDelta(serverMessage)
             break
         case MESSAGE_ACTIONS.NO_GIFS:
             ShowNoGifs()
@@ -38,6 +112,187 @@ const HandleMessage = (event) => {
     }
 }
 
+// in sync mode the server says when, in its own clock, and every screen on the wall does it at that moment
+const ScheduleMessage = (messageAction, serverMessage, received) => {
+    const { current = null, id = null, at } = serverMessage
+    const isPhase = messageAction === MESSAGE_ACTIONS.PHASE
+    if (isPhase) {
+        if (at === pendingPhaseAt) {
+            return
+        }
+        pendingPhaseAt = at
+    }
+    // both start the gif over from its first frame, which takes a fetch and a decode, so get that going now
+    let restart = null
+    if (isPhase || messageAction === MESSAGE_ACTIONS.TOGGLE_GIF) {
+        restart = PrepareRestart(current)
+    }
+    RunAt(at, () => {
+        if (isPhase) {
+            // a toggle got in first, the next resync is for whatever is on screen now
+            const shown = document.querySelector('picture.show')
+            if (shown === null || shown.dataset.name !== current) {
+                return
+            }
+        } else {
+            ApplyMessage(messageAction, serverMessage)
+        }
+        const restarted = restart === null ? Promise.resolve() : restart.then(swap => swap())
+        restarted.then(() => {
+            ReportApplied(at)
+            if (id !== null) {
+                AckRender(id, received)
+            }
+        })
+    })
+}
+
+// at is the server's clock, a screen that got the message too late does it straight away
+const RunAt = (at, run) => {
+    if (clockOffset === null) {
+        waitingForClock.push([at, run])
+        return
+    }
+    const delay = at - clockOffset - performance.now()
+    if (delay > 0) {
+        setTimeout(run, delay)
+    } else {
+        run()
+    }
+}
+
+const SendClock = () => {
+    if (socket === null || socket.readyState !== WebSocket.OPEN) {
+        return
+    }
+    socket.send(JSON.stringify({ message: CLIENT_MESSAGES.CLOCK, sent: performance.now() }))
+}
+
+const StartClockSync = () => {
+    clearInterval(clockInterval)
+    for (let i = 0; i < CLOCK_BURST; i++) {
+        setTimeout(SendClock, i * CLOCK_BURST_SPACING_MS)
+    }
+    clockInterval = setInterval(SendClock, CLOCK_INTERVAL_MS)
+}
+
+// NTP style, the server stamps its clock as it answers, so it was that time about halfway through the round trip
+const HandleClock = ({ sent = null, server = null }, received) => {
+    if (sent === null || server === null) {
+        return
+    }
+    clockSamples.push({ rtt: received - sent, offset: server - (sent + received) / 2 })
+    clockSamples = clockSamples.slice(-CLOCK_SAMPLES)
+    clockOffset = clockSamples.reduce((best, sample) => sample.rtt < best.rtt ? sample : best).offset
+    const waiting = waitingForClock
+    waitingForClock = []
+    waiting.forEach(([at, run]) => RunAt(at, run))
+}
+
+// when the change hit the screen in the server's clock, it works out how far apart the screens were from that
+const ReportApplied = (at) => {
+    requestAnimationFrame(() => requestAnimationFrame(() => {
+        if (socket === null || socket.readyState !== WebSocket.OPEN || clockOffset === null) {
+            return
+        }
+        socket.send(JSON.stringify({
+            message: CLIENT_MESSAGES.APPLIED,
+            at,
+            shown: performance.now() + clockOffset
+        }))
+    }))
+}
+
+// a gif only starts over from its first frame as a new image, the same url carries on wherever it had got to. A
+// blob url is a new image without going back to the server, the gif itself comes out of the browser's cache.
+// Resolves to a function that swaps it in
+const PrepareRestart = (name) => {
+    const gifWrapper = document.querySelector(`body > div.${GIF_WRAPPER_CLASS}`)
+    const picture = gifWrapper === null ? undefined : FindGif(gifWrapper, name)
+    const img = picture === undefined ? null : picture.querySelector('img')
+    if (img === null || (img.currentSrc || img.src) === '') {
+        return Promise.resolve(() => {})
+    }
+    return fetch(img.currentSrc || img.src)
+        .then(response => response.blob())
+        .then(blob => {
+            const restarted = document.createElement('img')
+            restarted.src = URL.createObjectURL(blob)
+            return restarted.decode().catch(() => {}).then(() => () => {
+                // a delta swapped the whole <picture> out in the meantime
+                const playing = picture.querySelector('img')
+                if (!picture.isConnected || playing === null) {
+                    URL.revokeObjectURL(restarted.src)
+                    return
+                }
+                // it's whichever format the browser picked already, the <source>s have done their job
+                picture.querySelectorAll('source').forEach(source => source.remove())
+                playing.replaceWith(restarted)
+                if (playing.src.startsWith('blob:')) {
+                    URL.revokeObjectURL(playing.src)
+                }
+            })
+        })
+        .catch((e) => {
+            console.error(e)
+            return () => {}
+        })
+}
+
+// tell the server when the change actually hit the screen, it works out the per hop latencies
+const AckRender = (id, received) => {
+    // the first callback runs before the paint, the second one right after it
+    requestAnimationFrame(() => requestAnimationFrame(() => {
+        if (socket === null || socket.readyState !== WebSocket.OPEN) {
+            return
+        }
+        socket.send(JSON.stringify({
+            message: CLIENT_MESSAGES.ACK,
+            id,
+            received,
+            rendered: performance.now()
+        }))
+    }))
+}
+
+// the server picks which size of the gifs we get from how many device pixels we have
+const ViewportQuery = () => {
+    return `width=${window.innerWidth}&height=${window.innerHeight}&dpr=${window.devicePixelRatio || 1}`
+}
+
+let viewportTimeout = null
+
+const SendViewport = () => {
+    clearTimeout(viewportTimeout)
+    viewportTimeout = setTimeout(() => {
+        if (socket === null || socket.readyState !== WebSocket.OPEN) {
+            return
+        }
+        socket.send(JSON.stringify({
+            message: CLIENT_MESSAGES.VIEWPORT,
+            width: window.innerWidth,
+            height: window.innerHeight,
+            devicePixelRatio: window.devicePixelRatio || 1
+        }))
+        connectedViewport = ViewportQuery()
+    }, VIEWPORT_DEBOUNCE_MS)
+}
+
+// once per page load, for the server's boot timeline
+const ReportFirstFrame = () => {
+    const img = document.querySelector('picture.show img')
+    if (sentFirstFrame || img === null) {
+        return
+    }
+    sentFirstFrame = true
+    img.decode().catch(() => {}).then(() => requestAnimationFrame(() => requestAnimationFrame(() => {
+        if (socket === null || socket.readyState !== WebSocket.OPEN) {
+            return
+        }
+        socket.send(JSON.stringify({ message: CLIENT_MESSAGES.FIRST_FRAME }))
+    })))
+}
+
 const TurnPowerOn = () => {
     document.body.classList.remove('hide')
 }
@@ -46,8 +301,9 @@ const TurnPowerOff = () => {
     document.body.classList.add('hide')
 }
 
-const SwitchGif = () => {
-    const gifs = Array.from(document.querySelectorAll('img'))
+// the server says which gif is current, stepping to the next one is only for when we don't have it
+const SwitchGif = (current = null) => {
+    const gifs = Array.from(document.querySelectorAll('picture'))
     if (gifs.length === 0) {
         console.error('AHHHHH SHIT, THERE ARE NO GIFS IN THIS BITCH D:')
         return
@@ -56,33 +312,110 @@ const SwitchGif = () => {
         return
     }
     const currentGif = gifs.findIndex(gif => gif.classList.contains('show'))
-    const nextGif = (currentGif + 1) % gifs.length
-    gifs[currentGif].classList.remove('show')
+    let nextGif = gifs.findIndex(gif => gif.dataset.name === current)
+    if (nextGif === -1) {
+        nextGif = (currentGif + 1) % gifs.length
+    }
+    if (currentGif !== -1) {
+        gifs[currentGif].classList.remove('show')
+    }
     gifs[nextGif].classList.add('show')
 }
 
-const TryLoadGifs = (gifPaths = []) => {
-    if (!Array.isArray(gifPaths)) {
-        console.error('AHHHHH SHIT, THE SERVER DIDN\'T SEND OVER AN ARRAY OF GIF PATHS D:')
-    } else if (gifPaths.length === 0) {
+// the browser plays the first <source> type it supports, and falls back to the gif in the <img>
+const CreateGif = ({ name, url, sources = [] }) => {
+    const picture = document.createElement('picture');
+    picture.dataset.name = name;
+    sources.forEach(({ url: sourceUrl, type }) => {
+        const source = document.createElement('source');
+        source.srcset = sourceUrl;
+        source.type = type;
+        picture.appendChild(source);
+    })
+    const img = document.createElement('img');
+    img.src = url;
+    picture.appendChild(img);
+    return picture
+}
+
+const TryLoadGifs = (gifs = [], current = null) => {
+    if (!Array.isArray(gifs)) {
+        console.error('AHHHHH SHIT, THE SERVER DIDN\'T SEND OVER AN ARRAY OF GIFS D:')
+    } else if (gifs.length === 0) {
         console.error('AHHHHH SHIT, THE SERVER SENT THE WRONG MESSAGE TYPE... MAYBE? D:')
     }
     let gifHolder = new DocumentFragment();
     let gifWrapper = document.createElement('div')
+    gifWrapper.classList.add(GIF_WRAPPER_CLASS)
     gifHolder.appendChild(gifWrapper)
-    gifPaths.forEach((filePath, index) => {
-        const img = document.createElement('img');
-        img.src = filePath;
-        if (index === 0) {
-            img.classList.add('show');
+    const currentIndex = Math.max(gifs.findIndex(gif => gif.name === current), 0)
+    gifs.forEach((gif, index) => {
+        const picture = CreateGif(gif);
+        if (index === currentIndex) {
+            picture.classList.add('show');
         }
-        gifWrapper.appendChild(img);
+        gifWrapper.appendChild(picture);
     })
     const replaceElement = document.querySelector('body > div')
     replaceElement.parentNode.replaceChild(gifHolder, replaceElement);
+    ReportFirstFrame()
+}
+
+const FindGif = (gifWrapper, name) => {
+    return Array.from(gifWrapper.children).find(picture => picture.dataset.name === name)
+}
+
+// only touch the <picture>s that changed, so the rest keep playing
+const ApplyGifsDelta = ({ added = [], removed = [], changed = [], current = null }) => {
+    const gifWrapper = document.querySelector(`body > div.${GIF_WRAPPER_CLASS}`)
+    if (gifWrapper === null) {
+        TryLoadGifs(added, current)
+        return
+    }
+    removed.forEach(name => {
+        const picture = FindGif(gifWrapper, name)
+        if (picture === undefined) {
+            return
+        }
+        // same rule as the server, if the gif on screen goes the next one takes its place
+        if (picture.classList.contains('show')) {
+            const nextGif = picture.nextElementSibling || gifWrapper.firstElementChild
+            nextGif.classList.add('show')
+        }
+        picture.remove()
+    })
+    changed.forEach(gif => {
+        const picture = FindGif(gifWrapper, gif.name)
+        if (picture === undefined) {
+            return
+        }
+        // swap the whole <picture>, so the browser picks a format again from the new sources
+        const replacement = CreateGif(gif)
+        if (picture.classList.contains('show')) {
+            replacement.classList.add('show')
+        }
+        picture.replaceWith(replacement)
+    })
+    added.forEach(gif => {
+        const picture = CreateGif(gif)
+        if (gifWrapper.querySelector('picture.show') === null) {
+            picture.classList.add('show')
+        }
+        gifWrapper.appendChild(picture)
+    })
+    const shown = gifWrapper.querySelector('picture.show')
+    if (current !== null && (shown === null || shown.dataset.name !== current)) {
+        SwitchGif(current)
+    }
+    ReportFirstFrame()
 }
 
 const ShowNoGifs = () => {
+    // the last gif went, take it off screen. An empty div keeps the place for TryLoadGifs when some turn up again
+    const gifWrapper = document.querySelector(`body > div.${GIF_WRAPPER_CLASS}`)
+    if (gifWrapper !== null) {
+        gifWrapper.replaceWith(document.createElement('div'))
+    }
     window.confirm(
         'AGHHHH, NO GIFFS LOCATED ~/sparky-screen/gifs D: D:\n Load some GIFS and restart'
     )
@@ -94,11 +427,43 @@ const ShowGenericError = () => {
     )
 }
 
+const Connect = () => {
+    const viewport = ViewportQuery()
+    let query = viewport
+    if (sessionEpoch !== null && lastSeq !== null && viewport === connectedViewport) {
+        query += `&epoch=${sessionEpoch}&seq=${lastSeq}`
+    }
+    connectedViewport = viewport
+    // the page always comes from the server, and a screen in a wall might not be the one running it
+    socket = new WebSocket(`ws://${window.location.host}/ws?${query}`)
+    socket.onopen = () => {
+        reconnectDelay = RECONNECT_MIN_MS
+        StartClockSync()
+    }
+    socket.onmessage = HandleMessage
+    socket.onclose = ScheduleReconnect
+}
+
+// keep what's on screen playing and try again, a room of screens spreads out so they don't all hit at once
+const ScheduleReconnect = () => {
+    socket = null
+    const delay = reconnectDelay * (0.5 + Math.random() / 2)
+    reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS)
+    setTimeout(() => {
+        try {
+            Connect()
+        } catch (e) {
+            console.error(e)
+            ScheduleReconnect()
+        }
+    }, delay)
+}
+
 window.addEventListener('DOMContentLoaded', () => {
     try {
-        const socket = new WebSocket('ws://localhost:42069/ws')
-        socket.onmessage = HandleMessage
-        socket.onclose = ShowGenericError
+        Connect()
+        // going fullscreen or dragging to another monitor changes both
+        window.addEventListener('resize', SendViewport)
     } catch (e) {
         console.error(e)
         ShowGenericError()
@@ -1,11 +1,12 @@
 
 import os
 from pathlib import Path
-from typing import List, Callable
+from typing import Dict, List, Callable, Tuple
 import re
 
 import kivy
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.image import AsyncImage
 from kivy.uix.popup import Popup
@@ -26,6 +27,9 @@ kivy.require('2.0.0')
 GIF_PATH = os.path.join(Path.home(), '.config', 'sparky-screen')
 IS_GIF = re.compile('.+?.gif$', re.IGNORECASE)
 
+# seconds of watchdog events that get folded into one reload
+RELOAD_DELAY = 0.5
+
 IS_PI = hasattr(os, 'uname') and os.uname()[4][:3] == 'arm'
 
 TOGGLE_BUTTON = 21
@@ -37,16 +41,19 @@ if IS_PI:
 
 class GifViewer(FloatLayout):
 
-    def _LoadGifs(self):
-
+    def _ListGifs(self) -> List[str]:
         Path(GIF_PATH).mkdir(parents=True, exist_ok=True)
-
-        gif_list = [
+        # sorted, so the gif on screen keeps its place when others come and go
+        return sorted(
             os.path.join(GIF_PATH, f)
             for f in os.listdir(GIF_PATH)
             if os.path.isfile(os.path.join(GIF_PATH, f))
             and IS_GIF.match(f)
-        ]
+        )
+
+    def _LoadGifs(self):
+
+        gif_list = self._ListGifs()
         # didn't find any gifs...
         if len(gif_list) == 0:
             popup = Popup(
@@ -57,10 +64,30 @@ class GifViewer(FloatLayout):
             popup.open()
             return
 
-        self._gifs = [
-            AsyncImage(source=gif_path, size=Window.size, allow_stretch=True, keep_ratio=False)
-            for gif_path in gif_list
-        ]
+        gifs = []
+        for gif_path in gif_list:
+            try:
+                stat = os.stat(gif_path)
+            except FileNotFoundError:
+                continue
+            key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._gif_cache.get(gif_path)
+            if cached is not None and cached[0] == key:
+                # same file as last time, its textures are already up, keep the widget
+                gifs.append(cached[1])
+                continue
+            if cached is not None:
+                # kivy caches by source, drop the old frames or the new widget would just get them back
+                cached[1].remove_from_cache()
+            image = AsyncImage(source=gif_path, size=Window.size, allow_stretch=True, keep_ratio=False)
+            self._gif_cache[gif_path] = (key, image)
+            gifs.append(image)
+
+        for gif_path in set(self._gif_cache) - set(gif_list):
+            _, image = self._gif_cache.pop(gif_path)
+            image.remove_from_cache()
+
+        self._gifs = gifs
         self.has_loaded = True
 
     def GetNextGif(self):
@@ -74,28 +101,45 @@ class GifViewer(FloatLayout):
     def PowerOff(self):
         if not self.has_loaded:
             return
+        self.powered = False
         self.clear_widgets()
 
     def PowerOn(self):
         if not self.has_loaded:
             return
+        self.powered = True
         self.add_widget(self._gifs[self._current_gif])
 
     def __init__(self, **kwargs):
         super(GifViewer, self).__init__(**kwargs)
         self._current_gif: int = 0
         self._gifs: List[AsyncImage] = []
+        # path -> ((mtime_ns, size), widget), outlives reloads so only files that changed get decoded again
+        self._gif_cache: Dict[str, Tuple[Tuple[int, int], AsyncImage]] = {}
         self.has_loaded: bool = False
+        self.powered: bool = True
+        # a burst of watchdog events (copying a gif in fires one per write) turns into a single reload
+        self._reload_trigger = Clock.create_trigger(lambda dt: self._Reload(), RELOAD_DELAY)
         self._LoadGifs()
         self.PowerOn()
 
     def ReloadGifs(self):
+        # called from the watchdog thread, the clock runs the reload on the main thread
+        self._reload_trigger()
+
+    def _Reload(self):
         if not self.has_loaded:
             return
-        self.PowerOff()
+        current_gif = self._gifs[self._current_gif] if self._current_gif < len(self._gifs) else None
+        old_gifs = self._gifs
         self._LoadGifs()
-        self._current_gif = 0
-        self.PowerOn()
+        if self._gifs is old_gifs or self._gifs == old_gifs:
+            return
+        # stay on the gif that was showing if it's still around
+        self._current_gif = self._gifs.index(current_gif) if current_gif in self._gifs else 0
+        if self.powered:
+            self.clear_widgets()
+            self.add_widget(self._gifs[self._current_gif])
 
 
 class GifFolderWatcher:
@@ -118,6 +162,7 @@ class GifFolderHandler(PatternMatchingEventHandler):
     def __init__(self, viewer: GifViewer):
         # Set the patterns for PatternMatchingEventHandler
         PatternMatchingEventHandler.__init__(self, patterns=['*.gif'], ignore_directories=True, case_sensitive=False)
+        # every event only fires the viewer's clock trigger, the reload itself happens on the main thread
         self.viewer = viewer
 
     def on_created(self, event):
@@ -129,6 +174,10 @@ class GifFolderHandler(PatternMatchingEventHandler):
     def on_deleted(self, event):
         self.viewer.ReloadGifs()
 
+    def on_moved(self, event):
+        # a rename in or out of the folder, or onto a .gif name
+        self.viewer.ReloadGifs()
+
 
 class SparkyScreen(App):
 
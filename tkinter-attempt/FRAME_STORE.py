@@ -0,0 +1,241 @@
+
+import pathlib
+import os
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+FILE_PATH = pathlib.Path(__file__).parent.absolute()
+STORE_PATH = os.path.join(FILE_PATH, 'frame_store')
+
+# magic, width, height, frame count, source mtime_ns, source size
+MAGIC = b'SPKYFRM1'
+HEADER = struct.Struct('<8sIIIQQ')
+DURATION = struct.Struct('<I')
+
+# GIFs without a duration play at the old fixed rate
+DEFAULT_DURATION = 33
+
+# how many gifs FrameStoreCache keeps mapped, and how much frame data they can add up to
+DEFAULT_CACHED_GIFS = 3
+DEFAULT_CACHED_BYTES = 256 * 1024 * 1024
+
+
+def store_path_for(gif_path: str) -> str:
+    return os.path.join(STORE_PATH, os.path.basename(gif_path) + '.frames')
+
+
+def _frames_offset(frame_count: int) -> int:
+    # start the raw frames on a page boundary so every frame maps straight out of the page cache
+    index_size = HEADER.size + DURATION.size * frame_count
+    return (index_size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+
+
+def write_frame_store(gif_path: str, size: Tuple[int, int]) -> str:
+    """
+    Decode the GIF once and write every frame out as raw, screen sized RGB.
+
+    Layout: HEADER, one DURATION (ms) per frame, padding up to a page, then frame_count * width * height * 3 bytes.
+
+    Returns:
+        the path of the frame store
+    """
+    pathlib.Path(STORE_PATH).mkdir(parents=True, exist_ok=True)
+    store_path = store_path_for(gif_path)
+    tmp_path = store_path + '.tmp'
+
+    stat = os.stat(gif_path)
+    gif_image = Image.open(gif_path)
+    frame_count = getattr(gif_image, 'n_frames', 1)
+    durations: List[int] = []
+
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, size[0], size[1], frame_count, stat.st_mtime_ns, stat.st_size))
+        f.seek(_frames_offset(frame_count))
+        for i in range(frame_count):
+            gif_image.seek(i)
+            frame = gif_image.convert('RGB')
+            if frame.size != size:
+                frame = frame.resize(size)
+            f.write(frame.tobytes())
+            durations.append(gif_image.info.get('duration') or DEFAULT_DURATION)
+        f.seek(HEADER.size)
+        f.write(b''.join(DURATION.pack(duration) for duration in durations))
+
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+class FrameStore:
+    """
+    Memory mapped frame store for one GIF, frames come straight out of the page cache with no decoding.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        with open(store_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, height, frame_count, self.source_mtime_ns, self.source_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('{} is not a frame store'.format(store_path))
+        self.size = (width, height)
+        self.frame_count = frame_count
+        self.durations = [
+            DURATION.unpack_from(self._map, HEADER.size + DURATION.size * i)[0]
+            for i in range(frame_count)
+        ]
+        self._frame_bytes = width * height * 3
+        self._frames_offset = _frames_offset(frame_count)
+        self._view = memoryview(self._map)
+
+    def __len__(self):
+        return self.frame_count
+
+    @property
+    def nbytes(self) -> int:
+        return self.frame_count * self._frame_bytes
+
+    def advise_willneed(self):
+        # start paging the frames in now, rather than on the first pass through them
+        if hasattr(self._map, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+            self._map.madvise(mmap.MADV_WILLNEED)
+
+    def is_current(self, gif_path: str, size: Tuple[int, int]) -> bool:
+        stat = os.stat(gif_path)
+        return (
+            self.size == size
+            and self.source_mtime_ns == stat.st_mtime_ns
+            and self.source_size == stat.st_size
+        )
+
+    def frame(self, index: int) -> Image.Image:
+        start = self._frames_offset + index * self._frame_bytes
+        return Image.frombuffer('RGB', self.size, self._view[start:start + self._frame_bytes], 'raw', 'RGB', 0, 1)
+
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # a frame from this store is still alive somewhere, the map goes away with it
+            pass
+
+
+def open_frame_store(gif_path: str, size: Tuple[int, int]) -> FrameStore:
+    """
+    Map the GIF's frame store, (re)building it first if it's missing or out of date.
+    """
+    store_path = store_path_for(gif_path)
+    try:
+        store = FrameStore(store_path)
+    except (OSError, ValueError, struct.error):
+        store = None
+    if store is not None:
+        if store.is_current(gif_path, size):
+            return store
+        store.close()
+    return FrameStore(write_frame_store(gif_path, size))
+
+
+class FrameStoreCache:
+    """
+    Keeps only a few frame stores mapped, least recently used first out, so the library size doesn't matter.
+
+    get() is for the gif that has to go on screen now, prefetch() opens (building if needed) the one after it on a
+    background thread. Nothing in here touches tk, so it's safe to do off the main thread.
+
+    The store the last get() returned is playing, it's never evicted. If the budget can't fit a prefetched store
+    next to it, the prefetched one is dropped and gets opened by get() when its turn comes.
+    """
+
+    def __init__(self, size: Tuple[int, int], max_gifs: int = DEFAULT_CACHED_GIFS,
+                 max_bytes: int = DEFAULT_CACHED_BYTES):
+        self.size = size
+        # always room for the gif on screen and the one being prefetched
+        self.max_gifs = max(max_gifs, 2)
+        self.max_bytes = max_bytes
+        self._stores: 'OrderedDict[str, FrameStore]' = OrderedDict()
+        # the gif on screen, from the last get()
+        self._current: Optional[str] = None
+        self._prefetching: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, gif_path: str) -> FrameStore:
+        with self._lock:
+            self._current = gif_path
+            store = self._stores.get(gif_path)
+            if store is not None:
+                self._stores.move_to_end(gif_path)
+                return store
+            future = self._prefetching.get(gif_path)
+        if future is not None:
+            future.result()
+            with self._lock:
+                # it might not have fit, or got evicted before it was asked for
+                store = self._stores.get(gif_path)
+                if store is not None:
+                    self._stores.move_to_end(gif_path)
+                    return store
+        store = open_frame_store(gif_path, self.size)
+        self._Insert(gif_path, store)
+        return store
+
+    def prefetch(self, gif_path: str):
+        with self._lock:
+            if gif_path in self._stores or gif_path in self._prefetching:
+                return
+            self._prefetching[gif_path] = self._executor.submit(self._Prefetch, gif_path)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
+
+    def _Prefetch(self, gif_path: str) -> Optional[FrameStore]:
+        try:
+            store = open_frame_store(gif_path, self.size)
+            store.advise_willneed()
+            return store if self._Insert(gif_path, store) else None
+        finally:
+            with self._lock:
+                self._prefetching.pop(gif_path, None)
+
+    def _Insert(self, gif_path: str, store: FrameStore) -> bool:
+        """
+        Returns:
+            False if there was no room for store next to the gif on screen, it's been closed
+        """
+        with self._lock:
+            self._stores[gif_path] = store
+            self._stores.move_to_end(gif_path)
+            total_bytes = sum(cached.nbytes for cached in self._stores.values())
+
+            def over_budget():
+                return len(self._stores) > self.max_gifs or total_bytes > self.max_bytes
+
+            # closing the gif on screen would pull its frames out from under the player, and the one just asked
+            # for stays even if it's bigger than the budget on its own
+            pinned = {gif_path, self._current}
+            for cached_path in list(self._stores):
+                if not over_budget():
+                    break
+                if cached_path in pinned:
+                    continue
+                evicted = self._stores.pop(cached_path)
+                total_bytes -= evicted.nbytes
+                evicted.close()
+            if gif_path != self._current and over_budget():
+                del self._stores[gif_path]
+                store.close()
+                return False
+            return True
@@ -1,15 +1,13 @@
 
 import pathlib
 import os
-import pickle
-
-from PIL import Image, ImageTk
 
 import tkinter as tk
 
+from FRAME_STORE import write_frame_store
+
 FILE_PATH = pathlib.Path(__file__).parent.absolute()
 GIF_PATH = os.path.join(FILE_PATH, 'data')
-PICKLE_FILE = os.path.join(FILE_PATH, 'gif_pickle.dat')
 
 
 if __name__ == '__main__':
@@ -29,22 +27,11 @@ if __name__ == '__main__':
     screen_width = root.winfo_screenwidth()
     screen_height = root.winfo_screenheight()
 
-    print('pickling gifs')
-    gifs = []
+    root.destroy()
+
+    # PhotoImages can't be pickled, so store decoded frames that RASPI.py can mmap instead
+    print('writing frame stores at ' + str(screen_width) + 'x' + str(screen_height))
 
     for gif in gif_list:
-        gif_image = Image.open(gif)
-        gif_frames = []
-        try:
-            while True:
-                frame = ImageTk.PhotoImage(gif_image.copy())
-                print(frame)
-                quit()
-                gif_frames.append(frame)
-                gif_image.seek(len(gif_frames))
-        except EOFError:
-            pass
-        gifs.append(gif_frames)
-
-    pickle_file = open(PICKLE_FILE, 'wb')
-    pickle.dump(gifs, pkl_file, protocol=pickle.HIGHEST_PROTOCOL)
+        print(gif)
+        write_frame_store(gif, (screen_width, screen_height))
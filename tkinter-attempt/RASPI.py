@@ -1,6 +1,7 @@
 
 import pathlib
 import os
+import time
 
 from typing import Optional, List
 
@@ -8,18 +9,35 @@ import tkinter as tk
 from tkinter import messagebox
 from PIL import Image, ImageTk
 
+from FRAME_STORE import FrameStore, FrameStoreCache
+
 
 FILE_PATH = pathlib.Path(__file__).parent.absolute()
 GIF_PATH = os.path.join(FILE_PATH, 'data')
 
-# 30hz
-REFRESH_DELAY = 33
+# ms, frames asking for less than this get SHORT_FRAME_DURATION instead, like browsers do
+MIN_FRAME_DURATION = 20
+SHORT_FRAME_DURATION = 100
+
+# seconds past its deadline before a frame counts as late
+LATE_FRAME_THRESHOLD = 0.005
+# ms between late / dropped frame reports
+FRAME_STATS_INTERVAL = 60 * 1000
+
+# gifs kept mapped at once (the one on screen plus the next), and the most frame data they can add up to
+GIF_CACHE_SIZE = 3
+GIF_CACHE_BYTES = 256 * 1024 * 1024
 
 IS_PI = hasattr(os, 'uname') and os.uname()[4][:3] == 'arm'
 
 TOGGLE_BUTTON = 21
 POWER_BUTTON = 20
 
+TOGGLE_PUSHED_EVENT = '<<TogglePushed>>'
+TOGGLE_RELEASED_EVENT = '<<ToggleReleased>>'
+POWER_PUSHED_EVENT = '<<PowerPushed>>'
+POWER_RELEASED_EVENT = '<<PowerReleased>>'
+
 if IS_PI:
     from gpiozero import Button
 
@@ -38,48 +56,137 @@ class GifViewer(tk.Frame):
             self.panicked_parent.PANIC()
             return
         
-        for gif in gif_list:
-            gif_image = Image.open(gif)
-            gif_frames = []
-            try:
-                while True:
-                    frame = ImageTk.PhotoImage(gif_image.copy())
-                    gif_frames.append(frame)
-                    gif_image.seek(len(gif_frames))
-            except EOFError:
-                pass
-            self.gifs.append(gif_frames)
+        self.gifs = gif_list
+        # only the gif on screen gets loaded up front, the next one is prefetched while this one plays
+        self._ShowGif(0)
+
+    def _ShowGif(self, index: int):
+        # only decodes gifs PICKLE_GIFS.py hasn't already stored (or that changed since), the rest just get mapped
+        self.current_gif = index
+        self.current_store = self.gif_cache.get(self.gifs[index])
+        self.gif_cache.prefetch(self.gifs[(index + 1) % len(self.gifs)])
 
     def GetNextGif(self):
         self.current_frame = 0
         next_gif = self.current_gif + 1
-        self.current_gif = next_gif if next_gif < len(self.gifs) else 0
+        self._ShowGif(next_gif if next_gif < len(self.gifs) else 0)
+        self._StartPlayback()
 
     def __init__(self, parent, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
         self.panicked_parent: SparkyScreen = parent
         self.current_gif: int = 0
         self.current_frame: int = 0
-        self.gifs: List[List[ImageTk]] = []
+        self.gifs: List[str] = []
+        self.current_store: Optional[FrameStore] = None
         self.screen_width = parent.winfo_screenwidth()
         self.screen_height = parent.winfo_screenheight()
+        self.gif_cache = FrameStoreCache(
+            (self.screen_width, self.screen_height), max_gifs=GIF_CACHE_SIZE, max_bytes=GIF_CACHE_BYTES
+        )
         self._LoadGifs()
         blank_image = Image.new('RGB', (self.screen_width, self.screen_height), 'black')
         self.blank_image = ImageTk.PhotoImage(blank_image)
+        # every frame gets pasted into the one PhotoImage rather than keeping one per frame
+        self.frame_image = ImageTk.PhotoImage('RGB', (self.screen_width, self.screen_height))
         self.image_label = tk.Label(self)
         self.image_label.pack(fill=tk.BOTH, expand=tk.YES)
+        self.powered = True
+        # what the label is showing, so it only gets reconfigured when that changes
+        self._label_image: Optional[ImageTk.PhotoImage] = None
+        # monotonic time the frame on screen is due to be replaced
+        self._deadline = 0.0
+        self._tick_handle: Optional[str] = None
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.shown_frames = 0
+        if self.current_store is not None:
+            self._StartPlayback()
+        self.after(FRAME_STATS_INTERVAL, self._ReportFrameStats)
+
+    def _FrameDuration(self, index: int) -> float:
+        duration = self.current_store.durations[index]
+        # same as browsers, gifs asking for next to no delay get slowed down rather than run flat out
+        if duration < MIN_FRAME_DURATION:
+            duration = SHORT_FRAME_DURATION
+        return duration / 1000
 
     def _StepFrame(self):
         next_frame = self.current_frame + 1
-        self.current_frame = next_frame if next_frame < len(self.gifs[self.current_gif]) else 0
+        self.current_frame = next_frame if next_frame < len(self.current_store) else 0
+
+    def _SetLabelImage(self, image: ImageTk.PhotoImage):
+        if image is not self._label_image:
+            self.image_label.config(image=image)
+            self._label_image = image
 
     def UpdateImage(self):
-        self.image_label.config(image=self.gifs[self.current_gif][self.current_frame])
-        self._StepFrame()
+        # pasting into the PhotoImage the label already shows is enough to redraw it
+        self.frame_image.paste(self.current_store.frame(self.current_frame))
+        self._SetLabelImage(self.frame_image)
+        self.shown_frames += 1
+
+    def _CancelTick(self):
+        if self._tick_handle is not None:
+            self.after_cancel(self._tick_handle)
+            self._tick_handle = None
+
+    def _StartPlayback(self):
+        self._CancelTick()
+        if not self.powered:
+            return
+        self.UpdateImage()
+        self._deadline = time.monotonic() + self._FrameDuration(self.current_frame)
+        self._ScheduleTick()
 
-    def DisplayBlack(self):
-        self.image_label.config(image=self.blank_image)
+    def _ScheduleTick(self):
+        # a single frame gif never needs redrawing
+        if len(self.current_store) < 2:
+            return
+        delay = max(0, round((self._deadline - time.monotonic()) * 1000))
+        self._tick_handle = self.after(delay, self._Tick)
+
+    def _Tick(self):
+        self._tick_handle = None
+        now = time.monotonic()
+        if now - self._deadline > LATE_FRAME_THRESHOLD:
+            self.late_frames += 1
         self._StepFrame()
+        # deadlines come off the previous deadline, not off now, so callback overhead never adds up
+        deadline = self._deadline + self._FrameDuration(self.current_frame)
+        # any frame whose whole slot is already over gets skipped, to stay in step instead of playing slow
+        while deadline <= now:
+            self.dropped_frames += 1
+            self._StepFrame()
+            deadline += self._FrameDuration(self.current_frame)
+        self._deadline = deadline
+        self.UpdateImage()
+        self._ScheduleTick()
+
+    def _ReportFrameStats(self):
+        if self.late_frames > 0 or self.dropped_frames > 0:
+            print('frames: {} shown, {} late, {} dropped'.format(
+                self.shown_frames, self.late_frames, self.dropped_frames
+            ))
+        self.shown_frames = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.after(FRAME_STATS_INTERVAL, self._ReportFrameStats)
+
+    def PowerOff(self):
+        self.powered = False
+        self._CancelTick()
+        self._SetLabelImage(self.blank_image)
+
+    def PowerOn(self):
+        self.powered = True
+        # pick back up where it was, the screen was black in between so there's nothing to catch up on
+        self._StartPlayback()
+
+    def destroy(self):
+        self._CancelTick()
+        self.gif_cache.close()
+        super().destroy()
 
 
 class SparkyScreen(tk.Tk):
@@ -90,20 +197,29 @@ class SparkyScreen(tk.Tk):
         self.resizable(width=False, height=False)
         self.gif_viewer: GifViewer = GifViewer(self)
         self.gif_viewer.pack(fill=tk.BOTH)
-        self.toggle_flag = False
-        self.last_toggle = False
-        self.power_off_flag = False
+        self.toggle_pressed = False
+        self.power_pressed = False
         if not IS_PI:
             self.bind('<KeyPress>', self.Keydown)
             self.bind('<KeyRelease>', self.Keyup)
         else:
+            # gpiozero calls back on its own thread, hand every edge to the tk thread as a virtual event
+            for name, handler in (
+                (TOGGLE_PUSHED_EVENT, self._ToggleButtonPushed),
+                (TOGGLE_RELEASED_EVENT, self._ToggleButtonReleased),
+                (POWER_PUSHED_EVENT, self._PowerButtonPushed),
+                (POWER_RELEASED_EVENT, self._PowerButtonReleased),
+            ):
+                self.bind(name, lambda event, handler=handler: handler())
             self.toggle_button = Button(TOGGLE_BUTTON)
-            self.toggle_button.when_pressed = self._ToggleButtonPushed
-            self.toggle_button.when_released = self._ToggleButtonReleased
+            self.toggle_button.when_pressed = lambda: self._PostEvent(TOGGLE_PUSHED_EVENT)
+            self.toggle_button.when_released = lambda: self._PostEvent(TOGGLE_RELEASED_EVENT)
             self.power_button = Button(POWER_BUTTON)
-            self.power_button.when_pressed = self._PowerButtonPushed
-            self.power_button.when_released = self._PowerButtonReleased
-        self.after(REFRESH_DELAY, self.DoUpdate)
+            self.power_button.when_pressed = lambda: self._PostEvent(POWER_PUSHED_EVENT)
+            self.power_button.when_released = lambda: self._PostEvent(POWER_RELEASED_EVENT)
+
+    def _PostEvent(self, name: str):
+        self.event_generate(name, when='tail')
 
     def Keydown(self, event):
         # spacebar, toggle
@@ -122,35 +238,27 @@ class SparkyScreen(tk.Tk):
             self._PowerButtonReleased()
 
     def _ToggleButtonPushed(self):
-        self.toggle_flag = True
+        # make sure holding down the button (or key repeat) won't spam it
+        if self.toggle_pressed:
+            return
+        self.toggle_pressed = True
+        self.gif_viewer.GetNextGif()
 
     def _ToggleButtonReleased(self):
-        self.toggle_flag = False
+        self.toggle_pressed = False
 
     def _PowerButtonPushed(self):
-        self.power_off_flag = True
+        # display black while "no power" is held
+        if self.power_pressed:
+            return
+        self.power_pressed = True
+        self.gif_viewer.PowerOff()
 
     def _PowerButtonReleased(self):
-        self.power_off_flag = False
-
-    def DoUpdate(self):
-
-        # if its a new toggle
-        if self.toggle_flag and self.toggle_flag != self.last_toggle:
-            # get the next image
-            self.gif_viewer.GetNextGif()
-        # make sure holding down the button won't spam it
-        self.last_toggle = self.toggle_flag
-
-        # display black if "no power"
-        if self.power_off_flag:
-            self.gif_viewer.DisplayBlack()
-        # otherwise, show the image
-        else:
-            self.gif_viewer.UpdateImage()
-
-        # manually reset the counter
-        self.after(REFRESH_DELAY, self.DoUpdate)
+        if not self.power_pressed:
+            return
+        self.power_pressed = False
+        self.gif_viewer.PowerOn()
 
     def PANIC(self):
         self.destroy()